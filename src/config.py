@@ -7,12 +7,16 @@ temp_dir = "/tmp/projectname-deploy-tmp"
 # Env archive file name
 arch_name = "projectname.dist.tar.gz"
 
+# Codec of the env archive and default codec of dumped images: none, gzip, zstd, with level e.g. 'zstd:19' (default: gzip:9)
+compression = 'gzip:9'
+
 # Directory on the destination server for extracting the environment
 destination_dir = "projectname"
 
 # Variables
 # Built-in variables: VERSION, ENV, DESTINATION_DIR, DOCKER_PROJECT_NAME, TEMP_DIR, TEMP_ENVIRONMENT_DIR
-# Use $VARNAME variables in paths and ${VARNAME} in file contents
+# Use $VARNAME or ${VARNAME} variables in paths, names and commands and ${VARNAME} in file contents
+# Environment variables are available too, server variables override them and they override these ones
 variables = {
     'DOCKER_PROJECT_NAME': 'projectname',
     'SUDO': 'sudo'
@@ -21,6 +25,13 @@ variables = {
 # Replace content variables only if file name matches pattern
 replace_vars_file_patterns = ['.conf$', '.yml$', 'default$']
 
+# Number of files rendered at the same time (default: number of CPUs)
+env_workers = 8
+
+# How files without variables are placed to the environment: reflink (default, falls back to copy), hardlink or copy.
+# Hard linked files share data with the sources: a file changed in place in the environment changes the source too
+env_link = 'reflink'
+
 # Run command to start the project on the destination server
 run_command = "cd $DESTINATION_DIR && docker-compose -p $DOCKER_PROJECT_NAME up -d"
 
@@ -29,7 +40,32 @@ run_command = "cd $DESTINATION_DIR && docker-compose -p $DOCKER_PROJECT_NAME up
 docker = {
     'host': 'ssh://user@remote-ssh-docker-host', # Global Docker host
     'buildx': False,  # Global buildx option
-    'platform': 'linux/amd64'  # Global platform
+    'platform': 'linux/amd64',  # Global platform
+    'build_workers': 4,  # Number of parallel builds
+    'host_build_workers': 2,  # Number of parallel builds per docker host
+    'build_cache': True,  # Skip builds with unchanged Dockerfile, context and build options
+    'buildx_cache': {'type': 'local', 'max_size': '10G'},  # BuildKit cache of buildx builds: local or registry
+    'push_cache': False,  # Skip push of images which were already pushed from this machine
+    'push_workers': 4,  # Number of parallel pushes
+    'push_check': True,  # Skip push of images which registry already has
+    'dump_workers': 4,  # Number of parallel image dumps (docker save)
+    'dump_compression': 'gzip',  # Codec of dumped images: gzip (pigz if installed), zstd, none, with level e.g. 'zstd:19'
+    'compress_threads': 0,  # Number of compression threads, 0 for number of CPUs
+    'cleanup_background': False,  # Remove old images in background after run_command
+    'import_workers': 2  # Number of images loaded on the server at the same time
+}
+
+# Timeout of local commands in seconds, 0 for no timeout. Commands with timeout run without terminal
+command_timeout = 0
+
+# SSH configuration
+ssh = {
+    'multiplexing': True,  # Use one connection per server for all ssh and rsync calls
+    'persist': 60,  # Optional: seconds the idle master connection is kept open (default: 60)
+    'connect_timeout': 10,  # Optional: timeout of opening the master connection in seconds (default: 10)
+    # Timeout of remote commands, uploads and streams in seconds, 0 for no timeout (default: command_timeout).
+    # Commands with timeout run without terminal: ssh can not ask for passwords or to accept host keys
+    'timeout': 0
 }
 
 # List of Docker containers to build and deploy
@@ -40,14 +76,17 @@ containers = [
         'dockerfile': 'docker/projectname/Dockerfile',  # Path to Dockerfile
         'build_path': '',  # Build path (empty means use directory of Dockerfile)
         'build_args': ['VERSION=$VERSION'],  # Build arguments
-        'build_contexts': ['app1=/path/to/app1-src-dir'],  # Build contexts
+        'build_contexts': ['app1=/path/to/app1-src-dir'],  # Build contexts, relative paths are relative to work_dir
         'arch_name': 'projectname-first-container.tar',  # Archive name for the container
+        'transfer': 'layers',  # Optional: send only layers missing on the server
+        'compress': 'zstd',  # Optional: codec of the dumped image or of the layers stream, overrides dump_compression
         'buildx': True,  # Use buildx for this container
         'platform': 'linux/amd64',  # Platform for this container
         'docker_host': 'ssh://user@remote-ssh-docker-host-another',  # Docker host for this container,
         'cleanup_old': True,  # Optional: enable cleanup of old versions (default: false)
         'keep_versions': 5,   # Optional: number of versions to keep (default: 3)
-        'cleanup_pattern': '*-prod'  # Optional: pattern to match tags for cleanup (default: *-{build_type})
+        'cleanup_pattern': '*-prod',  # Optional: pattern to match tags for cleanup (default: *-{build_type})
+        'depends_on': ['projectname-second-container']  # Optional: containers to build before this one
     },
     {
         'name': 'projectname-second-container:$VERSION',
@@ -120,9 +159,54 @@ servers = {
         'version': '0.0.1',
         'env': 'prod',
         'destination_dir': 'projectname',
+        'tags': ['web'],  # Tags to deploy group of servers
         'variables': {
             'DOMAIN': 'projectname.com',
             'SUDO': ''  # No sudo required for production
         }
     },
-}
\ No newline at end of file
+    'prod2': {
+        'host': 'projectname-prod2',
+        'version': '0.0.1',
+        'env': 'prod',
+        'destination_dir': 'projectname',
+        'tags': ['web'],
+        'variables': {
+            'DOMAIN': 'projectname.com',
+            'SUDO': ''
+        }
+    },
+}
+
+# Server groups: deploy to all servers of the group using group name or server tag
+# Servers of a group get the environment and containers built for the first of them, do not mix dev and prod
+groups = {
+    'production': ['prod', 'prod2']
+}
+
+# Number of servers of a group to deploy at the same time
+parallel = 10
+
+# Extract, import containers and run in one remote session (same as --transaction)
+transaction = False
+
+# Stream environment to the server without archive on local disk (same as --stream)
+stream = False
+
+# Run build-env, build, push and deploy as one task graph (same as --pipeline)
+pipeline = False
+
+# Run history: runs kept per server, stages past the percentile of the window of previous runs are regressions
+history = {
+    'keep': 1000,
+    'window': 20,
+    'percentile': 90
+}
+
+# Watch command: debounce of changes in seconds, reload hooks by patterns of changed paths
+watch = {
+    'debounce': 0.2,  # Changes are sent when nothing changes for this time
+    'hooks': {
+        'nginx/*': 'docker exec $DOCKER_PROJECT_NAME-nginx-1 nginx -s reload'
+    }
+}
@@ -9,7 +9,30 @@ import subprocess
 import json
 import http.client
 import pprint
+import shlex
+import threading
+import tempfile
+import shutil
+import atexit
+import copy
+import gzip
+import io
+import hashlib
+import tarfile
+import fnmatch
+import fcntl
+import time
+import functools
+import contextlib
+import sqlite3
+import ctypes
+import ctypes.util
+import select
+import struct
+from collections import ChainMap, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
+from stat import S_ISREG
 
 version = "v1.2.40"
 
@@ -22,11 +45,93 @@ skip_containers_flag = False
 update_flag = False
 config_flag = False
 version_flag = False
+flags = []
+
+# Server, group or tag of the command line; servers of the group, first of them is the server
+server_name = ''
+servers = []
+# Variables of the config and environment without the variables of the first server
+base_variables = ChainMap()
+
+# Variables in file contents: ${VARNAME}
+content_variable_pattern = re.compile(rb'\$\{([^${}\s]+)\}')
+
+# Variables in paths, names and commands: ${VARNAME} or $VARNAME, the longest defined name is used
+template_variable_pattern = re.compile(r'\$\{(\w+)\}|\$(\w+)')
+render_chunk_size = 1024 * 1024
+render_max_name_length = 1024
+
+# Linux ioctl which clones file data (copy-on-write copy on btrfs, xfs)
+FICLONE = 0x40049409
+
+# Linux inotify events of watch: modify, attrib, close_write, moved_from, moved_to, create, delete
+IN_CHANGED = 0x3ce
+IN_ADDED = 0x180
+IN_IGNORED = 0x8000
+IN_Q_OVERFLOW = 0x4000
+IN_ISDIR = 0x40000000
+
+# Marker of remote transaction steps in output
+step_marker = '##AIRSHIP_STEP'
+
+# Multiplexed ssh connections
+ssh_lock = threading.RLock()
+ssh_masters = {}
+ssh_control_dir = ''
+
+# Fingerprints of built images
+docker_build_cache_lock = threading.Lock()
+
+# Local BuildKit caches of buildx builds: lock of the cache directory, locks of caches in use
+buildx_cache_lock = threading.Lock()
+buildx_cache_users = {}
+
+# Steps of buildx builds in plain progress output: "#5 [app 2/4] RUN ..." and "#5 CACHED"
+buildx_step_pattern = re.compile(r'^#(\d+) (?:\[[^\]]*\d+/\d+\]|(CACHED)$)')
+
+# Pushes skipped by the pipeline because registry has the images
+pipeline_skipped_pushes = []
+
+# Environment archives uploaded by the pipeline before deploy: server name -> content hash to extract, None if the
+# server has the same archive
+pipeline_uploads = {}
+
+# Trace of commands and stages: --trace=file.json
+trace_file = ''
+trace_spans = []
+trace_lock = threading.Lock()
+
+# Image IDs of dumped images: dump path -> image ID
+dumped_image_ids = {}
+
+# Sizes and transfers of deploy artifacts: name -> sizes and transfers to servers
+transfer_artifacts = {}
+transfer_lock = threading.Lock()
+
+# Running commands: process -> True if it is killed by timeout
+running_processes = {}
+running_lock = threading.Lock()
+
+# Durations of stages and counters of cache hits for the run history
+history_stages = []
+history_counters = {}
+history_lock = threading.Lock()
+interrupted_flag = False
+
+# Last output lines of a command kept for its error
+output_tail_lines = 50
+
+# Exit code of commands killed by timeout, as timeout(1) does
+timeout_code = 124
+
+# Output of parallel tasks
+output_lock = threading.Lock()
+thread_local = threading.local()
 
 # -- Lib
 
 def usage():
-    print("AirShip [%s] usage: deploy.py [server name] {commands} {options}" % version)
+    print("AirShip [%s] usage: deploy.py [server name|group|tag] {commands} {options}" % version)
     print("")
     print("Commands: ")
     print(" build-env  build environment content")
@@ -34,11 +139,23 @@ def usage():
     print(" push       push docker containers to registry")
     print(" deploy     make environment archive, upload it to server, and run")
     print(" run        execute 'run' command")
+    print(" history    show recent runs and stages slower than percentile of recent runs")
+    print(" watch      send changed environment files to server and run reload hooks")
     print("")
     print("Options: ")
     print(" -v                   verbose mode, print executed commands")
     print(" --dry                dry run mode, all commands will not executed")
     print(" --skip-containers    skip build, deploy and import docker containers")
+    print(" --parallel=N         number of servers of a group to deploy at the same time")
+    print(" --transaction        extract, import containers and run in one remote session")
+    print(" --force-build        build containers even if their inputs are not changed")
+    print(" --force-upload       upload environment archive even if it is not changed")
+    print(" --stream             stream environment to server without archive on local disk")
+    print(" --trace=FILE         write timings of stages and commands to FILE in Chrome trace format")
+    print(" --pipeline           run build-env, build, push and deploy as one task graph, stages overlap")
+    print(" --transfer-report=FILE  write sizes and transfers of deploy artifacts to FILE (default: temp_dir)")
+    print(" --clean              remove temp directory and build environment from scratch")
+    print(" --last=N             number of runs shown by history (default: 10)")
     print("")
     print(" --version            print this script version")
     print(" --update             update this script")
@@ -46,115 +163,1157 @@ def usage():
 
 # -- Lib
 
+def prefix():
+    return getattr(thread_local, 'prefix', '')
+
+
+def out(text):
+    with output_lock:
+        print(text, flush=True)
+
+
 def mes(text):
-    print('\033[92m# [' + datetime.now().strftime('%H:%M:%S.%f') + '] ' + text + '\033[0m')
+    out('\033[92m# [' + datetime.now().strftime('%H:%M:%S.%f') + '] ' + prefix() + text + '\033[0m')
 
 
 def err(text):
-    print('\033[91m# ' + text + '\033[0m')
+    out('\033[91m# ' + prefix() + text + '\033[0m')
 
 
 def deb(text):
     if not debug_flag:
         return
-    print('\033[90m' + text + '\033[0m')
+    out('\033[90m' + prefix() + text + '\033[0m')
+
+
+class Span:
+    """Timed step of the trace: stage, task, command, ssh, upload
+
+    Used as context manager, args are shown in the trace viewer and can be updated until the span ends.
+    """
+
+    def __init__(self, name, category, **args):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        stack = getattr(thread_local, 'spans', [])
+        self.parent = stack[-1].category if stack else ''
+        thread_local.spans = stack + [self]
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end = time.time()
+        thread_local.spans = thread_local.spans[:-1]
+        if exc_type is not None and issubclass(exc_type, SystemExit):
+            self.args.setdefault('code', exc.code)
+        elif exc_type is not None:
+            self.args.setdefault('error', str(exc))
+
+        if self.category == 'stage':
+            with history_lock:
+                history_stages.append((self.name, self.end - self.start))
+
+        if trace_file:
+            self.thread = prefix().strip() or threading.current_thread().name
+            with trace_lock:
+                trace_spans.append(self)
+        return False
+
+
+def write_trace(file):
+    """Write spans in Chrome trace event format (chrome://tracing, ui.perfetto.dev)"""
+    if not trace_spans:
+        return
+
+    start = min(span.start for span in trace_spans)
+    threads = {}
+    events = []
+    for span in sorted(trace_spans, key=lambda span: span.start):
+        tid = threads.setdefault(span.thread, len(threads) + 1)
+        events.append({
+            'name': span.name,
+            'cat': span.category,
+            'ph': 'X',
+            'ts': int((span.start - start) * 1000000),
+            'dur': int((span.end - span.start) * 1000000),
+            'pid': 1,
+            'tid': tid,
+            'args': span.args,
+        })
+    for name, tid in threads.items():
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': name}})
+
+    with open(file, 'w') as f:
+        f.write(json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'}, default=str))
+
+
+def trace_summary(count=10):
+    """Print the slowest commands, uploads and remote calls"""
+    spans = [span for span in trace_spans
+             if span.category not in ['stage', 'task'] and span.parent not in ['ssh', 'upload', 'stream']]
+    if not spans:
+        return
+
+    mes("Slowest steps")
+    out("%-8s %-8s %-24s %s" % ('TIME', 'TYPE', 'WHERE', 'COMMAND'))
+    for span in sorted(spans, key=lambda span: span.start - span.end)[:count]:
+        command = ' '.join(str(span.args.get('command', span.args.get('file', span.name))).split())
+        out("%-8s %-8s %-24s %s" % (
+            "%.1fs" % (span.end - span.start),
+            span.category,
+            span.args.get('host', span.thread)[:24],
+            command[:100]
+        ))
+
+
+def finish_trace():
+    if not trace_file:
+        return
+    trace_summary()
+    write_trace(trace_file)
+    mes("Trace is written to %s" % trace_file)
+
+
+def account_artifact(name, kind, raw_bytes, compressed_bytes, **fields):
+    """Record sizes of the artifact built for deploy: environment archive or image dump"""
+    if dry_run_flag:
+        return
+    with transfer_lock:
+        artifact = transfer_artifacts.setdefault(name, {'transfers': []})
+        artifact.update(kind=kind, raw_bytes=raw_bytes, compressed_bytes=compressed_bytes,
+                        ratio=round(compressed_bytes / raw_bytes, 3) if raw_bytes else None, **fields)
+
+
+def account_transfer(name, variables, method, sent_bytes, seconds):
+    """Record transfer of the artifact to the server: method is rsync, stream, layers or skipped"""
+    if dry_run_flag:
+        return
+    with transfer_lock:
+        transfer_artifacts.setdefault(name, {'transfers': []})['transfers'].append({
+            'server': variables.get('SERVER_NAME', ''),
+            'method': method,
+            'bytes': sent_bytes,
+            'seconds': round(seconds, 3),
+            'throughput': int(sent_bytes / seconds) if seconds > 0 else None,
+        })
+
+
+def format_size(size):
+    if size is None:
+        return '-'
+    for unit in ['B', 'K', 'M', 'G']:
+        if abs(size) < 1024:
+            return ("%d%s" if unit == 'B' else "%.1f%s") % (size, unit)
+        size /= 1024
+    return "%.1fT" % size
+
+
+def transfer_report():
+    """Print sizes and transfers of artifacts, largest first, and write them as JSON
+
+    The file is --transfer-report=FILE or transfers.json in temp_dir.
+    """
+    with transfer_lock:
+        artifacts = [dict(name=name, **artifact) for name, artifact in transfer_artifacts.items()]
+    if not artifacts:
+        return
+
+    artifacts.sort(key=lambda artifact: (-(artifact.get('compressed_bytes') or 0), artifact['name']))
+
+    mes("Transfers")
+    out("%-32s %-12s %9s %9s %6s %-20s %-8s %9s %8s %10s" % (
+        'ARTIFACT', 'KIND', 'RAW', 'SIZE', 'RATIO', 'SERVER', 'METHOD', 'SENT', 'TIME', 'SPEED'))
+    for artifact in artifacts:
+        row = "%-32s %-12s %9s %9s %6s" % (
+            artifact['name'][:32], artifact.get('kind', ''), format_size(artifact.get('raw_bytes')),
+            format_size(artifact.get('compressed_bytes')),
+            '-' if artifact.get('ratio') is None else "%.2f" % artifact['ratio'])
+        if not artifact['transfers']:
+            out(row + (" in %s" % artifact['archive'] if 'archive' in artifact else ''))
+        for transfer in artifact['transfers']:
+            out(row + " %-20s %-8s %9s %7.1fs %10s" % (
+                transfer['server'][:20], transfer['method'], format_size(transfer['bytes']), transfer['seconds'],
+                '-' if transfer['throughput'] is None else format_size(transfer['throughput']) + '/s'))
+
+    file = get_flag_value('--transfer-report', os.path.join(config.temp_dir, 'transfers.json'))
+    report = {'server': config.variables.get('SERVER_NAME', ''), 'version': config.variables.get('VERSION', ''), 'artifacts': artifacts}
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(file)), exist_ok=True)
+        with open(file, 'w') as f:
+            json.dump(report, f, indent=1)
+        mes("Transfer report is written to %s" % file)
+    except OSError as e:
+        err("Failed to write transfer report %s: %s" % (file, str(e)))
+
+
+def count(name, value=1):
+    """Add value to the counter of the run history: cache hits, skipped builds, pushes and imports"""
+    with history_lock:
+        history_counters[name] = history_counters.get(name, 0) + value
+
+
+def history_settings():
+    return getattr(config, 'history', {})
+
+
+def cache_home():
+    return os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'airship')
+
+
+def history_file():
+    return history_settings().get('file', '') or os.path.join(cache_home(), 'history.sqlite')
+
+
+def history_project():
+    """Runs of the same project share history: absolute work_dir"""
+    return os.path.abspath(config.work_dir)
+
+
+def open_history():
+    os.makedirs(os.path.dirname(os.path.abspath(history_file())), exist_ok=True)
+    db = sqlite3.connect(history_file(), timeout=10)
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, project TEXT, server TEXT, version TEXT,
+            commands TEXT, started REAL, duration REAL, code INTEGER);
+        CREATE INDEX IF NOT EXISTS runs_server ON runs (project, server, id);
+        CREATE TABLE IF NOT EXISTS stages (run_id INTEGER, name TEXT, duration REAL);
+        CREATE TABLE IF NOT EXISTS artifacts (run_id INTEGER, name TEXT, kind TEXT, raw_bytes INTEGER,
+            compressed_bytes INTEGER, sent_bytes INTEGER);
+        CREATE TABLE IF NOT EXISTS counters (run_id INTEGER, name TEXT, value INTEGER);
+    """)
+    return db
+
+
+def save_history(commands, started, code):
+    """Append the run to the history: stage durations, artifact sizes, counters and exit status
+
+    The newest keep runs of the server are kept. Returns id of the run or None.
+    """
+    settings = history_settings()
+    if not settings.get('enabled', True) or dry_run_flag or not commands or \
+            set(commands) <= {'version', 'update', 'config', 'history', 'watch'}:
+        return None
+
+    with history_lock, transfer_lock:
+        stages = {}
+        for name, duration in history_stages:
+            stages[name] = stages.get(name, 0) + duration
+        counters = dict(history_counters)
+        artifacts = [(name, artifact.get('kind', ''), artifact.get('raw_bytes'), artifact.get('compressed_bytes'),
+                      sum(transfer['bytes'] for transfer in artifact['transfers']))
+                     for name, artifact in transfer_artifacts.items()]
+
+    try:
+        with contextlib.closing(open_history()) as db, db:
+            run_id = db.execute(
+                "INSERT INTO runs (project, server, version, commands, started, duration, code) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (history_project(), server_name, config.variables.get('VERSION', ''), ",".join(commands), started,
+                 time.time() - started, code)).lastrowid
+            db.executemany("INSERT INTO stages VALUES (?, ?, ?)", [(run_id, name, duration)
+                                                                  for name, duration in stages.items()])
+            db.executemany("INSERT INTO artifacts VALUES (?, ?, ?, ?, ?, ?)", [(run_id,) + artifact
+                                                                               for artifact in artifacts])
+            db.executemany("INSERT INTO counters VALUES (?, ?, ?)", [(run_id, name, value)
+                                                                    for name, value in counters.items()])
+
+            keep = int(settings.get('keep', 1000))
+            old = "SELECT id FROM runs WHERE project = ? AND server = ? ORDER BY id DESC LIMIT -1 OFFSET ?"
+            for table, column in [('stages', 'run_id'), ('artifacts', 'run_id'), ('counters', 'run_id'), ('runs', 'id')]:
+                db.execute("DELETE FROM %s WHERE %s IN (%s)" % (table, column, old),
+                           (history_project(), server_name, keep))
+        return run_id
+    except (sqlite3.Error, OSError) as e:
+        err("Failed to write run history %s: %s" % (history_file(), str(e)))
+        return None
+
+
+def load_history(db, server, limit):
+    """Last runs of the server, newest first: dicts with stages, artifacts and counters"""
+    runs = [dict(zip(['id', 'version', 'commands', 'started', 'duration', 'code'], row)) for row in db.execute(
+        "SELECT id, version, commands, started, duration, code FROM runs WHERE project = ? AND server = ? "
+        "ORDER BY id DESC LIMIT ?", (history_project(), server, limit))]
+    for run in runs:
+        run['stages'] = dict(db.execute("SELECT name, duration FROM stages WHERE run_id = ?", (run['id'],)))
+        run['artifacts'] = {name: (compressed or 0, sent or 0) for name, compressed, sent in db.execute(
+            "SELECT name, compressed_bytes, sent_bytes FROM artifacts WHERE run_id = ?", (run['id'],))}
+        run['counters'] = dict(db.execute("SELECT name, value FROM counters WHERE run_id = ?", (run['id'],)))
+    return runs
+
+
+def percentile(values, p):
+    """p-th percentile of values with linear interpolation"""
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    low = int(k)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (k - low)
+
+
+def history_trends(runs, p, min_runs=5, tolerance=0.1, min_seconds=1.0):
+    """Stages and artifacts of the newest run compared with successful runs before it
+
+    Returns rows: kind (stage or artifact), name, last value, median, percentile, number of runs, regression
+    flag. Regression is a value past the percentile of at least min_runs previous runs by more than tolerance,
+    and for stages by min_seconds at least, so jitter of short stages is not reported.
+    """
+    if not runs:
+        return []
+    last, previous = runs[0], [run for run in runs[1:] if run['code'] == 0]
+
+    rows = []
+    for kind, values in [('stage', lambda run: run['stages']),
+                         ('artifact', lambda run: {name: sizes[0] for name, sizes in run['artifacts'].items()})]:
+        for name, value in sorted(values(last).items()):
+            history = [values(run)[name] for run in previous if name in values(run)]
+            if not history:
+                rows.append((kind, name, value, None, None, 0, False))
+                continue
+            limit = percentile(history, p)
+            rows.append((kind, name, value, percentile(history, 50), limit, len(history),
+                         len(history) >= min_runs and value > limit * (1 + tolerance)
+                         and (kind != 'stage' or value - limit >= min_seconds)))
+    return rows
+
+
+def history_settings_trends(runs):
+    """history_trends with percentile, min_runs, tolerance and min_seconds of the history option"""
+    settings = history_settings()
+    return history_trends(runs, float(settings.get('percentile', 90)), int(settings.get('min_runs', 5)),
+                          float(settings.get('tolerance', 0.1)), float(settings.get('min_seconds', 1)))
+
+
+def report_history_regressions(run_id):
+    """Warn about stages and artifacts of the run which are past the percentile of recent runs"""
+    if run_id is None:
+        return
+    try:
+        with contextlib.closing(open_history()) as db:
+            runs = load_history(db, server_name, int(history_settings().get('window', 20)) + 1)
+    except sqlite3.Error:
+        return
+    for kind, name, value, median, limit, runs_count, regression in history_settings_trends(runs):
+        if not regression:
+            continue
+        err("Regression: %s %s %s, p%s of last %d runs %s" % (
+            kind, name, format_history_value(kind, value), history_settings().get('percentile', 90), runs_count,
+            format_history_value(kind, limit)))
+
+
+def format_history_value(kind, value):
+    if value is None:
+        return '-'
+    return "%.1fs" % value if kind == 'stage' else format_size(value)
+
+
+def history_report():
+    """Print recent runs of the server and trends of stages and artifacts of the last run"""
+    settings = history_settings()
+    window = int(settings.get('window', 20))
+    p = float(settings.get('percentile', 90))
+    if not os.path.exists(history_file()):
+        mes("History is empty: %s" % history_file())
+        return
+
+    with contextlib.closing(open_history()) as db:
+        runs = load_history(db, server_name, max(window + 1, int(get_flag_value('--last', 10))))
+    if not runs:
+        mes("History of [%s] is empty" % server_name)
+        return
+
+    mes("Runs of [%s]" % server_name)
+    out("%-19s %-12s %-32s %-7s %9s %9s %9s %s" % ('STARTED', 'VERSION', 'COMMANDS', 'STATUS', 'TIME', 'SIZE', 'SENT',
+                                                  'CACHE'))
+    for run in runs[:int(get_flag_value('--last', 10))]:
+        counters = run['counters']
+        out("%-19s %-12s %-32s %-7s %8.1fs %9s %9s %s" % (
+            datetime.fromtimestamp(run['started']).strftime('%Y-%m-%d %H:%M:%S'), run['version'][:12],
+            run['commands'][:32], 'ok' if run['code'] == 0 else 'exit %s' % run['code'], run['duration'],
+            format_size(sum(sizes[0] for sizes in run['artifacts'].values())),
+            format_size(sum(sizes[1] for sizes in run['artifacts'].values())),
+            " ".join("%s=%d" % (name, value) for name, value in sorted(counters.items())) or '-'))
+
+    runs = runs[:window + 1]
+    mes("Trends of the last run against %d previous successful runs, p%g" % (
+        len([run for run in runs[1:] if run['code'] == 0]), p))
+    out("%-10s %-32s %9s %9s %9s %5s %s" % ('KIND', 'NAME', 'LAST', 'MEDIAN', 'P%g' % p, 'RUNS', ''))
+    for kind, name, value, median, limit, runs_count, regression in history_settings_trends(runs):
+        out("%-10s %-32s %9s %9s %9s %5d %s" % (
+            kind, name[:32], format_history_value(kind, value), format_history_value(kind, median),
+            format_history_value(kind, limit), runs_count, 'REGRESSION' if regression else ''))
+
+
+class CommandError(SystemExit):
+    """Failed command, its exit code is the exit code of AirShip if the error is not caught
+
+    result is the dict returned by execute(): command, code, output, time, timed_out.
+    """
+
+    def __init__(self, result):
+        super().__init__(result['code'])
+        self.result = result
+
+    def __str__(self):
+        command = ' '.join(self.result['command'].split())[:200]
+        if self.result['timed_out']:
+            return "Command timed out after %.1fs: %s" % (self.result['time'], command)
+        return "Command failed with code %s: %s" % (self.result['code'], command)
+
+
+def command_timeout(remote=False):
+    """Timeout of commands in seconds, 0 for none: ssh timeout for remote commands and uploads"""
+    timeout = getattr(config, 'command_timeout', 0)
+    if remote:
+        timeout = getattr(config, 'ssh', {}).get('timeout', timeout)
+    return float(timeout or 0)
+
+
+def start_process(command, timeout=0, **kwargs):
+    """Start shell command, return process and its timeout timer
+
+    Commands with timeout run in their own session, so the timer kills the whole process tree. Such
+    commands have no controlling terminal and can not ask for passwords.
+    """
+    process = subprocess.Popen(command, shell=True, start_new_session=timeout > 0, **kwargs)
+    with running_lock:
+        running_processes[process] = False
+
+    timer = None
+    if timeout > 0:
+        timer = threading.Timer(timeout, kill_process, [process, True])
+        timer.daemon = True
+        timer.start()
+    return process, timer
+
+
+def finish_process(process, timer):
+    """Wait for the process started by start_process(), return True if it was killed by timeout"""
+    process.wait()
+    if timer:
+        timer.cancel()
+    with running_lock:
+        return running_processes.pop(process, False)
+
+
+def kill_process(process, timed_out=False):
+    """Terminate process group of the command, kill it if it does not exit in 5 seconds"""
+    with running_lock:
+        if process not in running_processes:
+            return
+        running_processes[process] = running_processes[process] or timed_out
 
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(5)
+    except subprocess.TimeoutExpired:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    except ProcessLookupError:
+        pass
 
-def run(command, input=None):
+
+def kill_running_processes():
+    """Terminate commands which run in their own sessions, others get the signal from the terminal"""
+    with running_lock:
+        processes = list(running_processes)
+    for process in processes:
+        try:
+            if os.getpgid(process.pid) == process.pid:
+                os.killpg(process.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+
+def execute(command, input=None, on_line=None, timeout=0):
+    """Run command, return result: command, code, output (last lines), time, timed_out
+
+    Output of parallel tasks (with prefix) and with on_line is read line by line, on_line(line) returns True if
+    the line should not be printed. Otherwise the command writes to the terminal directly and output is empty.
+    """
+    start = time.time()
+    output = deque(maxlen=output_tail_lines)
+    if prefix() == '' and on_line is None:
+        process, timer = start_process(command, timeout, text=True,
+                                       stdin=subprocess.PIPE if input is not None else None)
+        if input is not None:
+            try:
+                process.stdin.write(input)
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+    else:
+        # Parallel task: stream output line by line with task prefix
+        process, timer = start_process(command, timeout, text=True, errors='replace', stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT,
+                                       stdin=subprocess.PIPE if input is not None else None)
+        reading = True
+        try:
+            if input is not None:
+                try:
+                    process.stdin.write(input)
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
+            for line in process.stdout:
+                line = line.rstrip('\n')
+                output.append(line)
+                if on_line is None or not on_line(line):
+                    out(prefix() + line)
+            reading = False
+        finally:
+            # Don't leave the command running if its output can not be handled
+            if reading:
+                if timer:
+                    kill_process(process)
+                else:
+                    process.kill()
+                finish_process(process, timer)
+            process.stdout.close()
+
+    timed_out = finish_process(process, timer)
+    return {
+        'command': command,
+        'code': timeout_code if timed_out else process.returncode,
+        'output': '\n'.join(output),
+        'time': time.time() - start,
+        'timed_out': timed_out,
+    }
+
+
+def run(command, input=None, on_line=None, check=True, timeout=None):
+    """Run command, on_line(line) receives output lines and returns True if the line should not be printed
+
+    Returns exit code, raises CommandError if check is set and the command fails or times out.
+    """
     if input is not None:
         deb(command + " " + str(input))
     else:
         deb(command)
     if not dry_run_flag:
         try:
-            process = subprocess.run(command, input=input, shell=True, text=True)
-            if process.returncode < 0 or process.returncode > 0:
-                sys.exit(process.returncode)
+            with Span('run', 'command', command=command) as span:
+                result = execute(command, input, on_line, command_timeout() if timeout is None else timeout)
+                span.args['code'] = result['code']
+                if result['timed_out']:
+                    span.args['timed_out'] = True
+                if check and result['code'] != 0:
+                    raise CommandError(result)
+                return result['code']
         except OSError as e:
             print("Execution failed:", e, file=sys.stderr)
+    return 0
+
+
+def run_output(command, check=True, input=None, timeout=None):
+    """Run command and return its output"""
+    deb(command)
+    if dry_run_flag:
+        return ''
+    start = time.time()
+    with Span('run', 'command', command=command) as span:
+        process, timer = start_process(command, command_timeout() if timeout is None else timeout, text=True,
+                                       errors='replace', stdout=subprocess.PIPE,
+                                       stdin=subprocess.PIPE if input is not None else None)
+        stdout, _ = process.communicate(input)
+        timed_out = finish_process(process, timer)
+        span.args['code'] = timeout_code if timed_out else process.returncode
+    if check and span.args['code'] != 0:
+        raise CommandError({'command': command, 'code': span.args['code'], 'output': stdout[-4096:],
+                            'time': time.time() - start, 'timed_out': timed_out})
+    return stdout
+
+
+def run_pipe(command, filter, path):
+    """Run command | filter > path, return number of bytes passed from command to filter"""
+    deb("%s | %s > %s" % (command, filter, path))
+    if dry_run_flag:
+        return 0
+
+    start = time.time()
+    timeout = command_timeout()
+    with Span('run', 'command', command="%s | %s" % (command, filter)) as span, open(path, 'wb') as f:
+        source, source_timer = start_process(command, timeout, stdout=subprocess.PIPE)
+        sink, sink_timer = start_process(filter, timeout, stdin=subprocess.PIPE, stdout=f)
+        size = 0
+        try:
+            for chunk in iter(lambda: source.stdout.read(render_chunk_size), b''):
+                size += len(chunk)
+                sink.stdin.write(chunk)
+            sink.stdin.close()
+        except BrokenPipeError:
+            pass
+        source.stdout.close()
+
+        timed_out = finish_process(source, source_timer) | finish_process(sink, sink_timer)
+        codes = [source.returncode, sink.returncode]
+        span.args['code'] = timeout_code if timed_out else next((code for code in codes if code != 0), 0)
+    if span.args['code'] != 0:
+        raise CommandError({'command': "%s | %s" % (command, filter), 'code': span.args['code'], 'output': '',
+                            'time': time.time() - start, 'timed_out': timed_out})
+    return size
+
+
+def run_task(task):
+    thread_local.prefix = task.get('prefix', '')
+    try:
+        with Span(task['id'], 'task'):
+            task['fn']()
+        return True
+    except CommandError as e:
+        err("Task %s failed: %s" % (task['id'], str(e)))
+    except SystemExit as e:
+        err("Task %s failed with code %s" % (task['id'], e.code))
+    except Exception as e:
+        err("Task %s failed: %s" % (task['id'], str(e)))
+    finally:
+        thread_local.prefix = ''
+    return False
+
+
+def check_task_cycles(tasks):
+    ids = {task['id'] for task in tasks}
+    deps = {task['id']: task['deps'] & ids for task in tasks}
+    while deps:
+        ready = [id for id, task_deps in deps.items() if not task_deps]
+        if not ready:
+            err("Error: dependency cycle between %s" % ", ".join(sorted(deps)))
+            sys.exit(1)
+        for id in ready:
+            del deps[id]
+        for task_deps in deps.values():
+            task_deps.difference_update(ready)
+
+
+def run_tasks(tasks, workers=1, slot_workers=0):
+    """Run tasks in parallel respecting dependencies
+
+    Task is a dict: id, fn, deps (set of task ids), slot (tasks with the same slot are limited
+    by slot_workers), limits (dict: group -> max running tasks of the group), prefix (output prefix).
+    Returns sets of done and failed task ids.
+    """
+    pending = list(tasks)
+    running = {}
+    slots = {}
+    groups = {}
+    done = set()
+    failed = set()
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        while pending or running:
+            skipped = [task for task in pending if task['deps'] & failed]
+            while skipped:
+                for task in skipped:
+                    err("Skip %s: dependency failed" % task['id'])
+                    pending.remove(task)
+                    failed.add(task['id'])
+                skipped = [task for task in pending if task['deps'] & failed]
+
+            for task in list(pending):
+                if not task['deps'] <= done or len(running) >= max(workers, 1):
+                    continue
+                slot = task.get('slot')
+                if slot_workers > 0 and slots.get(slot, 0) >= slot_workers:
+                    continue
+                limits = task.get('limits', {})
+                if any(limit > 0 and groups.get(group, 0) >= limit for group, limit in limits.items()):
+                    continue
+                pending.remove(task)
+                slots[slot] = slots.get(slot, 0) + 1
+                for group in limits:
+                    groups[group] = groups.get(group, 0) + 1
+                running[pool.submit(run_task, task)] = task
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                task = running.pop(future)
+                slots[task.get('slot')] -= 1
+                for group in task.get('limits', {}):
+                    groups[group] -= 1
+                if future.result():
+                    done.add(task['id'])
+                else:
+                    failed.add(task['id'])
+
+    return done, failed
+
+
+def ssh_destination(server):
+    destination = ''
+    if 'user' in server and server['user'] != '':
+        destination += server['user'] + "@"
+    return destination + server['host']
 
 
-def ssh(server, command):
-    cmd = "ssh "
+def ssh_options(server):
+    """Port and connection multiplexing options of ssh"""
+    options = ''
 
     if 'port' in server and server['port'] != '':
-        cmd += " -p " + server['port'] + " "
+        options += " -p " + server['port']
 
-    if 'user' in server and server['user'] != '':
-        cmd += server['user'] + "@"
+    control_path = ssh_connect(server)
+    if control_path:
+        options += " -o ControlMaster=no -o ControlPath=" + control_path
+
+    return options
+
+
+def ssh_connect(server):
+    """Open multiplexed master connection to the server once per run, return its control path"""
+    global ssh_control_dir
 
-    cmd += server['host']
+    if not config.ssh.get('multiplexing', True) or dry_run_flag:
+        return ''
+
+    destination = ssh_destination(server) + ':' + str(server.get('port', ''))
+    with ssh_lock:
+        if ssh_control_dir == '':
+            ssh_control_dir = tempfile.mkdtemp(prefix='airship-ssh-')
+        if destination not in ssh_masters:
+            ssh_masters[destination] = {'lock': threading.Lock(), 'server': server, 'control_path': None,
+                                        'path': os.path.join(ssh_control_dir, str(len(ssh_masters)))}
+        master = ssh_masters[destination]
+
+    # Connect to different servers at the same time
+    with master['lock']:
+        # Master exits after persist seconds without connections and removes its socket, open it again
+        if master['control_path'] and not os.path.exists(master['control_path']):
+            deb("Multiplexed connection to %s has exited" % ssh_destination(server))
+            master['control_path'] = None
+        if master['control_path'] is None:
+            # Master exits by itself if the run is killed and can not close it
+            cmd = "ssh -o ControlMaster=yes -o ControlPersist=%s -o ConnectTimeout=%s -o ControlPath=%s" % (
+                config.ssh.get('persist', 60), config.ssh.get('connect_timeout', 10), master['path'])
+            if 'port' in server and server['port'] != '':
+                cmd += " -p " + server['port']
+            cmd += " -N -f " + ssh_destination(server)
+
+            deb(cmd)
+            process = subprocess.run(cmd, shell=True, text=True)
+            if process.returncode == 0:
+                master['control_path'] = master['path']
+            else:
+                err("Failed to open multiplexed connection to %s, use separate connections" % ssh_destination(server))
+                master['control_path'] = ''
+
+    return master['control_path']
+
+
+def ssh_disconnect():
+    """Close all multiplexed master connections"""
+    global ssh_control_dir
+
+    with ssh_lock:
+        for master in ssh_masters.values():
+            if master['control_path']:
+                cmd = "ssh -o ControlPath=%s -O exit %s" % (master['control_path'], ssh_destination(master['server']))
+                deb(cmd)
+                subprocess.run(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        ssh_masters.clear()
+
+        if ssh_control_dir != '':
+            shutil.rmtree(ssh_control_dir, ignore_errors=True)
+            ssh_control_dir = ''
+
+
+def ssh(server, command, on_line=None, check=True):
+    cmd = "ssh" + ssh_options(server) + " " + ssh_destination(server)
     cmd += " bash -s"
-    run(cmd, command)
+    with Span('ssh', 'ssh', host=ssh_destination(server), command=command) as span:
+        span.args['code'] = run(cmd, command, on_line, check, command_timeout(remote=True))
+        return span.args['code']
 
 
-def upload(server, frm, to, ignore_existing=False):
-    cmd = "rsync -chavzP --info=progress2"
+def ssh_output(server, command):
+    """Run command on the server and return its output"""
+    cmd = "ssh" + ssh_options(server) + " " + ssh_destination(server)
+    cmd += " bash -s"
+    with Span('ssh', 'ssh', host=ssh_destination(server), command=command):
+        return run_output(cmd, input=command, timeout=command_timeout(remote=True))
+
+
+def upload(server, frm, to, ignore_existing=False, create_dir=False, compress=True):
+    cmd = "rsync -chav%sP --info=progress2" % ('z' if compress else '')
 
     if ignore_existing:
         cmd += " --ignore-existing"
 
-    cmd += " -e 'ssh"
+    if create_dir:
+        cmd += " --rsync-path=\"mkdir -p %s && rsync\"" % to
 
-    if 'port' in server and server['port'] != '':
-        cmd += " -p " + server['port']
+    cmd += " -e 'ssh" + ssh_options(server) + "' " + frm + " "
+    cmd += ssh_destination(server) + ":" + to
+    with Span('upload', 'upload', host=ssh_destination(server), file=frm, destination=to,
+              bytes=os.path.getsize(frm) if os.path.isfile(frm) else None):
+        run(cmd, timeout=command_timeout(remote=True))
 
-    cmd += "' " + frm + " "
 
-    if 'user' in server and server['user'] != '':
-        cmd += server['user'] + "@"
+def upload_artifact(server, variables, name, frm, to, ignore_existing=False, create_dir=False, codec=None):
+    """Upload the artifact and account its size and time, rsync compresses only artifacts of none codec"""
+    start = time.time()
+    upload(server, frm, to, ignore_existing, create_dir, not compressed_codec(codec))
+    account_transfer(name, variables, 'rsync', os.path.getsize(frm) if os.path.isfile(frm) else 0, time.time() - start)
+
+
+class HashWriter:
+    """File object wrapper which hashes written data"""
 
-    cmd += server['host'] + ":" + to
-    run(cmd)
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        return self.fileobj.write(data)
+
+
+class SizeWriter:
+    """File object wrapper which counts written bytes"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        return self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+def archive_entries(path):
+    """Archive names and paths in stable order: ./ and sorted tree for directory, file name for file"""
+    if not os.path.isdir(path):
+        yield os.path.basename(path), path
+        return
+
+    yield '.', path
+    yield from archive_tree(path, '.')
+
+
+def archive_tree(path, arcname):
+    for name in sorted(os.listdir(path)):
+        full_path = os.path.join(path, name)
+        yield arcname + '/' + name, full_path
+        if os.path.isdir(full_path) and not os.path.islink(full_path):
+            yield from archive_tree(full_path, arcname + '/' + name)
+
+
+def archive_normalize(tarinfo):
+    tarinfo.mtime = 0
+    tarinfo.uid = tarinfo.gid = 0
+    tarinfo.uname = tarinfo.gname = ''
+    return tarinfo
+
+
+def write_archive(fileobj, path):
+    """Write reproducible tar stream of the path, return content hash and size"""
+    writer = HashWriter(fileobj)
+    with tarfile.open(fileobj=writer, mode='w|', format=tarfile.GNU_FORMAT) as tar:
+        for name, full_path in archive_entries(path):
+            tar.add(full_path, arcname=name, recursive=False, filter=archive_normalize)
+    return writer.hash.hexdigest(), writer.size
 
 
 def archive(destination_dir, path):
-    if os.path.isdir(path):
-        run("cd %s && tar -zcf %s --totals -C %s ." % (path, destination_dir, path))
-    else:
-        file = os.path.basename(path)
-        path = os.path.dirname(path)
-        run("cd %s && tar -zcf %s --totals -C %s %s" % (path, destination_dir, path, file))
+    """Build reproducible tar archive of the path compressed by environment_codec, content hash is written to
+    <archive>.sha256"""
+    deb("Archive %s to %s" % (path, destination_dir))
+    if dry_run_flag:
+        return ''
 
+    codec = environment_codec()
+    with open(destination_dir, 'wb') as f:
+        result = compress_stream(f, lambda stream: write_archive(stream, path), codec)
+    if result is None:
+        err("Failed to build archive %s" % destination_dir)
+        sys.exit(1)
+    content_hash, size = result
 
-def copy_dir(file):
-    run("cp -R %s %s" % (file['path'], file['env_path']))
+    with open(destination_dir + '.sha256', 'w') as f:
+        f.write(content_hash + '\n')
 
+    compressed = os.path.getsize(destination_dir)
+    out("Total bytes written: %d, compressed: %d" % (size, compressed))
+    account_artifact(os.path.basename(destination_dir), 'environment', size, compressed, codec=codec['codec'])
+    return content_hash
 
-def copy_and_replace(variables, file):
-    cmdVars = ""
 
-    if not os.path.exists(os.path.dirname(file['env_path'])):
-        run("mkdir -p %s" % os.path.dirname(file['env_path']))
+# Codecs of archives, image dumps and layer streams: range of compression levels
+codec_levels = {'none': None, 'gzip': (1, 9), 'zstd': (1, 22)}
 
-    if 'replace_vars' in file and file['replace_vars'] and len(variables) > 0:
-        for var, val in variables.items():
-            cmdVars += " -e 's/${%s}/%s/g'" % (var, val.replace('/', r'\/'))
-        cmd = "cat %s | sed %s > %s" % (file['path'], cmdVars, file['env_path'])
-    else:
-        cmd = "cp %s %s" % (file['path'], file['env_path'])
-    run(cmd)
 
+def compress_threads():
+    return int(config.docker.get('compress_threads', 0)) or os.cpu_count() or 1
 
-def replace_variables(variables, str):
-    for var, val in variables.items():
-        str = str.replace("$" + var, val)
-    return str
 
+def compression_codec(spec, name=''):
+    """Codec settings {codec, level, threads} of 'none', 'gzip', 'zstd', 'zstd:19' or dict with these keys
+
+    Empty spec is 'none', level None is the default level of the compressor, threads 0 is compress_threads.
+    """
+    if not isinstance(spec, dict):
+        codec, _, level = (spec or 'none').partition(':')
+        spec = {'codec': codec, 'level': level}
+
+    codec = spec.get('codec') or 'none'
+    if codec not in codec_levels:
+        err("Unknown compression of %s: %s" % (name, codec))
+        sys.exit(1)
+
+    level = spec.get('level')
+    try:
+        level = None if level in [None, ''] or codec == 'none' else int(level)
+    except ValueError:
+        level = 0
+    if level is not None and not codec_levels[codec][0] <= level <= codec_levels[codec][1]:
+        err("Compression level of %s must be %d-%d for %s: %s" % (name, codec_levels[codec][0],
+                                                                   codec_levels[codec][1], codec, spec['level']))
+        sys.exit(1)
+
+    return {'codec': codec, 'level': level, 'threads': int(spec.get('threads', 0)) or compress_threads()}
+
+
+def environment_codec():
+    """Codec of the environment archive and stream: compression option, gzip with level 9 by default"""
+    return compression_codec(getattr(config, 'compression', '') or 'gzip:9', config.arch_name)
 
-def find_files_for_replace(path, patterns):
-    fileCandidates = []
-    for root, subdirs, files in os.walk(path):
-        for file in files:
-            if not re.findall("(%s)" % "|".join(patterns), file):
-                continue
-            fileCandidates.append(os.path.join(root, file))
 
-    return fileCandidates
+def compress_command(codec):
+    """Multi-threaded compressor of the codec: zstd or pigz, gzip if pigz is not installed; empty for none"""
+    level = '' if codec['level'] is None else ' -%d' % codec['level']
+    if codec['codec'] == 'zstd':
+        return "zstd -q -T%d%s%s" % (codec['threads'], ' --ultra' if codec['level'] and codec['level'] > 19 else '',
+                                     level)
+    if codec['codec'] == 'gzip':
+        if shutil.which('pigz'):
+            return "pigz -n -p %d%s" % (codec['threads'], level)
+        return "gzip -n" + level
+    return ''
 
 
-def docker_build(variables, container):
-    build_variables = variables
+def untar_command(codec, path, options=''):
+    """Remote command extracting tar compressed by the codec from the path, '-' for stdin"""
+    if codec['codec'] == 'zstd':
+        return "zstd -dc %s| tar -x%sf -" % ('' if path == '-' else path + ' ', options)
+    return "tar -x%s%sf %s" % ('z' if codec['codec'] == 'gzip' else '', options, path)
+
+
+def compressed_codec(codec):
+    """Payloads of the codec are compressed already and are sent without transport compression"""
+    return codec is not None and codec['codec'] != 'none'
+
+
+def compress_stream(fileobj, write, codec):
+    """Compress data written by write(stream) into fileobj with the codec, return the result of write or None on failure
+
+    Multi-threaded zstd or pigz is used, gzip module if pigz is not installed. Compressor writes into the file
+    descriptor of fileobj, output is copied for file objects without it (SizeWriter). With none write gets fileobj.
+    """
+    if codec['codec'] == 'none':
+        return write(fileobj)
+
+    if codec['codec'] == 'gzip' and not shutil.which('pigz'):
+        level = 9 if codec['level'] is None else codec['level']
+        with gzip.GzipFile(filename='', mode='wb', fileobj=fileobj, mtime=0, compresslevel=level) as gz:
+            return write(gz)
+
+    if not shutil.which(codec['codec']):
+        err("%s is not installed" % codec['codec'])
+        return None
+
+    try:
+        stdout = fileobj.fileno()
+        fileobj.flush()
+    except (AttributeError, io.UnsupportedOperation):
+        stdout = subprocess.PIPE
+    process = subprocess.Popen(shlex.split(compress_command(codec)), stdin=subprocess.PIPE, stdout=stdout)
+
+    copier = None
+    if stdout == subprocess.PIPE:
+        def copy():
+            try:
+                shutil.copyfileobj(process.stdout, fileobj, render_chunk_size)
+            except OSError:
+                pass
+            finally:
+                # Compressor gets broken pipe instead of blocking if fileobj fails
+                process.stdout.close()
+
+        copier = threading.Thread(target=copy)
+        copier.start()
+
+    result = None
+    try:
+        result = write(process.stdin)
+        process.stdin.close()
+    except BrokenPipeError:
+        result = None
+
+    code = process.wait()
+    if copier:
+        copier.join()
+    if code != 0:
+        return None
+    return result
+
+
+def archive_hash(destination_dir):
+    """Content hash of the archive built by archive()"""
+    if not os.path.exists(destination_dir + '.sha256'):
+        return ''
+    with open(destination_dir + '.sha256') as f:
+        return f.read().strip()
+
+
+def remote_archive_hash(server, variables):
+    """Content hash of the archive last extracted on the server"""
+    if '--force-upload' in flags:
+        return ''
+    return ssh_output(server, "cat %s 2>/dev/null || true" % os.path.join(
+        variables['DESTINATION_DIR'], config.arch_name + '.sha256')).strip()
+
+
+def compile_variables(variables):
+    """Compile variables for replacing ${VARNAME} in file contents, every name is looked up once"""
+    values = {}
+
+    def value(match):
+        name = match.group(1)
+        if name not in values:
+            val = variables.get(name.decode('utf-8', 'surrogateescape'))
+            values[name] = None if val is None else str(val).encode('utf-8', 'surrogateescape')
+        return match.group(0) if values[name] is None else values[name]
+
+    return lambda data: content_variable_pattern.sub(value, data)
+
+
+def render_file(replacer, frm, to):
+    """Stream file through the compiled variables replacer"""
+    with open(frm, 'rb') as src, open(to, 'wb') as dst:
+        tail = b''
+        while True:
+            chunk = src.read(render_chunk_size)
+            data = tail + chunk
+            tail = b''
+            if chunk:
+                # Keep unfinished ${VARNAME} for the next chunk
+                start = data.rfind(b'$')
+                if start != -1 and data.find(b'}', start) == -1 and len(data) - start <= render_max_name_length:
+                    tail = data[start:]
+                    data = data[:start]
+            dst.write(replacer(data))
+            if not chunk:
+                break
+    shutil.copymode(frm, to)
+
+
+def copy_and_replace(replacer, file):
+    deb("Render %s to %s" % (file['path'], file['env_path']) if file.get('replace_vars') and replacer else
+        "Copy %s to %s" % (file['path'], file['env_path']))
+    if dry_run_flag:
+        return
+
+    os.makedirs(os.path.dirname(file['env_path']), exist_ok=True)
+
+    # Never write into existing file, it can be a hard link to the source
+    temp_path = file['env_path'] + '.airship-tmp'
+    try:
+        if 'replace_vars' in file and file['replace_vars'] and replacer is not None:
+            render_file(replacer, file['path'], temp_path)
+        else:
+            link_or_copy(file['path'], temp_path)
+        os.replace(temp_path, file['env_path'])
+    finally:
+        if os.path.lexists(temp_path):
+            os.unlink(temp_path)
+
+
+def link_or_copy(frm, to):
+    """Place file without copying its data if possible: hard link, reflink, copy
+
+    Mode is set by config.env_link: reflink (default), hardlink or copy. Hard link shares the data with the source,
+    changes of the environment file in place change the source too.
+    """
+    mode = getattr(config, 'env_link', 'reflink')
+    if mode == 'hardlink':
+        try:
+            os.link(frm, to)
+            return
+        except OSError:
+            pass
+
+    if mode in ['hardlink', 'reflink']:
+        try:
+            with open(frm, 'rb') as src, open(to, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            shutil.copymode(frm, to)
+            return
+        except OSError:
+            if os.path.lexists(to):
+                os.unlink(to)
+
+    shutil.copy(frm, to)
+
+
+def replace_variables(variables, str, resolving=()):
+    """Replace $VARNAME and ${VARNAME} in one pass, values may refer to other variables
+
+    $VARNAME takes the longest defined name ($VERSION_SUFFIX before $VERSION), unknown names are kept.
+    """
+    parts = compile_template(str)
+    if len(parts) == 1:
+        return str
+
+    result = []
+    for i, part in enumerate(parts):
+        if i % 2 == 0:
+            result.append(part)
+            continue
+
+        name, braced = part
+        if not braced:
+            name = next((name[:end] for end in range(len(name), 0, -1) if name[:end] in variables), name)
+        if name not in variables or name in resolving:
+            result.append('${%s}' % name if braced else '$' + part[0])
+            continue
+
+        val = variables[name]
+        result.append(replace_variables(variables, val, resolving + (name,)) if '$' in val else val)
+        if not braced:
+            result.append(part[0][len(name):])
+    return ''.join(result)
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_template(str):
+    """Split the string into literal parts and (name, braced) variable tokens, tokens are at odd positions"""
+    parts = []
+    start = 0
+    for match in template_variable_pattern.finditer(str):
+        parts.append(str[start:match.start()])
+        parts.append((match.group(1), True) if match.group(1) is not None else (match.group(2), False))
+        start = match.end()
+    parts.append(str[start:])
+    return tuple(parts)
+
+
+def docker_build(variables, container, base_fingerprints=()):
+    """Build the container, skip the build if its fingerprint is the same as of the last build
+
+    Returns the fingerprint of the build inputs, base_fingerprints are fingerprints of base images built in the same run.
+    """
+    build_variables = dict(variables)
     build_variables['DOCKERFILE_DIR'] = os.path.dirname(container['dockerfile'])
 
     container['name'] = replace_variables(variables, container['name'])
@@ -169,8 +1328,7 @@ def docker_build(variables, container):
     build_contexts = []
     if 'build_contexts' in container:
         for arg in container['build_contexts']:
-            arg = replace_variables(build_variables, arg)
-            build_args.append('--build-context ' + arg)
+            build_contexts.append(build_context_path(replace_variables(build_variables, arg)))
 
     if container['build_path'] == "./":
         container['build_path'] = os.path.dirname(container['dockerfile'])
@@ -187,17 +1345,381 @@ def docker_build(variables, container):
     if 'platform' in container:
         platform = '--platform ' + container['platform']
 
-    run("%sdocker %s build %s %s %s -t %s/%s -f %s %s" % (
-        get_docker_host(variables, container['docker_host'] if 'docker_host' in container else ''),
-        buildx,
-        platform,
-        " ".join(build_args),
-        " ".join(build_contexts),
-        container['registry'],
-        container['name'],
-        container['dockerfile'],
-        container['build_path'],
-    ))
+    docker_host = get_docker_host(variables, container['docker_host'] if 'docker_host' in container else '')
+    ref = "%s/%s" % (container['registry'], container['name'])
+
+    # Fingerprint is still recorded with --force-build, so the next run can skip the build
+    fingerprint = ''
+    if config.docker.get('build_cache', True) and not dry_run_flag:
+        fingerprint = docker_build_fingerprint(container, [docker_host, buildx, platform] + build_args,
+                                               base_fingerprints, build_contexts)
+        if '--force-build' not in flags and docker_build_cached(docker_host, ref, fingerprint):
+            mes("Skip build %s: inputs are not changed" % ref)
+            count('build_cache_hits')
+            return fingerprint
+
+    # BuildKit cache import and export, plain progress to count cached steps
+    cache = buildx_cache_settings(container) if buildx else None
+    cache_options = ''
+    steps = {}
+    with buildx_cache_user(cache, ref):
+        if cache:
+            cache_options = '--load --progress=plain ' + buildx_cache_options(build_variables, cache, ref)
+
+        run("%sdocker %s build %s %s %s %s -t %s/%s -f %s %s" % (
+            docker_host,
+            buildx,
+            platform,
+            cache_options,
+            " ".join(build_args),
+            " ".join('--build-context ' + context for context in build_contexts),
+            container['registry'],
+            container['name'],
+            container['dockerfile'],
+            container['build_path'],
+        ), on_line=buildx_step_counter(steps) if cache else None)
+
+        if cache:
+            buildx_cache_report(ref, steps)
+            if cache['type'] == 'local':
+                finish_buildx_cache(cache, ref)
+
+    image_id = docker_image_id(docker_host, ref) if fingerprint else ''
+    if image_id:
+        update_docker_build_cache(ref, {'fingerprint': fingerprint, 'image_id': image_id})
+    return fingerprint
+
+
+def build_context_path(context):
+    """Build context name=path with the local path relative to work_dir, images, URLs and targets are kept"""
+    name, _, source = context.partition('=')
+    if re.match(r'^[a-z][a-z0-9+.-]*://', source) or source.startswith(('git@', 'target:')):
+        return context
+    return name + '=' + os.path.join(config.work_dir, source)
+
+
+def docker_build_fingerprint(container, args, base_fingerprints=(), contexts=()):
+    """Hash of build inputs: Dockerfile, build context contents, resolved build options and base images
+
+    contexts are build contexts name=source resolved by build_context_path, contents of local directories are hashed.
+    """
+    fingerprint = hashlib.sha256()
+    for arg in list(args) + ['--build-context ' + context for context in contexts] + list(base_fingerprints):
+        fingerprint.update(arg.encode() + b'\0')
+
+    with open(container['dockerfile'], 'rb') as f:
+        for chunk in iter(lambda: f.read(render_chunk_size), b''):
+            fingerprint.update(chunk)
+
+    paths = [container['build_path']]
+    for context in contexts:
+        path = context.split('=', 1)[-1]
+        if os.path.isdir(path):
+            paths.append(path)
+
+    for path in paths:
+        fingerprint.update(b'context\0')
+        build_context_hash(path, fingerprint)
+
+    return fingerprint.hexdigest()
+
+
+def dockerignore_patterns(path):
+    """Patterns of .dockerignore in the build context: list of (exclude, pattern)"""
+    patterns = []
+    file = os.path.join(path, '.dockerignore')
+    if not os.path.isfile(file):
+        return patterns
+
+    with open(file) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            exclude = not line.startswith('!')
+            pattern = os.path.normpath(line.lstrip('!').strip().lstrip('/'))
+            patterns.append((exclude, pattern))
+    return patterns
+
+
+def dockerignore_match(patterns, name):
+    """Check if the context path is excluded, the last matching pattern wins"""
+    parts = name.split('/')
+    excluded = False
+    for exclude, pattern in patterns:
+        for i in range(1, len(parts) + 1):
+            if fnmatch.fnmatchcase('/'.join(parts[:i]), pattern):
+                excluded = exclude
+                break
+    return excluded
+
+
+def build_context_hash(path, fingerprint):
+    """Add names, modes and contents of the build context files to the hash, .dockerignore is respected"""
+    patterns = dockerignore_patterns(path)
+    prune = not any(not exclude for exclude, pattern in patterns)
+
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        rel_root = root[len(path):].strip(os.sep)
+        if prune:
+            dirs[:] = [d for d in dirs if not dockerignore_match(patterns, os.path.join(rel_root, d))]
+
+        for name in sorted(files):
+            file = os.path.join(root, name)
+            rel = os.path.join(rel_root, name)
+            if dockerignore_match(patterns, rel):
+                continue
+
+            st = os.lstat(file)
+            fingerprint.update(("%s\0%o\0" % (rel, st.st_mode)).encode())
+            if os.path.islink(file):
+                fingerprint.update(os.readlink(file).encode() + b'\0')
+            elif S_ISREG(st.st_mode):
+                with open(file, 'rb') as f:
+                    for chunk in iter(lambda: f.read(render_chunk_size), b''):
+                        fingerprint.update(chunk)
+
+
+def docker_image_id(docker_host, ref):
+    """ID of the local image, '' if there is no such image"""
+    return run_output("%sdocker image inspect --format '{{.Id}}' %s 2>/dev/null" % (docker_host, ref), check=False).strip()
+
+
+def docker_build_cache_file():
+    cache_dir = config.docker.get('build_cache_dir', '') or cache_home()
+    return os.path.join(cache_dir, 'build-fingerprints.json')
+
+
+def load_docker_build_cache():
+    try:
+        with open(docker_build_cache_file()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def update_docker_build_cache(ref, entry):
+    """Update cache entry of the image: fingerprint, image_id, pushed (image ID which was pushed)"""
+    if dry_run_flag:
+        return
+
+    with docker_build_cache_lock:
+        cache = load_docker_build_cache()
+        cache[ref] = dict(cache.get(ref, {}), **entry)
+        file = docker_build_cache_file()
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        with open(file + '.tmp', 'w') as f:
+            f.write(json.dumps(cache, indent=1, sort_keys=True))
+        os.replace(file + '.tmp', file)
+
+
+def docker_build_cached(docker_host, ref, fingerprint):
+    """Check if the image was built from the same inputs and is still present"""
+    entry = load_docker_build_cache().get(ref)
+    if not entry or entry.get('fingerprint') != fingerprint:
+        return False
+    return entry.get('image_id') == docker_image_id(docker_host, ref)
+
+
+def buildx_cache_settings(container):
+    """BuildKit cache of the buildx build: global docker.buildx_cache updated by buildx_cache of the container
+
+    Returns None if cache is not configured or disabled for the container (buildx_cache: False).
+    """
+    settings = config.docker.get('buildx_cache') or {}
+    if 'buildx_cache' in container:
+        if not container['buildx_cache']:
+            return None
+        settings = dict(settings, **container['buildx_cache'])
+    if not settings:
+        return None
+
+    if settings.get('type', 'local') not in ['local', 'registry']:
+        err("Unknown buildx cache type of %s: %s" % (container['name'], settings['type']))
+        sys.exit(1)
+    return dict({'type': 'local', 'mode': 'max'}, **settings)
+
+
+def buildx_cache_dir(settings):
+    return settings.get('dir', '') or os.path.join(os.path.dirname(docker_build_cache_file()), 'buildx')
+
+
+def buildx_cache_path(settings, ref):
+    """Local cache directory of the image repository, all tags share it"""
+    return os.path.join(buildx_cache_dir(settings), re.sub(r'[^\w.-]', '_', image_repository(ref)))
+
+
+def buildx_cache_user(settings, ref):
+    """Lock of the local cache of the image repository: builds of its tags import, export and replace it one at a
+    time"""
+    if not settings or settings['type'] != 'local':
+        return contextlib.nullcontext()
+    with buildx_cache_lock:
+        return buildx_cache_users.setdefault(buildx_cache_path(settings, ref), threading.Lock())
+
+
+def buildx_cache_options(variables, settings, ref):
+    """--cache-from and --cache-to options
+
+    Registry cache is <image repository>:buildcache by default. Local cache is exported next to the current one
+    and replaces it after the build, so old layers do not pile up.
+    """
+    if settings['type'] == 'registry':
+        cache_ref = replace_variables(ChainMap({'IMAGE_REPOSITORY': image_repository(ref)}, variables),
+                                      settings.get('ref', '$IMAGE_REPOSITORY:buildcache'))
+        return "--cache-from type=registry,ref=%s --cache-to type=registry,ref=%s,mode=%s" % (
+            cache_ref, cache_ref, settings['mode'])
+
+    path = buildx_cache_path(settings, ref)
+    options = "--cache-to type=local,dest=%s.new,mode=%s" % (shlex.quote(path), settings['mode'])
+    if os.path.isdir(path):
+        options = "--cache-from type=local,src=%s %s" % (shlex.quote(path), options)
+    return options
+
+
+def buildx_step_counter(steps):
+    """on_line for plain progress output of buildx: fills steps (step number -> True if cached)"""
+    def on_line(line):
+        match = buildx_step_pattern.match(line)
+        if match:
+            steps[match.group(1)] = steps.get(match.group(1), False) or match.group(2) is not None
+        return False
+    return on_line
+
+
+def buildx_cache_report(ref, steps):
+    if dry_run_flag or not steps:
+        return
+    cached = sum(1 for hit in steps.values() if hit)
+    mes("Build cache of %s: %d of %d steps cached (%d%%)" % (ref, cached, len(steps), cached * 100 // len(steps)))
+    count('buildx_steps', len(steps))
+    count('buildx_steps_cached', cached)
+
+
+def finish_buildx_cache(settings, ref):
+    """Replace local cache by the exported one and prune cache directory to max_size"""
+    if dry_run_flag:
+        return
+
+    path = buildx_cache_path(settings, ref)
+    with buildx_cache_lock:
+        if os.path.isdir(path + '.new'):
+            shutil.rmtree(path, ignore_errors=True)
+            os.replace(path + '.new', path)
+
+        if settings.get('max_size'):
+            removed = prune_buildx_cache(buildx_cache_dir(settings), parse_size(settings['max_size']), path)
+            if removed:
+                mes("Build cache is pruned to %s: %s" % (settings['max_size'], ", ".join(removed)))
+
+
+def prune_buildx_cache(root, max_size, keep):
+    """Remove caches of repositories built least recently until the directory fits max_size, return removed names"""
+    caches = []
+    for entry in os.scandir(root):
+        if entry.is_dir(follow_symlinks=False) and not entry.name.endswith('.new'):
+            size = 0
+            for path, dirs, files in os.walk(entry.path):
+                size += sum(os.lstat(os.path.join(path, name)).st_size for name in files)
+            caches.append((entry.stat().st_mtime, entry.path, size))
+
+    total = sum(size for mtime, path, size in caches)
+    removed = []
+    for mtime, path, size in sorted(caches):
+        if total <= max_size:
+            break
+        if path == keep:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        removed.append(os.path.basename(path))
+    return removed
+
+
+def parse_size(size):
+    """Bytes of size with optional K, M, G, T suffix: 10G"""
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*$', str(size), re.IGNORECASE)
+    if not match:
+        err("Invalid size: %s" % size)
+        sys.exit(1)
+    return int(float(match.group(1)) * 1024 ** ' KMGT'.index(match.group(2).upper() or ' '))
+
+
+def image_repository(ref):
+    """Image reference without tag: registry:5000/name:tag -> registry:5000/name"""
+    if ':' in ref.rsplit('/', 1)[-1]:
+        return ref.rsplit(':', 1)[0]
+    return ref
+
+
+def docker_image_ref(variables, container):
+    return "%s/%s" % (replace_variables(variables, container['registry']), replace_variables(variables, container['name']))
+
+
+def docker_build_deps(variables, container, containers):
+    """Find containers which must be built before the container: depends_on and base images built in the same run"""
+    refs = {}
+    for other in containers:
+        if other is container:
+            continue
+        ref = docker_image_ref(variables, other)
+        name = replace_variables(variables, other['name'])
+        for key in [ref, image_repository(ref), name, image_repository(name)]:
+            refs[key] = ref
+
+    deps = set()
+    for name in container.get('depends_on', []):
+        name = replace_variables(variables, name)
+        if name not in refs:
+            err("Error: container %s depends on unknown container %s" % (container['name'], name))
+            sys.exit(1)
+        deps.add(refs[name])
+
+    dockerfile = os.path.join(config.work_dir, replace_variables(variables, container['dockerfile']))
+    if os.path.isfile(dockerfile):
+        with open(dockerfile) as f:
+            for base in re.findall(r"^\s*FROM\s+(?:--\S+\s+)*(\S+)", f.read(), re.MULTILINE | re.IGNORECASE):
+                base = replace_variables(variables, base)
+                if base in refs:
+                    deps.add(refs[base])
+
+    return deps
+
+
+def build_containers(variables, containers):
+    """Build containers in parallel, dependencies are built first"""
+    workers = int(config.docker.get('build_workers', 4))
+    host_workers = int(config.docker.get('host_build_workers', 0))
+
+    tasks = build_tasks(variables, containers, workers > 1 and len(containers) > 1)
+    check_task_cycles(tasks)
+
+    done, failed = run_tasks(tasks, workers, host_workers)
+    if failed:
+        err("Failed to build: %s" % ", ".join(sorted(failed)))
+        sys.exit(1)
+
+
+def build_tasks(variables, containers, prefixed):
+    """Build tasks of containers, task id is the image reference"""
+    fingerprints = {}
+
+    def build(ref, container, deps):
+        fingerprints[ref] = docker_build(variables, container, [fingerprints[dep] for dep in sorted(deps)])
+
+    tasks = []
+    for container in containers:
+        ref = docker_image_ref(variables, container)
+        deps = docker_build_deps(variables, container, containers)
+        tasks.append({
+            'id': ref,
+            'fn': (lambda r, c, d: lambda: build(r, c, d))(ref, container, deps),
+            'deps': deps,
+            'slot': get_docker_host(variables, container.get('docker_host', '')),
+            'prefix': '[%s] ' % replace_variables(variables, container['name']) if prefixed else '',
+        })
+    return tasks
 
 
 def docker_push(variables, container):
@@ -210,102 +1732,574 @@ def docker_push(variables, container):
     ))
 
 
+def registry_manifest_digest(registry, name):
+    """Get digest of the image manifest from the registry, None if it is unknown"""
+    repository, tag = name.rsplit(':', 1) if ':' in name else (name, 'latest')
+    host = registry.split('/')[0]
+    path = registry[len(host):]
+
+    if host.split(':')[0] in ['localhost', '127.0.0.1'] or host in config.docker.get('insecure_registries', []):
+        conn = http.client.HTTPConnection(host, timeout=10)
+    else:
+        conn = http.client.HTTPSConnection(host, timeout=10)
+
+    try:
+        conn.request('HEAD', '/v2%s/%s/manifests/%s' % (path, repository, tag), None, {
+            'User-agent': 'AirShip',
+            'Accept': ', '.join([
+                'application/vnd.oci.image.index.v1+json',
+                'application/vnd.oci.image.manifest.v1+json',
+                'application/vnd.docker.distribution.manifest.list.v2+json',
+                'application/vnd.docker.distribution.manifest.v2+json',
+            ])
+        })
+        response = conn.getresponse()
+        if response.status != 200:
+            deb("Registry %s responded %s for %s" % (registry, response.status, name))
+            return None
+        return response.getheader('Docker-Content-Digest')
+    except (OSError, http.client.HTTPException) as e:
+        deb("Registry %s is not available: %s" % (registry, str(e)))
+        return None
+    finally:
+        conn.close()
+
+
+def docker_pushed(variables, container):
+    """Check if the registry already has the same image"""
+    ref = docker_image_ref(variables, container)
+    output = run_output("%sdocker image inspect --format '{{json .RepoDigests}}' %s" % (
+        get_docker_host(variables, container['docker_host'] if 'docker_host' in container else ''),
+        ref
+    ), check=False)
+    try:
+        local_digests = json.loads(output) or []
+    except ValueError:
+        return False
+    if not local_digests:
+        return False
+
+    digest = registry_manifest_digest(
+        replace_variables(variables, container['registry']),
+        replace_variables(variables, container['name'])
+    )
+    return digest is not None and "%s@%s" % (image_repository(ref), digest) in local_digests
+
+
+def push_containers(variables, containers):
+    """Push containers in parallel, skip images which registry already has"""
+    workers = int(config.docker.get('push_workers', 4))
+    skipped = []
+    tasks = push_tasks(variables, containers, workers > 1 and len(containers) > 1, skipped)
+
+    done, failed = run_tasks(tasks, workers)
+
+    push_report(done, failed, skipped)
+    if failed:
+        sys.exit(1)
+
+
+def push_tasks(variables, containers, prefixed, skipped):
+    """Push tasks of containers, task id is the image reference, skipped images are added to skipped"""
+    check = config.docker.get('push_check', True)
+    push_cache = config.docker.get('push_cache', False) and '--force-build' not in flags
+
+    def push(container):
+        ref = docker_image_ref(variables, container)
+        if push_cache:
+            image_id = docker_image_id(get_docker_host(variables, container.get('docker_host', '')), ref)
+            if image_id and load_docker_build_cache().get(ref, {}).get('pushed') == image_id:
+                mes("Skip push %s: the same image was pushed before" % ref)
+                count('push_skipped')
+                skipped.append(ref)
+                return
+
+        if check and docker_pushed(variables, container):
+            mes("Skip push %s: registry has the same image" % ref)
+            count('push_skipped')
+            skipped.append(ref)
+            return
+        docker_push(variables, container)
+
+        if push_cache and image_id:
+            update_docker_build_cache(ref, {'pushed': image_id})
+
+    tasks = []
+    for container in containers:
+        tasks.append({
+            'id': docker_image_ref(variables, container),
+            'fn': (lambda c: lambda: push(c))(container),
+            'deps': set(),
+            'prefix': '[%s] ' % replace_variables(variables, container['name']) if prefixed else '',
+        })
+    return tasks
+
+
+def push_report(done, failed, skipped):
+    pushed = sorted(done - set(skipped))
+    mes("Pushed: %s" % (", ".join(pushed) if pushed else '-'))
+    mes("Skipped: %s" % (", ".join(sorted(skipped)) if skipped else '-'))
+    if failed:
+        err("Failed: %s" % ", ".join(sorted(failed)))
+
+
 def docker_dump(variables, container):
     container['registry'] = replace_variables(variables, container['registry'])
     container['name'] = replace_variables(variables, container['name'])
 
-    temp_path = config.temp_dir_environment
-    if 'deploy_separately' in container and container['deploy_separately']:
-        temp_path = config.temp_dir_containers
+    docker_host = get_docker_host(variables, container['docker_host'] if 'docker_host' in container else '')
+    image = "%s/%s" % (container['registry'], container['name'])
+    path = docker_dump_path(variables, container)
+
+    # Images without deploy_separately are sent inside the environment archive
+    fields = {'archive': config.arch_name} if os.path.dirname(path) == config.temp_dir_environment else {}
+
+    codec = dump_compression(container)
+    if not compressed_codec(codec):
+        run("%sdocker save %s -o %s" % (docker_host, image, path))
+        size = os.path.getsize(path) if not dry_run_flag else 0
+    else:
+        # Compress on the fly with all cores, docker save itself writes only plain tar
+        size = run_pipe("%sdocker save %s" % (docker_host, image), compress_command(codec), path)
+
+    if not dry_run_flag:
+        account_artifact(os.path.basename(path), 'image', size, os.path.getsize(path), codec=codec['codec'], **fields)
+        dumped_image_ids[path] = docker_dump_image_id(docker_host, image, path, codec)
+
+
+def docker_dump_path(variables, container):
+    """Local path of the dumped image: in the environment or, deployed separately, in containers temp dir"""
+    temp_path = config.temp_dir_environment if docker_dump_in_environment(container) else config.temp_dir_containers
+    return os.path.join(temp_path, replace_variables(variables, container['arch_name']))
+
+
+def docker_dump_in_environment(container):
+    """Dump is a part of the environment archive unless it is deployed separately or by layers"""
+    return not ('deploy_separately' in container and container['deploy_separately'] or docker_layers_mode(container))
+
+
+def docker_dump_image_id(docker_host, image, path, codec):
+    """ID of the dumped image: config digest from manifest.json of plain dumps, docker image inspect otherwise"""
+    if compressed_codec(codec):
+        return docker_image_id(docker_host, image)
+
+    try:
+        with tarfile.open(path) as tar:
+            config_name = json.load(tar.extractfile('manifest.json'))[0]['Config']
+    except (OSError, KeyError, IndexError, TypeError, AttributeError, ValueError, tarfile.TarError):
+        return ''
+
+    match = re.match(r'^(?:blobs/sha256/)?([0-9a-f]{64})(?:\.json)?$', config_name)
+    return 'sha256:' + match.group(1) if match else ''
+
+
+def dump_compression(container):
+    """Codec of the saved image: compress of the container, docker dump_compression, compression option or none
+
+    Images transferred by layers are not compressed, layers are compressed during the transfer.
+    """
+    if docker_layers_mode(container):
+        return compression_codec('none')
+
+    return compression_codec(container.get('compress', config.docker.get(
+        'dump_compression', getattr(config, 'compression', ''))), container['name'])
+
+
+def layers_compression(container):
+    """Codec of the layers stream: compress of the container, fast gzip by default"""
+    return compression_codec(container.get('compress', 'gzip:1'), container['name'])
+
+
+def dump_containers(variables, containers):
+    """Save images of containers in parallel"""
+    workers = int(config.docker.get('dump_workers', 4))
+    containers = [container for container in containers if 'arch_name' in container]
+
+    done, failed = run_tasks(dump_tasks(variables, containers, workers > 1 and len(containers) > 1), workers)
+    if failed:
+        err("Failed to dump: %s" % ", ".join(sorted(failed)))
+        sys.exit(1)
+
+
+def dump_tasks(variables, containers, prefixed):
+    """Dump tasks of containers with arch_name, task id is the image reference"""
+    tasks = []
+    for container in containers:
+        if 'arch_name' not in container:
+            continue
+        tasks.append({
+            'id': docker_image_ref(variables, container),
+            'fn': (lambda c: lambda: docker_dump(variables, c))(container),
+            'deps': set(),
+            'prefix': '[%s] ' % replace_variables(variables, container['name']) if prefixed else '',
+        })
+    return tasks
+
+def docker_layers(path):
+    """Layers of the saved image: archive member name -> sha256 of the layer"""
+    layers = {}
+    with tarfile.open(path) as tar:
+        manifest = json.load(tar.extractfile('manifest.json'))
+        for image in manifest:
+            for name in image['Layers']:
+                member = tar.getmember(name)
+                if not member.isfile() or name in layers:
+                    continue
+
+                # OCI layout names blobs by digest, older format needs hashing
+                match = re.match(r'^blobs/sha256/([0-9a-f]{64})$', name)
+                if match:
+                    layers[name] = match.group(1)
+                else:
+                    layer_hash = hashlib.sha256()
+                    f = tar.extractfile(member)
+                    for chunk in iter(lambda: f.read(render_chunk_size), b''):
+                        layer_hash.update(chunk)
+                    layers[name] = layer_hash.hexdigest()
+    return layers
+
+
+def write_layers(fileobj, path, arch_name, layers, missing):
+    """Write tar of missing layers (blobs/<sha256>) and the image without layers (images/<arch_name>/)
+
+    images/<arch_name>.layers lists layers to link into the image: sha256 and path.
+    """
+    recipe = ''
+    sent = set()
+    with tarfile.open(path) as tar, tarfile.open(fileobj=fileobj, mode='w|', format=tarfile.GNU_FORMAT) as out_tar:
+        for member in tar:
+            digest = layers.get(member.linkname if member.islnk() else member.name)
+            if digest is not None:
+                recipe += "%s %s\n" % (digest, member.name)
+                if digest in missing and digest not in sent:
+                    sent.add(digest)
+                    info = tarfile.TarInfo('blobs/' + digest)
+                    info.size = member.size
+                    info.mode = 0o644
+                    out_tar.addfile(info, tar.extractfile(member))
+                continue
+
+            info = copy.copy(member)
+            info.name = 'images/%s/%s' % (arch_name, member.name)
+            if member.islnk():
+                info.linkname = 'images/%s/%s' % (arch_name, member.linkname)
+            out_tar.addfile(info, tar.extractfile(member) if member.isfile() else None)
+
+        data = recipe.encode()
+        info = tarfile.TarInfo('images/%s.layers' % arch_name)
+        info.size = len(data)
+        out_tar.addfile(info, io.BytesIO(data))
+
+    return len(sent)
+
+
+def docker_layer_store():
+    return config.docker.get('layer_store', '.airship/layers')
+
+
+def docker_layers_import_command(variables, container):
+    """Link layers from the store into the image, load it and remove layers unused for layer_store_days"""
+    arch_name = replace_variables(variables, container['arch_name'])
+    cmd = ("cd %s && STORE=$(pwd) && cd images/%s && "
+           "while read -r digest path; do mkdir -p \"$(dirname \"$path\")\" && ln -f \"$STORE/blobs/$digest\" \"$path\" "
+           "&& touch \"$STORE/blobs/$digest\" || exit 1; done < ../%s.layers && "
+           "tar -cf - . | docker load && cd \"$STORE\" && rm -rf images/%s images/%s.layers") % (
+        docker_layer_store(), arch_name, arch_name, arch_name, arch_name)
+    days = int(config.docker.get('layer_store_days', 30))
+    if days > 0:
+        cmd += " && find blobs -type f -mtime +%d -delete" % days
+    return cmd
+
+
+def docker_transfer_layers(server, variables, container):
+    """Send layers which the server does not have and the image without layers"""
+    arch_name = replace_variables(variables, container['arch_name'])
+    path = os.path.join(config.temp_dir_containers, arch_name)
+    store = docker_layer_store()
+
+    mes("Transfer layers of container: %s" % container['name'])
+    if dry_run_flag:
+        deb("Transfer layers of %s to %s:%s" % (path, ssh_destination(server), store))
+        return
+
+    layers = docker_layers(path)
+    remote = set(ssh_output(server, "ls %s/blobs 2>/dev/null || true" % store).split())
+    missing = set(layers.values()) - remote
+    mes("%d of %d layers are missing on the server" % (len(missing), len(set(layers.values()))))
+
+    codec = layers_compression(container)
+
+    def write(fileobj):
+        writer = SizeWriter(fileobj)
+        sent = compress_stream(writer, lambda stream: write_layers(stream, path, arch_name, layers, missing), codec)
+        return None if sent is None else (sent, writer.size)
+
+    start = time.time()
+    sent, size = stream_to_server(server, "mkdir -p %s/blobs %s/images && cd %s && rm -rf images/%s && %s" % (
+        store, store, store, arch_name, untar_command(codec, '-')), write)
+    account_transfer(arch_name, variables, 'layers', size, time.time() - start)
+
+
+def docker_layers_mode(container):
+    return container.get('transfer', '') == 'layers'
 
-    run("%sdocker save %s/%s -o %s" % (
-        get_docker_host(variables, container['docker_host'] if 'docker_host' in container else ''),
-        container['registry'],
-        container['name'],
-        os.path.join(temp_path, replace_variables(variables, container['arch_name']))
-    ))
 
 def docker_cleanup_old_versions(server, variables, container):
     """Clean up old versions of Docker images"""
+    docker_cleanup(server, variables, [container])
+
+
+def docker_cleanup(server, variables, containers, background=False, inventory=None):
+    """Clean up old versions of images of containers: one inventory call, one batched docker rmi
+
+    With background the removal runs on the server after the call returns. Inventory fetched before
+    imports can be passed, imported versions are counted anyway.
+    """
+    if not any(docker_cleanup_settings(variables, container) for container in containers):
+        return
+
+    try:
+        refs = docker_cleanup_plan(variables, containers, inventory or docker_inventory(server))
+        if refs:
+            ssh(server, docker_remove_images_command(refs, background))
+    except (Exception, CommandError) as e:
+        # Don't fail deployment if cleanup fails, but stop on Ctrl+C
+        if interrupted_flag:
+            raise
+        err("Failed to cleanup old versions: %s" % str(e))
+
+
+def docker_cleanup_settings(variables, container):
+    """Image name without tag, number of versions to keep and tag pattern, None if cleanup is disabled"""
     if not container.get('cleanup_old', False):
         deb(f"Cleanup disabled for {container['name']}")
-        return
+        return None
 
     registry = container.get('registry', '')
     image_name = replace_variables(variables, container['name'].split(':')[0])
     if registry:
         image_name = f"{registry}/{image_name}"
-    
-    keep_versions = container.get('keep_versions', 2)
+
+    keep_versions = int(container.get('keep_versions', 2))
     cleanup_pattern = replace_variables(variables, container.get('cleanup_pattern', ''))
-    
-    # Convert glob pattern to grep pattern
+
+    # Glob pattern is matched as regular expression anywhere in the tag
     if cleanup_pattern:
         cleanup_pattern = cleanup_pattern.replace('*', '.*')
-    
-    mes(f"Cleaning up old versions of {image_name}" + 
-        (f" matching pattern '{cleanup_pattern}'" if cleanup_pattern else '') +
-        f" (keeping {keep_versions} newest versions)")
-
-    cleanup_script = f"""set -e
-
-echo "Listing all tags for {image_name}..."
-ALL_TAGS=$(docker images '{image_name}' --format '{{{{.Tag}}}}' | sort -rV)
-
-if [ -z "$ALL_TAGS" ]; then
-    echo "No tags found"
-    exit 0
-fi
-
-# Filter tags by pattern if specified
-if [ ! -z "{cleanup_pattern}" ]; then
-    echo "Filtering tags by pattern: {cleanup_pattern}"
-    ALL_TAGS=$(echo "$ALL_TAGS" | grep -E "{cleanup_pattern}" || true)
-    if [ -z "$ALL_TAGS" ]; then
-        echo "No tags match the pattern"
-        exit 0
-    fi
-fi
-
-TOTAL_TAGS=$(echo "$ALL_TAGS" | wc -l)
-echo "Found $TOTAL_TAGS matching tags"
-
-if [ $TOTAL_TAGS -gt {keep_versions} ]; then
-    echo "Keeping {keep_versions} newest versions, removing older ones..."
-    TAGS_TO_REMOVE=$(echo "$ALL_TAGS" | tail -n +$(({keep_versions} + 1)))
-    echo "$TAGS_TO_REMOVE" | while read -r tag; do
-        if [ ! -z "$tag" ]; then
-            # Check if image is used by any container
-            if docker ps -a --format '{{{{.Image}}}}' | grep -q "{image_name}:$tag"; then
-                echo "Skipping $tag - image is in use"
+
+    return image_name, keep_versions, cleanup_pattern
+
+
+def docker_inventory(server):
+    """Images and containers of the server in one call: {'images': [...], 'containers': [...]}"""
+    separator = '##AIRSHIP_CONTAINERS'
+    output = ssh_output(server, "docker images --no-trunc --format '{{json .}}' && echo '%s' && "
+                                "docker ps -a --no-trunc --format '{{json .}}'" % separator)
+
+    inventory = {'images': [], 'containers': []}
+    section = 'images'
+    for line in output.splitlines():
+        line = line.strip()
+        if line == separator:
+            section = 'containers'
+        elif line.startswith('{'):
+            inventory[section].append(json.loads(line))
+    return inventory
+
+
+def version_key(tag):
+    """Sort key of the tag, same order as sort -V: digits compare as numbers, letters before other characters, ~ first"""
+    def weight(char):
+        if char == '~':
+            return -1
+        if char.isalpha():
+            return ord(char)
+        return ord(char) + 256
+
+    parts = []
+    for text, number in re.findall(r'(\D*)(\d*)', tag):
+        if not text and not number:
+            continue
+        parts.append((tuple(weight(char) for char in text) + (0,), int(number) if number else 0))
+    return parts + [((0,), 0)], tag
+
+
+def docker_cleanup_plan(variables, containers, inventory):
+    """Image references to remove: tags older than keep_versions newest ones, images used by containers are kept"""
+    used = set()
+    for container in inventory['containers']:
+        image = container.get('Image', '')
+        used.add(image)
+        if image.startswith('sha256:'):
+            used.add(image[len('sha256:'):])
+
+    refs = []
+    for container in containers:
+        settings = docker_cleanup_settings(variables, container)
+        if settings is None:
+            continue
+        image_name, keep_versions, cleanup_pattern = settings
+
+        mes(f"Cleaning up old versions of {image_name}" +
+            (f" matching pattern '{cleanup_pattern}'" if cleanup_pattern else '') +
+            f" (keeping {keep_versions} newest versions)")
+
+        images = {image['Tag']: image.get('ID', '') for image in inventory['images']
+                  if image.get('Repository') == image_name and image.get('Tag', '<none>') != '<none>'}
+
+        # The deployed version counts even if it is not loaded yet (transaction)
+        tag = replace_variables(variables, container['name']).split(':')[1] if ':' in container['name'] else 'latest'
+        images.setdefault(tag, '')
+
+        tags = sorted((tag for tag in images if not cleanup_pattern or re.search(cleanup_pattern, tag)),
+                      key=version_key, reverse=True)
+        out("Found %d matching tags" % len(tags))
+        if len(tags) <= keep_versions:
+            out(f"No cleanup needed - number of tags ({len(tags)}) <= keep_versions ({keep_versions})")
+            continue
+
+        for tag in tags[keep_versions:]:
+            ref = f"{image_name}:{tag}"
+            image_id = images[tag]
+            if ref in used or (tag == 'latest' and image_name in used) or \
+                    (image_id and (image_id in used or image_id[len('sha256:'):] in used)):
+                out(f"Skipping {tag} - image is in use")
                 continue
-            fi
-            echo "Removing {image_name}:$tag"
-            if docker rmi -f {image_name}:$tag; then
-                echo "Successfully removed $tag"
-            else
-                echo "Failed to remove $tag"
-            fi
-        fi
-    done
-else
-    echo "No cleanup needed - number of tags ($TOTAL_TAGS) <= keep_versions ({keep_versions})"
-fi"""
-    
-    try:
-        ssh(server, cleanup_script)
-    except Exception as e:
-        err(f"Failed to cleanup old versions of {image_name}: {str(e)}")
-        # Don't fail deployment if cleanup fails
-        pass
+            out(f"Removing {ref}")
+            refs.append(ref)
 
+    return refs
+
+
+def docker_remove_images_command(refs, background=False):
+    """Remove images in one call, images which became used meanwhile are not removed (no -f)"""
+    command = "docker rmi %s" % " ".join(shlex.quote(ref) for ref in refs)
+    if background:
+        return "nohup %s >/dev/null 2>&1 </dev/null &" % command
+    return command + " || true"
+
+
+def docker_import_action(variables, container, inventory):
+    """How to import the dumped image: skip if the server has it with the same tag, tag if it has the image
+    with other tag only, load otherwise
+    """
+    image_id = dumped_image_ids.get(docker_dump_path(variables, container), '')
+    ref = docker_image_ref(variables, container)
+    repository = image_repository(ref)
+    tag = ref[len(repository) + 1:] or 'latest'
+
+    images = [image for image in inventory['images'] if image_id and image.get('ID') == image_id]
+    if not images:
+        return 'load'
+    if any(image.get('Repository') == repository and image.get('Tag') == tag for image in images):
+        return 'skip'
+    return 'tag'
+
+
+def docker_tag_command(variables, container):
+    image_id = dumped_image_ids.get(docker_dump_path(variables, container), '')
+    return "docker tag %s %s" % (image_id, docker_image_ref(variables, container))
 
-def docker_import(server, variables, container):
-    mes("Import container: %s" % container['name'])
-    ssh(server, "cd %s && docker load -i %s" % (
-        config.destination_dir,
-        replace_variables(variables, container['arch_name'])
-    ))
+
+def docker_import_guard(variables, container, command):
+    """Load only if the server does not have the image by the time the command runs"""
+    image_id = dumped_image_ids.get(docker_dump_path(variables, container), '')
+    if not image_id:
+        return command
+    return "[ \"$(docker image inspect --format '{{.Id}}' %s 2>/dev/null)\" = %s ] || { %s\n}" % (
+        docker_image_ref(variables, container), image_id, command)
+
+
+def docker_import_workers():
+    return int(config.docker.get('import_workers', 2))
+
+
+def parallel_command(commands, workers):
+    """Script which runs (name, command) pairs at the same time, at most workers of them
+
+    Output lines are prefixed by names, the script fails if any command fails.
+    """
+    if len(commands) == 1:
+        return commands[0][1]
+
+    script = "AIRSHIP_PIDS=''\nAIRSHIP_FAILED=0\n"
+    for i, (name, command) in enumerate(commands):
+        if i >= max(workers, 1):
+            script += "set -- $AIRSHIP_PIDS; wait $1 || AIRSHIP_FAILED=1; shift; AIRSHIP_PIDS=\"$*\"\n"
+        script += ("( set -o pipefail; { %s\n} 2>&1 | while IFS= read -r line; do printf '%%s %%s\\n' %s \"$line\"; done"
+                   " ) </dev/null &\n") % (command, shlex.quote('[%s]' % name))
+        script += "AIRSHIP_PIDS=\"$AIRSHIP_PIDS $!\"\n"
+    script += "for AIRSHIP_PID in $AIRSHIP_PIDS; do wait $AIRSHIP_PID || AIRSHIP_FAILED=1; done\n"
+    script += "[ $AIRSHIP_FAILED -eq 0 ]"
+    return script
+
+
+def docker_import_containers(server, imports):
+    """Run import commands (name, command) on the server in one call, import_workers at the same time"""
+    if not imports:
+        return
+    mes("Import containers: %s" % ", ".join(name for name, command in imports))
+    ssh(server, parallel_command(imports, docker_import_workers()))
+
+
+def docker_import_command(variables, container):
+    arch_name = replace_variables(variables, container['arch_name'])
+    if dump_compression(container)['codec'] == 'zstd':
+        # docker load reads gzip itself, zstd only in recent versions
+        return "cd %s && zstd -dc %s | docker load" % (variables['DESTINATION_DIR'], arch_name)
+
+    return "cd %s && docker load -i %s" % (variables['DESTINATION_DIR'], arch_name)
+
+
+def remote_transaction(server, steps):
+    """Run steps on the server in one session
+
+    Step is a dict: name, command, optional (failure does not stop the transaction).
+    Returns list of step results: name, code, time.
+    """
+    # Markers start on a new line, output of the step may have no newline at the end
+    script = ""
+    for step in steps:
+        script += "echo; echo '%s START %s'\n" % (step_marker, step['name'])
+        script += "(\n%s\n) </dev/null\n" % step['command']
+        script += "AIRSHIP_CODE=$?\n"
+        script += "echo; echo \"%s END %s $AIRSHIP_CODE\"\n" % (step_marker, step['name'])
+        if not step.get('optional', False):
+            script += "[ $AIRSHIP_CODE -eq 0 ] || exit $AIRSHIP_CODE\n"
+
+    results = []
+    # Empty line printed by echo before the marker is held until the next line is known
+    held = []
+
+    def on_line(line):
+        if not line.startswith(step_marker + ' '):
+            if held:
+                out(prefix() + held.pop())
+            if line == '':
+                held.append(line)
+                return True
+            return False
+        held.clear()
+        marker = line.split(' ')
+        if marker[1] == 'START':
+            mes("Step: %s" % marker[2])
+            results.append({'name': marker[2], 'code': None, 'start': datetime.now(), 'time': 0})
+        elif marker[1] == 'END' and results:
+            results[-1]['code'] = int(marker[3])
+            results[-1]['time'] = (datetime.now() - results[-1]['start']).total_seconds()
+        return True
+
+    code = ssh(server, script, on_line, check=False)
+
+    out(prefix() + "%-40s %-6s %s" % ('STEP', 'CODE', 'TIME'))
+    for result in results:
+        out(prefix() + "%-40s %-6s %.2fs" % (result['name'], '-' if result['code'] is None else result['code'],
+                                             result['time']))
+    if code != 0:
+        err("Remote transaction failed with code %d" % code)
+        sys.exit(code)
+
+    return results
 
 
 def user_commands(server, variables, commands, place):
@@ -320,11 +2314,457 @@ def user_commands(server, variables, commands, place):
 def stage_cleanup_temp_dir():
     mes("Create / cleanup temp directory")
     run("mkdir -p %s" % config.temp_dir)
-    run("rm -rf %s/*" % (config.temp_dir))
+    if '--clean' in flags:
+        run("rm -rf %s/*" % (config.temp_dir))
+    else:
+        # Environment is kept for the build cache
+        run("rm -rf %s/* %s/*" % (config.temp_dir_containers, config.temp_dir_archives))
     run("mkdir -p %s" % config.temp_dir_environment)
     run("mkdir -p %s" % config.temp_dir_containers)
     run("mkdir -p %s" % config.temp_dir_archives)
 
+
+def environment_files(path, env_path, replace_vars):
+    """Files, links and directories of the environment entry"""
+    if not os.path.isdir(path) or os.path.islink(path):
+        yield {'path': path, 'env_path': env_path, 'type': 'link' if os.path.islink(path) else 'file',
+               'replace_vars': replace_vars}
+        return
+
+    yield {'path': path, 'env_path': env_path, 'type': 'dir'}
+    yield from environment_tree(path, env_path, replace_vars_pattern(replace_vars))
+
+
+def replace_vars_pattern(replace_vars):
+    """Pattern of file names rendered in directories with replace_vars"""
+    return re.compile("(%s)" % "|".join(config.replace_vars_file_patterns)) if replace_vars else None
+
+
+def environment_tree(path, env_path, pattern):
+    """Walk the source tree once, file names matching pattern are rendered"""
+    with os.scandir(path) as entries:
+        for entry in entries:
+            file = {'path': entry.path, 'env_path': os.path.join(env_path, entry.name)}
+            if entry.is_symlink():
+                file['type'] = 'link'
+            elif entry.is_dir():
+                file['type'] = 'dir'
+            else:
+                file['type'] = 'file'
+                file['replace_vars'] = pattern is not None and pattern.search(entry.name) is not None
+                file['stat'] = entry.stat()
+            yield file
+            if file['type'] == 'dir':
+                yield from environment_tree(entry.path, file['env_path'], pattern)
+
+
+def build_cache_entry(file, variables, cached):
+    """Cache entry of the environment file: source hash and hash of variables used in the file"""
+    stat = file['stat'] if 'stat' in file else os.stat(file['path'])
+    # Names are known only if the cached entry was rendered too
+    if cached is not None and cached['path'] == file['path'] and cached['size'] == stat.st_size \
+            and cached['mtime'] == stat.st_mtime_ns and cached['replace_vars'] == file['replace_vars']:
+        source_hash, names = cached['hash'], cached['names']
+    else:
+        source = hashlib.sha256()
+        names = set()
+        with open(file['path'], 'rb') as f:
+            if file['replace_vars']:
+                data = f.read()
+                source.update(data)
+                names = set(name.decode('utf-8', 'surrogateescape') for name in content_variable_pattern.findall(data))
+            else:
+                for chunk in iter(lambda: f.read(render_chunk_size), b''):
+                    source.update(chunk)
+        source_hash, names = source.hexdigest(), sorted(names)
+
+    return {
+        'path': file['path'],
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+        'hash': source_hash,
+        'names': names,
+        'replace_vars': file['replace_vars'],
+        'variables': hashlib.sha256(json.dumps([[name, str(variables[name]) if name in variables else None]
+                                                for name in names]).encode()).hexdigest() if names else '',
+    }
+
+
+def build_cache_fresh(entry, cached, env_path):
+    """Check output of the environment file is built from the same source and variables"""
+    if cached is None:
+        return False
+    try:
+        stat = os.lstat(env_path)
+    except OSError:
+        return False
+    return S_ISREG(stat.st_mode) and all(entry[key] == cached[key] for key in ['hash', 'variables', 'replace_vars']) \
+        and cached.get('env_size') == stat.st_size and cached.get('env_mtime') == stat.st_mtime_ns
+
+
+def build_cache_file():
+    return os.path.join(config.temp_dir, 'build-cache.json')
+
+
+def load_build_cache():
+    try:
+        with open(build_cache_file()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_build_cache(cache):
+    with open(build_cache_file() + '.tmp', 'w') as f:
+        f.write(json.dumps(cache))
+    os.replace(build_cache_file() + '.tmp', build_cache_file())
+
+
+def prune_environment(path, keep):
+    """Remove files and directories which are not part of the environment anymore"""
+    removed = 0
+    for root, dirs, files in os.walk(path, topdown=False):
+        for name in files + [name for name in dirs if os.path.islink(os.path.join(root, name))]:
+            full_path = os.path.join(root, name)
+            if full_path not in keep:
+                deb("Remove %s" % full_path)
+                os.unlink(full_path)
+                removed += 1
+        for name in dirs:
+            full_path = os.path.join(root, name)
+            if full_path not in keep and not os.path.islink(full_path):
+                shutil.rmtree(full_path)
+                removed += 1
+    return removed
+
+
+def build_environment_file(replacer, file):
+    """Copy or render environment file, replace link or directory if it is in the way"""
+    if os.path.islink(file['env_path']) or os.path.isdir(file['env_path']):
+        remove_path(file['env_path'])
+    copy_and_replace(replacer, file)
+    stat = os.stat(file['env_path'])
+    return stat.st_size, stat.st_mtime_ns
+
+
+def place_environment_path(env_file):
+    """Create directory or link of the environment, replace what is in the way"""
+    if env_file['type'] == 'dir':
+        if os.path.islink(env_file['env_path']) or os.path.isfile(env_file['env_path']):
+            remove_path(env_file['env_path'])
+        os.makedirs(env_file['env_path'], exist_ok=True)
+        return
+
+    link = os.readlink(env_file['path'])
+    if not os.path.islink(env_file['env_path']) or os.readlink(env_file['env_path']) != link:
+        remove_path(env_file['env_path'])
+        os.makedirs(os.path.dirname(env_file['env_path']), exist_ok=True)
+        os.symlink(link, env_file['env_path'])
+
+
+def remove_path(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+
+def stage_build_environment():
+    """Build environment incrementally, return paths of changed files"""
+    mes("Copy environment files")
+    replacer = compile_variables(config.variables) if len(config.variables) > 0 else None
+    cache = load_build_cache()
+    new_cache = {}
+    keep = set()
+    changed = []
+
+    for file in config.files:
+        path = replace_variables(config.variables, os.path.join(config.work_dir, file['path']))
+        env_path = replace_variables(config.variables, os.path.join(config.temp_dir_environment, file['env_path']))
+
+        if not os.path.lexists(path) and not dry_run_flag:
+            err("File/dir %s not exist" % path)
+            continue
+
+        deb("Process file/dir: " + path)
+        if dry_run_flag:
+            continue
+
+        for env_file in environment_files(path, env_path, 'replace_vars' in file and file['replace_vars']):
+            keep.add(env_file['env_path'])
+            if env_file['type'] != 'file':
+                place_environment_path(env_file)
+            else:
+                cached = cache.get(env_file['env_path'])
+                entry = build_cache_entry(env_file, config.variables, cached)
+                new_cache[env_file['env_path']] = entry
+                if build_cache_fresh(entry, cached, env_file['env_path']):
+                    entry['env_size'], entry['env_mtime'] = cached['env_size'], cached['env_mtime']
+                else:
+                    changed.append(env_file)
+
+    # Parent directories of single files
+    for env_path in list(keep):
+        parent = os.path.dirname(env_path)
+        while parent.startswith(config.temp_dir_environment + os.sep) and parent not in keep:
+            keep.add(parent)
+            parent = os.path.dirname(parent)
+
+    if dry_run_flag:
+        return []
+
+    # Render changed files in parallel
+    with ThreadPoolExecutor(max_workers=int(getattr(config, 'env_workers', os.cpu_count() or 1))) as pool:
+        futures = [(file, pool.submit(build_environment_file, replacer, file)) for file in changed]
+        for file, future in futures:
+            new_cache[file['env_path']]['env_size'], new_cache[file['env_path']]['env_mtime'] = future.result()
+
+    removed = prune_environment(config.temp_dir_environment, keep)
+    if new_cache != cache:
+        save_build_cache(new_cache)
+
+    mes("Environment files: %d changed, %d not changed, %d removed" % (
+        len(changed), len(new_cache) - len(changed), removed))
+    count('env_files_cached', len(new_cache) - len(changed))
+    return [file['env_path'] for file in changed]
+
+
+class Watcher:
+    """Changed paths under the roots: inotify through ctypes on Linux, polling of the trees otherwise
+
+    Roots are files or directories, directories are watched recursively with directories created later.
+    """
+
+    def __init__(self, roots, poll_interval=1.0, inotify=True):
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.poll_interval = poll_interval
+        self.watches = {}
+        self.fd = self.init_inotify() if inotify else -1
+        if self.fd < 0:
+            self.snapshot = self.scan()
+
+    def init_inotify(self):
+        """Watch directories of the roots, -1 if inotify is not available or its limit of watches is reached"""
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return -1
+
+        # Single files are watched by their directories
+        if self.fd >= 0 and not all(self.add_watches(root) if os.path.isdir(root) else
+                                    self.add_watch(os.path.dirname(root)) for root in self.roots):
+            self.close()
+        return self.fd
+
+    def add_watches(self, path):
+        return all(self.add_watch(root) for root, dirs, files in os.walk(path))
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), IN_CHANGED)
+        if wd < 0:
+            deb("Failed to watch %s: %s" % (path, os.strerror(ctypes.get_errno())))
+            return False
+        self.watches[wd] = path
+        return True
+
+    def read_inotify(self, timeout):
+        changed = set()
+        while select.select([self.fd], [], [], timeout)[0]:
+            timeout = 0
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+                name = data[offset + 16:offset + 16 + length].rstrip(b'\0')
+                offset += 16 + length
+
+                if mask & IN_Q_OVERFLOW:
+                    # Events are lost, everything is changed
+                    changed.update(self.roots)
+                elif mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                elif wd in self.watches:
+                    path = os.path.join(self.watches[wd], os.fsdecode(name)) if name else self.watches[wd]
+                    changed.add(path)
+                    if mask & IN_ISDIR and mask & IN_ADDED and self.watched(path):
+                        # Files could be created before the watch is added
+                        self.add_watches(path)
+                        changed.update(self.scan([path]))
+        return changed
+
+    def scan(self, roots=None):
+        """Modification time, size and mode of every path under the roots"""
+        snapshot = {}
+        for root in roots or self.roots:
+            for path in [root] + [os.path.join(dir, name) for dir, dirs, files in os.walk(root)
+                                  for name in dirs + files]:
+                try:
+                    stat = os.lstat(path)
+                except OSError:
+                    continue
+                snapshot[path] = (stat.st_mtime_ns, stat.st_size, stat.st_mode)
+        return snapshot
+
+    def watched(self, path):
+        return any(path == root or path.startswith(root + os.sep) for root in self.roots)
+
+    def wait(self, timeout=None):
+        """Changed paths, waits up to timeout seconds for the first change, forever with None"""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            remaining = None if deadline is None else max(deadline - time.time(), 0)
+            if self.fd >= 0:
+                changed = self.read_inotify(remaining)
+            else:
+                time.sleep(self.poll_interval if remaining is None else min(self.poll_interval, remaining))
+                snapshot = self.scan()
+                changed = {path for path in set(snapshot) | set(self.snapshot)
+                           if snapshot.get(path) != self.snapshot.get(path)}
+                self.snapshot = snapshot
+
+            changed = {path for path in changed if self.watched(path)}
+            if changed or deadline is not None and time.time() >= deadline:
+                return changed
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def watch_settings():
+    return getattr(config, 'watch', {})
+
+
+def watch_source(file):
+    return os.path.abspath(replace_variables(config.variables, os.path.join(config.work_dir, file['path'])))
+
+
+def watch_changes(watcher, debounce):
+    """Wait for changes, collect them until debounce seconds pass without a change; return them and time of the first"""
+    changed = watcher.wait()
+    start = time.time()
+    while True:
+        more = watcher.wait(debounce)
+        if not more:
+            return changed, start
+        changed |= more
+
+
+def watch_update_environment(changed):
+    """Render environment files of changed sources with current variables
+
+    Returns changed and removed paths relative to the environment, the build cache is updated too.
+    """
+    replacer = compile_variables(config.variables) if len(config.variables) > 0 else None
+    cache = load_build_cache()
+    updated, removed = set(), set()
+
+    for file in config.files:
+        root = watch_source(file)
+        env_root = replace_variables(config.variables, os.path.join(config.temp_dir_environment, file['env_path']))
+        replace_vars = 'replace_vars' in file and file['replace_vars']
+
+        for path in sorted(changed):
+            if path != root and not path.startswith(root + os.sep):
+                continue
+            env_path = env_root if path == root else os.path.join(env_root, os.path.relpath(path, root))
+
+            if not os.path.lexists(path):
+                remove_path(env_path)
+                for name in [name for name in cache if name == env_path or name.startswith(env_path + os.sep)]:
+                    del cache[name]
+                removed.add(env_path)
+                continue
+
+            if path != root and (os.path.islink(path) or not os.path.isdir(path)):
+                pattern = replace_vars_pattern(replace_vars)
+                env_files = [{'path': path, 'env_path': env_path, 'type': 'link' if os.path.islink(path) else 'file',
+                              'replace_vars': pattern is not None and pattern.search(os.path.basename(path)) is not None}]
+            else:
+                env_files = environment_files(path, env_path, replace_vars)
+
+            for env_file in env_files:
+                if env_file['type'] != 'file':
+                    place_environment_path(env_file)
+                    if env_file['type'] == 'link':
+                        updated.add(env_file['env_path'])
+                    continue
+                entry = build_cache_entry(env_file, config.variables, None)
+                entry['env_size'], entry['env_mtime'] = build_environment_file(replacer, env_file)
+                cache[env_file['env_path']] = entry
+                updated.add(env_file['env_path'])
+
+    save_build_cache(cache)
+    return ([os.path.relpath(path, config.temp_dir_environment) for path in sorted(updated)],
+            [os.path.relpath(path, config.temp_dir_environment) for path in sorted(removed - updated)])
+
+
+def watch_hooks(paths):
+    """Commands of hooks whose patterns match changed paths, in order of the config"""
+    return [command for pattern, command in watch_settings().get('hooks', {}).items()
+            if any(fnmatch.fnmatch(path, pattern) for path in paths)]
+
+
+def watch_sync(server, variables, paths, commands):
+    """Send environment paths to the server in one rsync call, paths missing locally are deleted there; run hooks"""
+    destination_dir = variables['DESTINATION_DIR']
+    cmd = "rsync -avzR --delete-missing-args --force --rsync-path=\"mkdir -p %s && rsync\"" % destination_dir
+    cmd += " -e 'ssh" + ssh_options(server) + "' "
+    cmd += " ".join(shlex.quote(os.path.join(config.temp_dir_environment, '.', path)) for path in paths)
+    cmd += " " + ssh_destination(server) + ":" + destination_dir + "/"
+    with Span('upload', 'upload', host=ssh_destination(server), files=len(paths), destination=destination_dir):
+        run(cmd, timeout=command_timeout(remote=True))
+
+    for command in commands:
+        command = replace_variables(variables, command)
+        mes("Reload: %s" % command)
+        ssh(server, command)
+
+
+def stage_watch():
+    """Send changed environment files to servers and run reload hooks until Ctrl+C"""
+    settings = watch_settings()
+    run("mkdir -p %s" % config.temp_dir_environment)
+
+    # Changes made before the start are sent too
+    changed = stage_build_environment()
+    check_group_variables()
+    if changed:
+        paths = [os.path.relpath(path, config.temp_dir_environment) for path in changed]
+        on_servers(lambda server, variables: watch_sync(server, variables, paths, []))
+
+    watcher = Watcher([watch_source(file) for file in config.files], float(settings.get('poll_interval', 1)),
+                      settings.get('inotify', True))
+    mes("Watch environment files with %s, press Ctrl+C to stop" % ('inotify' if watcher.fd >= 0 else 'polling'))
+    try:
+        while True:
+            changed, start = watch_changes(watcher, float(settings.get('debounce', 0.2)))
+            updated, removed = watch_update_environment(changed)
+            paths = updated + removed
+            if not paths:
+                continue
+
+            mes("Changed: %s%s" % (", ".join(paths[:10]), " and %d more" % (len(paths) - 10) if len(paths) > 10 else ''))
+            commands = watch_hooks(paths)
+            try:
+                on_servers(lambda server, variables: watch_sync(server, variables, paths, commands))
+            except SystemExit as e:
+                # Ctrl+C exits with 0, failed sync waits for the next change
+                if not e.code:
+                    raise
+                err("Failed to send changes, waiting for the next change")
+                continue
+            mes("Live in %.1fs" % (time.time() - start))
+    finally:
+        watcher.close()
+
+
 def get_docker_host(variables, host = ''):
     docker_host = ''
     if host != '':
@@ -371,19 +2811,122 @@ def update():
     mes("AirShip updated to %s" % latest_tag_name)
 
 
+def get_servers(name):
+    """Server names by server name, group name or server tag"""
+    if name in config.servers:
+        return [name]
+    if name in getattr(config, 'groups', {}):
+        return list(config.groups[name])
+    return [server_name for server_name, server in config.servers.items() if name in server.get('tags', [])]
+
+
+def get_server_variables(server_name):
+    """Variables for the server of the group"""
+    server = config.servers[server_name]
+    variables = base_variables.new_child()
+    variables.update(
+        {
+            'SERVER_NAME': server_name,
+            'SERVER_HOST': server['host'],
+            'VERSION': replace_variables(variables, server['version']),
+            'ENV': server['env'],
+        }
+    )
+    if 'variables' in server:
+        variables.update(server['variables'])
+    variables['DESTINATION_DIR'] = replace_variables(variables, server.get('destination_dir', default_destination_dir))
+    return variables
+
+
+def group_templates():
+    """Templates resolved once for the whole group: environment files and paths, container images, builds and dumps"""
+    templates = ['${%s}' % name for entry in load_build_cache().values() for name in entry['names']]
+    templates += [file[key] for file in config.files for key in ['path', 'env_path']]
+    for container in config.containers:
+        templates += [container[key] for key in ['name', 'arch_name', 'registry', 'dockerfile', 'build_path']
+                      if key in container]
+        templates += [arg for key in ['build_args', 'build_contexts'] for arg in container.get(key, [])]
+        docker_host = container.get('docker_host') or config.docker.get('host', '')
+        if docker_host:
+            templates.append(docker_host)
+    return sorted(set(templates))
+
+
+def check_group_variables():
+    """Environment and containers are built once, every server of the group must resolve them the same way"""
+    if servers == [server_name]:
+        return
+
+    templates = group_templates()
+    built = {template: replace_variables(config.variables, template) for template in templates}
+    for name in servers:
+        variables = get_server_variables(name)
+        differ = [template for template in templates if replace_variables(variables, template) != built[template]]
+        if differ:
+            err("Server %s of [%s] resolves %s differently than the environment and containers built for the group, "
+                "deploy it separately" % (name, server_name, ", ".join(differ)))
+            sys.exit(1)
+
+
+def on_servers(fn):
+    """Run fn(server, variables) on every server of the group in parallel"""
+    if servers == [server_name]:
+        fn(server, config.variables)
+        return
+
+    workers = int(get_flag_value('--parallel', getattr(config, 'parallel', 10)))
+    times = {}
+
+    def run_on_server(name):
+        times[name] = [datetime.now(), None]
+        try:
+            fn(config.servers[name], get_server_variables(name))
+        finally:
+            times[name][1] = datetime.now()
+
+    tasks = []
+    for name in servers:
+        tasks.append({
+            'id': name,
+            'fn': (lambda n: lambda: run_on_server(n))(name),
+            'deps': set(),
+            'prefix': '[%s] ' % name,
+        })
+
+    done, failed = run_tasks(tasks, workers)
+
+    mes("Summary for [%s]" % server_name)
+    out("%-30s %-30s %-8s %s" % ('SERVER', 'HOST', 'STATUS', 'TIME'))
+    for name in servers:
+        out("%-30s %-30s %-8s %.1fs" % (
+            name,
+            config.servers[name]['host'],
+            'ok' if name in done else 'failed',
+            (times[name][1] - times[name][0]).total_seconds() if name in times else 0
+        ))
+    if failed:
+        err("Failed on %d of %d servers" % (len(failed), len(servers)))
+        sys.exit(1)
+
+
 def init_config(server_name=''):
     """Initialize configuration based on server name"""
-    global server
+    global server, servers, default_destination_dir, base_variables
 
-    # Load env to variables
-    config.variables.update(os.environ)
+    # Environment is read lazily: values set at runtime, then environment, then variables of the config
+    base_variables = ChainMap({}, os.environ, config.variables)
+    # Variables of the first server are set in the child, servers of the group start from the base
+    config.variables = base_variables.new_child()
 
     # Set server name in variables
     config.variables['SERVER_NAME'] = server_name
 
-    # Load server config
-    if server_name != '':
-        server = config.servers[server_name]
+    default_destination_dir = config.destination_dir
+    servers = get_servers(server_name) if server_name != '' else []
+
+    # Load server config, first server of the group is used to build the environment and containers
+    if len(servers) > 0:
+        server = config.servers[servers[0]]
 
         config.variables.update(
             {
@@ -406,9 +2949,9 @@ def init_config(server_name=''):
     config.temp_dir_containers = os.path.join(config.temp_dir, "containers")
     config.temp_dir_archives = os.path.join(config.temp_dir, "archives")
 
-    config.variables.update(
+    config.variables['DESTINATION_DIR'] = config.destination_dir
+    base_variables.update(
         {
-            'DESTINATION_DIR': config.destination_dir,
             'TEMP_DIR': config.temp_dir,
             'TEMP_ENVIRONMENT_DIR': config.temp_dir_environment
         }
@@ -422,14 +2965,494 @@ def init_config(server_name=''):
     if not hasattr(config, 'docker'):
         config.docker = {}
 
+    if not hasattr(config, 'ssh'):
+        config.ssh = {}
+
+def upload_environment(server, variables):
+    """Upload the environment archive, return its content hash or None if the server has the same archive"""
+    destination_dir = variables['DESTINATION_DIR']
+    arch_path = os.path.join(config.temp_dir_archives, config.arch_name)
+
+    content_hash = archive_hash(arch_path)
+    if content_hash != '' and content_hash == remote_archive_hash(server, variables):
+        mes("Environment is not changed, skip upload and extract")
+        count('uploads_skipped')
+        account_transfer(config.arch_name, variables, 'skipped', 0, 0)
+        return None
+
+    mes("Upload archive to [%s]" % destination_dir)
+    upload_artifact(server, variables, config.arch_name, arch_path, "%s/" % destination_dir, create_dir=True,
+                    codec=environment_codec())
+    return content_hash
+
+
+def deploy_environment(server, variables):
+    """Stream or upload the environment unless the pipeline uploaded it, return content hash of the archive to
+    extract or None"""
+    if stream_mode():
+        mes("Stream environment to [%s] on destination server" % variables['DESTINATION_DIR'])
+        stream_environment(server, variables)
+        return None
+    if variables['SERVER_NAME'] in pipeline_uploads:
+        return pipeline_uploads.pop(variables['SERVER_NAME'])
+    return upload_environment(server, variables)
+
+
+def deploy_server(server, variables):
+    """Upload environment and containers to the server, import containers and run"""
+    destination_dir = variables['DESTINATION_DIR']
+
+    content_hash = deploy_environment(server, variables)
+    if content_hash is not None:
+        mes("Extract archive")
+        ssh(server, extract_command(destination_dir, content_hash))
+
+    # Images which the server already has are not transferred and loaded again
+    containers = [container for container in config.containers if 'arch_name' in container]
+    inventory = docker_inventory(server) if containers else None
+    imports = []
+
+    for container in containers:
+        name = replace_variables(variables, container['name'])
+        action = docker_import_action(variables, container, inventory)
+        if action == 'skip':
+            mes("Skip import of %s: server has the same image" % name)
+            count('imports_skipped')
+            continue
+        if action == 'tag':
+            mes("Tag %s: server has the same image with other tag" % name)
+            imports.append((name, docker_tag_command(variables, container)))
+            continue
+
+        if docker_layers_mode(container):
+            docker_transfer_layers(server, variables, container)
+            imports.append((name, docker_layers_import_command(variables, container)))
+            continue
+
+        if 'deploy_separately' in container and container['deploy_separately']:
+            temp_path = os.path.join(config.temp_dir_containers, replace_variables(variables, container['arch_name']))
+
+            excludeVariables = {}
+            for var, val in variables.items():
+                excludeVariables[var] = "*[^" + val + "]"
+
+            if 'remove_old' in container and container['remove_old']:
+                ssh(server, "rm -f " + os.path.join(destination_dir,
+                                                    replace_variables(excludeVariables, container['arch_name'])))
+
+            upload_artifact(server, variables, os.path.basename(temp_path), temp_path, destination_dir,
+                            'ignore_existing' in container and container['ignore_existing'],
+                            codec=dump_compression(container))
+        imports.append((name, docker_import_command(variables, container)))
+
+    docker_import_containers(server, imports)
+
+    if docker_cleanup_background():
+        run_server(server, variables)
+        docker_cleanup(server, variables, containers, background=True, inventory=inventory)
+    else:
+        docker_cleanup(server, variables, containers, inventory=inventory)
+        run_server(server, variables)
+
+
+def docker_cleanup_background():
+    return config.docker.get('cleanup_background', False)
+
+
+def deploy_server_transaction(server, variables):
+    """Upload environment and containers, then extract, import and run in one remote session"""
+    destination_dir = variables['DESTINATION_DIR']
+
+    steps = []
+
+    content_hash = deploy_environment(server, variables)
+    if content_hash is not None:
+        steps.append({'name': 'extract', 'command': extract_command(destination_dir, content_hash)})
+
+    # Inventory is fetched before the session, loads check the image again when they run
+    containers = [container for container in config.containers if 'arch_name' in container]
+    inventory = docker_inventory(server) if containers else None
+    imports = []
+
+    for container in containers:
+        name = replace_variables(variables, container['name'])
+        action = docker_import_action(variables, container, inventory)
+        if action == 'skip':
+            mes("Skip import of %s: server has the same image" % name)
+            count('imports_skipped')
+            continue
+        if action == 'tag':
+            imports.append((name, docker_tag_command(variables, container)))
+            continue
+
+        if docker_layers_mode(container):
+            docker_transfer_layers(server, variables, container)
+        elif 'deploy_separately' in container and container['deploy_separately']:
+            temp_path = os.path.join(config.temp_dir_containers, replace_variables(variables, container['arch_name']))
+
+            excludeVariables = {}
+            for var, val in variables.items():
+                excludeVariables[var] = "*[^" + val + "]"
+
+            # Old archives never match the current one, so they can be removed after upload
+            if 'remove_old' in container and container['remove_old']:
+                steps.append({'name': 'remove-old:' + name, 'command': "rm -f " + os.path.join(
+                    destination_dir, replace_variables(excludeVariables, container['arch_name']))})
+
+            upload_artifact(server, variables, os.path.basename(temp_path), temp_path, destination_dir,
+                            'ignore_existing' in container and container['ignore_existing'],
+                            codec=dump_compression(container))
+
+        imports.append((name, docker_import_guard(variables, container, docker_layers_import_command(
+            variables, container) if docker_layers_mode(container) else docker_import_command(variables, container))))
+
+    if imports:
+        steps.append({'name': 'import' if len(imports) > 1 else 'import:' + imports[0][0],
+                      'command': parallel_command(imports, docker_import_workers())})
+
+    # Retention plan is made before the session, versions being imported are counted as present
+    cleanup = None
+    if any(docker_cleanup_settings(variables, container) for container in containers):
+        try:
+            refs = docker_cleanup_plan(variables, containers, inventory)
+            if refs:
+                cleanup = {'name': 'cleanup', 'optional': True,
+                           'command': docker_remove_images_command(refs, docker_cleanup_background())}
+        except (Exception, CommandError) as e:
+            if interrupted_flag:
+                raise
+            err("Failed to plan cleanup of old versions: %s" % str(e))
+
+    if cleanup and not docker_cleanup_background():
+        steps.append(cleanup)
+    steps.append({'name': 'run', 'command': replace_variables(variables, config.run_command)})
+    if cleanup and docker_cleanup_background():
+        steps.append(cleanup)
+
+    mes("Extract, import and run in one session")
+    return remote_transaction(server, steps)
+
+
+def stream_to_server(server, command, write):
+    """Run command on the server with input written by write(fileobj), return the result of write"""
+    cmd = "ssh" + ssh_options(server) + " " + ssh_destination(server) + " " + shlex.quote(command)
+    deb(cmd)
+    if dry_run_flag:
+        return None
+
+    start = time.time()
+    with Span('stream', 'stream', host=ssh_destination(server), command=command) as span:
+        process, timer = start_process(cmd, command_timeout(remote=True), stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=False)
+        task_prefix = prefix()
+        output = deque(maxlen=output_tail_lines)
+
+        def read_output():
+            for line in process.stdout:
+                output.append(line.decode(errors='replace').rstrip('\n'))
+                out(task_prefix + output[-1])
+
+        reader = threading.Thread(target=read_output)
+        reader.start()
+
+        writer = SizeWriter(process.stdin)
+        result = None
+        try:
+            result = write(writer)
+            process.stdin.close()
+        except BrokenPipeError:
+            result = None
+
+        timed_out = finish_process(process, timer)
+        reader.join()
+        process.stdout.close()
+        span.args['code'] = timeout_code if timed_out else process.returncode
+        span.args['bytes'] = writer.size
+
+    if span.args['code'] != 0 or result is None:
+        err("Failed to stream data to %s" % ssh_destination(server))
+        raise CommandError({'command': cmd, 'code': span.args['code'] or 1, 'output': '\n'.join(output),
+                            'time': time.time() - start, 'timed_out': timed_out})
+
+    return result
+
+
+def stream_environment(server, variables):
+    """Pack environment and extract it on the server on the fly, without archive on local disk"""
+    destination_dir = variables['DESTINATION_DIR']
+
+    codec = environment_codec()
+
+    def write(fileobj):
+        writer = SizeWriter(fileobj)
+        result = compress_stream(writer, lambda stream: write_archive(stream, config.temp_dir_environment), codec)
+        return None if result is None else result + (writer.size,)
+
+    start = time.time()
+    result = stream_to_server(server, "mkdir -p %s && cd %s && %s --totals" % (
+        destination_dir, destination_dir, untar_command(codec, '-', 'm')), write)
+    if result is None:
+        return
+
+    content_hash, size, compressed = result
+    mes("Streamed %d bytes" % size)
+    account_artifact(config.arch_name, 'environment', size, compressed, codec=codec['codec'])
+    account_transfer(config.arch_name, variables, 'stream', compressed, time.time() - start)
+
+    # Same hash as archive() gives for the environment
+    ssh(server, "echo %s > %s.sha256" % (content_hash, os.path.join(destination_dir, config.arch_name)))
+
+
+def stream_mode():
+    return '--stream' in flags or getattr(config, 'stream', False)
+
+
+def extract_command(destination_dir, content_hash):
+    """Extract environment archive, keep its content hash to skip upload of the same archive next time"""
+    cmd = "cd %s && %s --totals ." % (destination_dir, untar_command(environment_codec(), config.arch_name, 'm'))
+    if content_hash != '':
+        cmd += " && echo %s > %s.sha256" % (content_hash, config.arch_name)
+    return cmd
+
+
+def run_server(server, variables):
+    mes("Run")
+    ssh(server, replace_variables(variables, config.run_command))
+
+
+def get_flag_value(name, default=None):
+    """Value of --name=value flag"""
+    for flag in flags:
+        if flag.startswith(name + '='):
+            return flag[len(name) + 1:]
+    return default
+
+
 def signal_handler(signal, frame):
+    global interrupted_flag
+    interrupted_flag = True
+    kill_running_processes()
+    ssh_disconnect()
     sys.exit(0)
 
 signal.signal(signal.SIGINT, signal_handler)
+atexit.register(ssh_disconnect)
+
+def deploy_servers():
+    check_group_variables()
+    try:
+        if '--transaction' in flags or getattr(config, 'transaction', False):
+            on_servers(deploy_server_transaction)
+        else:
+            on_servers(deploy_server)
+    finally:
+        transfer_report()
+
+
+def pipeline_mode():
+    return '--pipeline' in flags or getattr(config, 'pipeline', False)
+
+
+def pipeline_tasks(commands):
+    """Compile commands into a task graph
+
+    Per container: build -> push -> deploy and build -> dump -> archive -> upload -> deploy, environment:
+    build-env -> check -> dump -> archive -> upload -> deploy, only dumps in the environment are archived. Upload sends
+    the archive to every server while other containers are built, pushed and dumped. Deploy waits for all previous
+    tasks: imports and run of a server share one inventory and one import session. Other commands and repeated stages
+    wait for all previous tasks, next tasks wait for them.
+    """
+    variables = config.variables
+    tasks = []
+    barrier = set()
+
+    def ids():
+        return {task['id'] for task in tasks}
+
+    def stages():
+        return {task['stage'] for task in tasks}
+
+    def add(task, stage, deps=(), limit=0):
+        """Add task of the stage, ids of container tasks are '<stage> <image reference>'"""
+        if 'stage' not in task:
+            task['id'] = stage + ' ' + task['id']
+            task['deps'] = {stage + ' ' + dep for dep in task['deps']}
+        task['stage'] = stage
+        task['deps'] = task['deps'] | set(deps) | barrier
+        task['limits'] = dict(task.get('limits', {}), **{stage: limit})
+        tasks.append(task)
+
+    for command in commands:
+        if command == 'build-env' and command not in stages():
+            add({'id': 'build-env', 'stage': 'build-env', 'deps': set(), 'prefix': '[build-env] ',
+                 'fn': lambda: (stage_cleanup_temp_dir(), stage_build_environment())}, 'build-env')
+
+        elif command == 'build' and command not in stages():
+            for task in build_tasks(variables, config.containers, True):
+                task['limits'] = {'build host ' + task.pop('slot'): int(config.docker.get('host_build_workers', 0))}
+                add(task, 'build', limit=int(config.docker.get('build_workers', 4)))
+
+        elif command == 'push' and command not in stages():
+            containers = [container for container in config.containers if 'arch_name' not in container]
+            for task in push_tasks(variables, containers, True, pipeline_skipped_pushes):
+                add(task, 'push', {'build ' + task['id']} & ids(), int(config.docker.get('push_workers', 4)))
+
+        elif command == 'deploy' and command not in stages():
+            environment = {'build-env'} & ids()
+            add({'id': 'check', 'stage': 'check', 'deps': set(), 'prefix': '[check] ', 'fn': check_group_variables},
+                'check', environment)
+
+            archived = {'dump ' + docker_image_ref(variables, container) for container in config.containers
+                        if 'arch_name' in container and docker_dump_in_environment(container)}
+            for task in dump_tasks(variables, config.containers, True):
+                add(task, 'dump', ({'build ' + task['id']} & ids()) | environment | {'check'},
+                    int(config.docker.get('dump_workers', 4)))
+
+            if not stream_mode():
+                add({'id': 'archive', 'stage': 'archive', 'deps': set(), 'prefix': '[archive] ',
+                     'fn': lambda: archive(os.path.join(config.temp_dir_archives, config.arch_name),
+                                           config.temp_dir_environment)},
+                    'archive', (archived & ids()) | environment | {'check'})
+                add({'id': 'upload', 'stage': 'upload', 'deps': set(), 'prefix': '[upload] ',
+                     'fn': lambda: on_servers(lambda server, variables: pipeline_uploads.__setitem__(
+                         variables['SERVER_NAME'], upload_environment(server, variables)))},
+                    'upload', {'archive'})
+
+            add({'id': 'deploy', 'stage': 'deploy', 'deps': set(), 'prefix': '[deploy] ', 'fn': deploy_servers},
+                'deploy', ids())
+
+        else:
+            id = command if command not in ids() else "%s %d" % (command, len(tasks))
+            add({'id': id, 'stage': command, 'deps': set(), 'prefix': '', 'fn': (lambda c: lambda: run_stage(c))(command)},
+                command, ids())
+            barrier = {id}
+
+    return tasks
+
+
+def run_pipeline(commands):
+    """Run commands as one task graph: environment, builds, pushes, dumps and uploads overlap"""
+    mes("Start pipeline %s for [%s]" % (",".join(commands), server_name))
+    del pipeline_skipped_pushes[:]
+    pipeline_uploads.clear()
+    tasks = pipeline_tasks(commands)
+    check_task_cycles(tasks)
+
+    # Stages overlap: time of a stage is from the start of its first task to the end of its last task
+    times = {}
+
+    def timed(stage, fn):
+        def run():
+            start = time.time()
+            try:
+                fn()
+            finally:
+                with history_lock:
+                    first, last = times.get(stage, (start, start))
+                    times[stage] = (min(first, start), max(last, time.time()))
+        return run
+
+    for task in tasks:
+        task['fn'] = timed(task['stage'], task['fn'])
+
+    workers = int(getattr(config, 'pipeline_workers', 0)) or sum(max(limit, 1) for limit in (
+        int(config.docker.get('build_workers', 4)),
+        int(config.docker.get('push_workers', 4)),
+        int(config.docker.get('dump_workers', 4)),
+    )) + 3
+    done, failed = run_tasks(tasks, workers)
+
+    with history_lock:
+        history_stages.extend(('pipeline ' + stage, last - first) for stage, (first, last) in times.items())
+
+    pushes = {task['id'] for task in tasks if task['stage'] == 'push'}
+    if pushes:
+        push_report({id[len('push '):] for id in done & pushes}, {id[len('push '):] for id in failed & pushes},
+                    pipeline_skipped_pushes)
+
+    if failed:
+        err("Failed: %s" % ", ".join(sorted(failed)))
+        sys.exit(1)
+
+
+def run_stage(command):
+    """Run one command of the command line"""
+    if command == 'version':
+        mes("Current version is %s" % version)
+
+    elif command == 'update':
+        mes("Checking for updates...")
+        update()
+
+    elif command == 'build-env':
+        stage_cleanup_temp_dir()
+        stage_build_environment()
+
+    elif command == 'build':
+        mes("Start building v%s for [%s]" % (config.variables['VERSION'], server_name))
+
+        mes("Build containers")
+        build_containers(config.variables, config.containers)
+
+    elif command == 'push':
+        mes("Start pushing containers v%s for [%s]" % (config.variables['VERSION'], server_name))
+        mes("Push containers")
+        push_containers(config.variables, [container for container in config.containers if 'arch_name' not in container])
+
+    elif command == 'deploy':
+        mes("Start deploy v%s to [%s]" % (config.variables['VERSION'], server_name))
+
+        deb("Variables: %r" % config.variables)
+        check_group_variables()
+
+        mes("Dump containers")
+        with Span('dump', 'stage'):
+            dump_containers(config.variables, config.containers)
+
+        if not stream_mode():
+            mes("Build archive(s)")
+            with Span('archive', 'stage'):
+                archive(os.path.join(config.temp_dir_archives, config.arch_name), config.temp_dir_environment)
+
+        deploy_servers()
+
+    elif command == 'run':
+        on_servers(run_server)
+
+    elif command == 'watch':
+        stage_watch()
+
+    elif command == 'history':
+        history_report()
+
+    elif command == 'config':
+        mes("Current config")
+        pprint.pprint({var:vars(config)[var] for var in dir(config) if not var.startswith('_')})
+
+    else:
+        if hasattr(config, 'user_commands'):
+            if command in config.user_commands:
+                mes("Start user command: %s, %s, server [%s]" % (command, config.user_commands[command]['place'], server_name))
+                if config.user_commands[command]['place'] == 'remote':
+                    on_servers(lambda server, variables: user_commands(
+                        server,
+                        variables,
+                        config.user_commands[command]['commands'],
+                        'remote'
+                    ))
+                else:
+                    user_commands(
+                        server,
+                        config.variables,
+                        config.user_commands[command]['commands'],
+                        config.user_commands[command]['place']
+                    )
+
 
 def main():
     """Main function to run the deployment process"""
-    global commands, server_name, debug_flag, dry_run_flag, skip_containers_flag, update_flag, config_flag, version_flag
+    global commands, server_name, flags, debug_flag, dry_run_flag, skip_containers_flag, update_flag, config_flag, version_flag
+    global trace_file
 
     # Initialize variables
     commands = []
@@ -454,6 +3477,9 @@ def main():
     update_flag = "--update" in flags
     config_flag = "--config" in flags
     version_flag = "--version" in flags
+    trace_file = get_flag_value('--trace', '')
+    if trace_file:
+        atexit.register(finish_trace)
 
     # Initialize configuration
     init_config(server_name)
@@ -462,11 +3488,11 @@ def main():
         usage()
         exit()
 
-    if 'run' in commands or 'deploy' in commands or 'build' in commands or 'build-env' in commands or 'push' in commands or 'init' in commands:
+    if 'run' in commands or 'deploy' in commands or 'build' in commands or 'build-env' in commands or 'push' in commands or 'init' in commands or 'watch' in commands or 'history' in commands:
         if len(sys.argv) < 3:
             usage()
             exit()
-        if server_name not in config.servers:
+        if len(servers) == 0:
             err("Error: server [%s] not exist in config" % server_name)
             exit()
 
@@ -491,128 +3517,33 @@ def main():
     print("AirShip %s takes of...\n%s" % (version, getattr(config, 'motd', '')))
 
     # -- Commands
-    for command in commands:
-        if command == 'version':
-            mes("Current version is %s" % version)
-
-        elif command == 'update':
-            mes("Checking for updates...")
-            update()
-
-        elif command == 'build-env':
-            stage_cleanup_temp_dir()
-
-            mes("Copy environment files")
-            for file in config.files:
-                file['path'] = os.path.join(config.work_dir, file['path'])
-                file['path'] = replace_variables(config.variables, file['path'])
-
-                file['env_path'] = os.path.join(config.temp_dir_environment, file['env_path'])
-                file['env_path'] = replace_variables(config.variables, file['env_path'])
-
-                if not os.path.exists(file['path']) and not dry_run_flag:
-                    err("File/dir %s not exist" % file['path'])
-                    continue
-
-                deb("Process file/dir: " + file['path'])
-                if os.path.isfile(file['path']):
-                    # @TODO mkdir?
-                    copy_and_replace(config.variables, file)
-
-                if os.path.isdir(file['path']):
-                    copy_dir(file)
-
-                    if 'replace_vars' in file and file['replace_vars']:
-                        for dirFile in find_files_for_replace(file['path'], config.replace_vars_file_patterns):
-                            copy_and_replace(
-                                config.variables,
-                                {
-                                    'path': dirFile,
-                                    'replace_vars': True,
-                                    'env_path': os.path.join(config.temp_dir_environment, file['env_path'],
-                                                             os.path.relpath(dirFile, file['path']))
-                                }
-                            )
-
-        elif command == 'build':
-            mes("Start building v%s for [%s]" % (config.variables['VERSION'], server_name))
-
-            mes("Build containers")
-            for container in config.containers:
-                docker_build(config.variables, container)
-
-        elif command == 'push':
-            mes("Start pushing containers v%s for [%s]" % (config.variables['VERSION'], server_name))
-            mes("Push containers")
-            for container in config.containers:
-                if 'arch_name' not in container:
-                    docker_push(config.variables, container)
-
-        elif command == 'deploy':
-            mes("Start deploy v%s to [%s]" % (config.variables['VERSION'], server_name))
-
-            deb("Variables: %r" % config.variables)
-
-            mes("Dump containers")
-            for container in config.containers:
-                if 'arch_name' in container:
-                    docker_dump(config.variables, container)
-
-            mes("Build archive(s)")
-            archive(os.path.join(config.temp_dir_archives, config.arch_name), config.temp_dir_environment)
-
-            mes("Create destination dir [%s] on destination server" % config.destination_dir)
-            ssh(server, "mkdir -p %s" % config.destination_dir)
-
-            mes("Upload archive")
-            upload(server, "%s/*" % config.temp_dir_archives, "%s/" % config.destination_dir)
-
-            mes("Extract archive")
-            ssh(server, "cd %s && tar -xzf %s --totals ." % (config.destination_dir, config.arch_name))
-
-            for container in config.containers:
-                if 'arch_name' in container:
-                    temp_path = config.temp_dir_environment
-                    if 'deploy_separately' in container and 'deploy_separately' in container and container['deploy_separately']:
-                        temp_path = config.temp_dir_containers
-
-                        temp_path = os.path.join(temp_path, replace_variables(config.variables, container['arch_name']))
-
-                        excludeVariables = {}
-                        for var, val in config.variables.items():
-                            excludeVariables[var] = "*[^" + val + "]"
-
-                        if 'remove_old' in container and container['remove_old']:
-                            ssh(server, "rm -f " + os.path.join(config.destination_dir,
-                                                                replace_variables(excludeVariables, container['arch_name'])))
-
-                        upload(server, temp_path, config.destination_dir,
-                               'ignore_existing' in container and container['ignore_existing'])
-                    docker_import(server, config.variables, container)
-
-                    docker_cleanup_old_versions(server, config.variables, container)
-
-            mes("Run")
-            ssh(server, replace_variables(config.variables, config.run_command))
-
-        elif command == 'run':
-            mes("Run")
-            ssh(server, replace_variables(config.variables, config.run_command))
+    started = time.time()
+    code = 0
+    try:
+        if pipeline_mode():
+            with Span('pipeline', 'stage'):
+                run_pipeline(commands)
+            return
 
-        elif command == 'config':
-            mes("Current config")
-            pprint.pprint({var:vars(config)[var] for var in dir(config) if not var.startswith('_')})
+        for command in commands:
+            with Span(command, 'stage'):
+                run_stage(command)
+    except CommandError as e:
+        err(str(e))
+        code = e.code
+        raise
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 1
+        raise
+    except BaseException:
+        code = 1
+        raise
+    finally:
+        # Ctrl+C exits with 0, the run is recorded as interrupted
+        run_id = save_history(commands, started, 130 if interrupted_flag else code or 0)
+        if code == 0 and not interrupted_flag:
+            report_history_regressions(run_id)
 
-        else:
-            if hasattr(config, 'user_commands'):
-                if command in config.user_commands:
-                    mes("Start user command: %s, %s, server [%s]" % (command, config.user_commands[command]['place'], server_name))
-                    user_commands(
-                        server,
-                        config.variables,
-                        config.user_commands[command]['commands'],
-                        config.user_commands[command]['place']
-                    )
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""Offline benchmark of AirShip overhead
+
+Runs real deploy.py stages against a synthetic project with stub docker, ssh and rsync on PATH, and reports
+wall time and number of spawned processes per stage. Remote commands are executed locally in <root>/remote/<host>.
+
+    python3 tests/benchmark.py --containers 10 --files 2000 --variables 50 --servers 5
+    python3 tests/benchmark.py --save before.json
+    python3 tests/benchmark.py --baseline before.json
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+DEPLOY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'deploy.py')
+
+# Simulated latency of every call (BENCH_LATENCY) and throughput of transfers in bytes/s (BENCH_THROUGHPUT)
+THROTTLE = """
+[ -n "$BENCH_LATENCY" ] && sleep "$BENCH_LATENCY"
+throttle() {
+    [ -n "$BENCH_THROUGHPUT" ] && sleep "$(awk "BEGIN { print $1 / $BENCH_THROUGHPUT }")"
+}
+"""
+
+STUBS = {
+    'docker': """#!/bin/bash
+echo docker >> "$BENCH_ROOT/calls.log"
+""" + THROTTLE + """
+case "$1" in
+    build|buildx) [ -n "$BENCH_BUILD_TIME" ] && sleep "$BENCH_BUILD_TIME";;
+    push) [ -n "$BENCH_PUSH_TIME" ] && sleep "$BENCH_PUSH_TIME";;
+    save)
+        out=/dev/stdout
+        while [ $# -gt 0 ]; do [ "$1" = "-o" ] && out=$2; shift; done
+        head -c "$BENCH_IMAGE_SIZE" /dev/urandom > "$out";;
+    load)
+        if [ "$2" = "-i" ]; then cat "$3" > /dev/null; else cat > /dev/null; fi;;
+    image)
+        case "$*" in *RepoDigests*) echo '[]';; *) echo 'sha256:bench';; esac;;
+esac
+exit 0
+""",
+    'ssh': """#!/bin/bash
+echo ssh >> "$BENCH_ROOT/calls.log"
+""" + THROTTLE + """
+while [ $# -gt 0 ]; do case "$1" in -p|-o|-O) shift 2;; -*) shift;; *) break;; esac; done
+host=$1
+shift
+[ $# -eq 0 ] && exit 0
+mkdir -p "$BENCH_ROOT/remote/$host" && cd "$BENCH_ROOT/remote/$host" || exit 255
+input=$(mktemp -p "$BENCH_ROOT")
+cat > "$input"
+throttle "$(wc -c < "$input")"
+bash -c "$*" < "$input"
+code=$?
+rm -f "$input"
+exit $code
+""",
+    'rsync': """#!/bin/bash
+echo rsync >> "$BENCH_ROOT/calls.log"
+""" + THROTTLE + """
+args=()
+skip=0
+for arg in "$@"; do
+    if [ $skip = 1 ]; then skip=0; continue; fi
+    case "$arg" in -e) skip=1;; -*) ;; *) args+=("$arg");; esac
+done
+n=${#args[@]}
+destination=${args[$((n - 1))]}
+path="$BENCH_ROOT/remote/${destination%%:*}/${destination#*:}"
+mkdir -p "$path"
+for ((i = 0; i < n - 1; i++)); do
+    throttle "$(du -sb "${args[$i]}" | cut -f1)"
+    cp -R "${args[$i]}" "$path/"
+done
+""",
+}
+
+
+def generate_project(root, args):
+    """Write synthetic project: containers, environment files with variables, servers; return path of config.py"""
+    project = os.path.join(root, 'project')
+    variables = ['VAR_%d' % i for i in range(args.variables)]
+
+    containers = []
+    for i in range(args.containers):
+        path = os.path.join(project, 'docker', 'app%d' % i)
+        os.makedirs(path)
+        with open(os.path.join(path, 'Dockerfile'), 'w') as f:
+            f.write('FROM alpine\nARG VERSION\nCOPY . /app\n')
+        with open(os.path.join(path, 'main.py'), 'w') as f:
+            f.write('print(%d)\n' % i)
+
+        container = {
+            'name': 'bench-app%d:$VERSION' % i,
+            'registry': 'localhost:5000',
+            'dockerfile': 'docker/app%d/Dockerfile' % i,
+            'build_path': './',
+            'build_args': ['VERSION=$VERSION'],
+        }
+        if i < args.dumps:
+            container['arch_name'] = 'bench-app%d.tar' % i
+        containers.append(container)
+
+    for i in range(args.files):
+        path = os.path.join(project, 'files', 'dir%d' % (i % 100))
+        os.makedirs(path, exist_ok=True)
+        if i % 2:
+            content = ''.join('%s = ${%s}\n' % (name.lower(), name) for name in variables[i % 10::10]) * 10
+            name = 'file%d.conf' % i
+        else:
+            content = 'static content %d\n' % i * 50
+            name = 'file%d.txt' % i
+        with open(os.path.join(path, name), 'w') as f:
+            f.write(content)
+
+    servers = {}
+    for i in range(args.servers):
+        servers['bench%d' % i] = {'host': 'bench-host%d' % i, 'version': '1.0.0', 'env': 'bench', 'tags': ['bench']}
+
+    config = {
+        'work_dir': project + '/',
+        'temp_dir': os.path.join(root, 'tmp'),
+        'arch_name': 'bench.dist.tar.gz',
+        'destination_dir': 'bench',
+        'variables': dict({'DOCKER_PROJECT_NAME': 'bench'}, **{name: 'value-' + name for name in variables}),
+        'replace_vars_file_patterns': ['.conf$'],
+        'run_command': 'cd $DESTINATION_DIR && true',
+        'docker': {},
+        'containers': containers,
+        'files': [{'path': 'files', 'env_path': 'files', 'replace_vars': True}],
+        'servers': servers,
+        'parallel': args.servers,
+    }
+    with open(os.path.join(root, 'config.py'), 'w') as f:
+        for name, value in config.items():
+            f.write('%s = %r\n' % (name, value))
+
+
+def run_stage(root, env, stage):
+    """Run one stage, return wall time, spawned processes by deploy.py, calls of stubs and duration of the stage span"""
+    trace = os.path.join(root, 'trace-%s.json' % stage)
+    open(os.path.join(root, 'calls.log'), 'w').close()
+
+    start = time.time()
+    with open(os.path.join(root, 'output.log'), 'a') as output:
+        process = subprocess.run([sys.executable, 'deploy.py', 'bench', stage, '--trace=' + trace],
+                                 cwd=root, env=env, stdout=output, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+    wall = time.time() - start
+    if process.returncode != 0:
+        with open(os.path.join(root, 'output.log')) as f:
+            print(f.read()[-3000:])
+        raise SystemExit("Stage %s failed with code %d" % (stage, process.returncode))
+
+    with open(trace) as f:
+        events = json.load(f)['traceEvents']
+    with open(os.path.join(root, 'calls.log')) as f:
+        calls = f.read().split()
+
+    result = {
+        'wall': wall,
+        'stage': sum(event['dur'] for event in events if event.get('cat') == 'stage' and event['name'] == stage) / 1e6,
+        'spawns': len([event for event in events if event.get('cat') in ['command', 'stream']]),
+    }
+    for tool in STUBS:
+        result[tool] = calls.count(tool)
+    return result
+
+
+def benchmark(args):
+    """Run stages repeat times on a fresh project, return median of every stage"""
+    results = {}
+    for i in range(args.repeat):
+        root = tempfile.mkdtemp(prefix='airship-bench-')
+        try:
+            bin_dir = os.path.join(root, 'bin')
+            os.makedirs(bin_dir)
+            for name, script in STUBS.items():
+                with open(os.path.join(bin_dir, name), 'w') as f:
+                    f.write(script)
+                os.chmod(os.path.join(bin_dir, name), 0o755)
+
+            generate_project(root, args)
+            shutil.copy(DEPLOY, os.path.join(root, 'deploy.py'))
+
+            env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ['PATH'], BENCH_ROOT=root,
+                       XDG_CACHE_HOME=os.path.join(root, 'cache'), BENCH_IMAGE_SIZE=str(args.image_size),
+                       BENCH_LATENCY=str(args.latency or ''), BENCH_THROUGHPUT=str(args.throughput or ''),
+                       BENCH_BUILD_TIME=str(args.build_time or ''), BENCH_PUSH_TIME=str(args.push_time or ''))
+
+            for stage in args.stages.split(','):
+                results.setdefault(stage, []).append(run_stage(root, env, stage))
+        finally:
+            if args.keep:
+                print("Benchmark directory: %s" % root)
+            else:
+                shutil.rmtree(root)
+
+    return {stage: {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+            for stage, runs in results.items()}
+
+
+def print_results(stages, baseline=None):
+    print("%-10s %9s %9s %7s %7s %7s %7s" % ('STAGE', 'WALL', 'STAGE', 'SPAWNS', 'DOCKER', 'SSH', 'RSYNC'))
+    for stage, result in stages.items():
+        print("%-10s %8.3fs %8.3fs %7d %7d %7d %7d" % (
+            stage, result['wall'], result['stage'], result['spawns'], result['docker'], result['ssh'], result['rsync']))
+        if baseline and stage in baseline:
+            base = baseline[stage]
+            print("%-10s %+8.1f%% %+8.1f%% %+7d %+7d %+7d %+7d" % (
+                '  vs base', (result['wall'] / base['wall'] - 1) * 100 if base['wall'] else 0,
+                (result['stage'] / base['stage'] - 1) * 100 if base['stage'] else 0,
+                result['spawns'] - base['spawns'], result['docker'] - base['docker'],
+                result['ssh'] - base['ssh'], result['rsync'] - base['rsync']))
+
+
+def regressions(stages, baseline, threshold):
+    """Stages which are slower than baseline by more than threshold or spawn more processes"""
+    found = []
+    for stage, result in stages.items():
+        if stage not in baseline:
+            continue
+        base = baseline[stage]
+        if result['stage'] > base['stage'] * (1 + threshold) and result['stage'] - base['stage'] > 0.05:
+            found.append("%s: %.3fs, baseline %.3fs" % (stage, result['stage'], base['stage']))
+        if result['spawns'] > base['spawns']:
+            found.append("%s: %d spawned processes, baseline %d" % (stage, result['spawns'], base['spawns']))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of AirShip stages')
+    parser.add_argument('--containers', type=int, default=6, help='number of containers')
+    parser.add_argument('--dumps', type=int, default=3, help='number of containers delivered with arch_name')
+    parser.add_argument('--files', type=int, default=1000, help='number of environment files')
+    parser.add_argument('--variables', type=int, default=50, help='number of variables')
+    parser.add_argument('--servers', type=int, default=3, help='number of servers in the group')
+    parser.add_argument('--stages', default='build-env,build,push,deploy', help='comma separated stages to run')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs, median is reported')
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every docker, ssh and rsync call')
+    parser.add_argument('--throughput', type=float, default=0, help='transfer speed of ssh and rsync in bytes/s')
+    parser.add_argument('--build-time', type=float, default=0, help='seconds of every docker build')
+    parser.add_argument('--push-time', type=float, default=0, help='seconds of every docker push')
+    parser.add_argument('--image-size', type=int, default=1024 * 1024, help='bytes of every saved image')
+    parser.add_argument('--save', help='write results to the JSON file')
+    parser.add_argument('--baseline', help='compare with results saved by --save')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown against baseline')
+    parser.add_argument('--keep', action='store_true', help='keep benchmark directory')
+    args = parser.parse_args()
+
+    params = {name: value for name, value in vars(args).items() if name not in ['save', 'baseline', 'threshold', 'keep']}
+    stages = benchmark(args)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            saved = json.load(f)
+        if saved['params'] != params:
+            print("Warning: baseline was made with other parameters: %r" % saved['params'])
+        baseline = saved['stages']
+
+    print_results(stages, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'params': params, 'stages': stages}, f, indent=1)
+
+    if baseline:
+        found = regressions(stages, baseline, args.threshold)
+        for regression in found:
+            print("Regression: " + regression)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
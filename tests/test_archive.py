@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+import gzip
+import io
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import unittest
+
+import deploy
+
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.env = os.path.join(self.dir.name, 'environment')
+        for path, content in [('b.yml', 'b'), ('a/c.conf', 'c'), ('a/b/d', 'd')]:
+            os.makedirs(os.path.dirname(os.path.join(self.env, path)), exist_ok=True)
+            with open(os.path.join(self.env, path), 'w') as f:
+                f.write(content)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def build(self, name):
+        path = os.path.join(self.dir.name, name)
+        content_hash = deploy.archive(path, self.env)
+        with open(path, 'rb') as f:
+            return content_hash, f.read()
+
+    def test_reproducible(self):
+        """Test archive of the same content is the same regardless of mtimes"""
+        first_hash, first = self.build('first.tar.gz')
+        os.utime(os.path.join(self.env, 'a/c.conf'), (1000, 1000))
+        second_hash, second = self.build('second.tar.gz')
+
+        self.assertEqual(first, second)
+        self.assertEqual(first_hash, second_hash)
+        self.assertEqual(deploy.archive_hash(os.path.join(self.dir.name, 'first.tar.gz')), first_hash)
+
+        with open(os.path.join(self.env, 'a/c.conf'), 'w') as f:
+            f.write('changed')
+        self.assertNotEqual(self.build('third.tar.gz')[0], first_hash)
+
+    def test_entries(self):
+        """Test entries are sorted and metadata is normalized"""
+        self.build('env.tar.gz')
+        with tarfile.open(os.path.join(self.dir.name, 'env.tar.gz')) as tar:
+            members = tar.getmembers()
+
+        self.assertEqual([member.name for member in members], ['.', './a', './a/b', './a/b/d', './a/c.conf', './b.yml'])
+        for member in members:
+            self.assertEqual((member.mtime, member.uid, member.gid, member.uname, member.gname), (0, 0, 0, '', ''))
+
+    def test_compress_stream(self):
+        """Test compressed output is counted with gzip module and with pigz writing into a pipe"""
+        bin_dir = os.path.join(self.dir.name, 'bin')
+        os.makedirs(bin_dir)
+        with open(os.path.join(bin_dir, 'pigz'), 'w') as f:
+            f.write('#!/bin/sh\nexec gzip -n -c\n')
+        os.chmod(os.path.join(bin_dir, 'pigz'), 0o755)
+
+        path = os.environ['PATH']
+        try:
+            for bin_path in ['', bin_dir + os.pathsep]:
+                os.environ['PATH'] = bin_path + path
+                data = io.BytesIO()
+                writer = deploy.SizeWriter(data)
+                codec = deploy.compression_codec('gzip:1')
+                self.assertEqual(deploy.compress_stream(writer, lambda gz: gz.write(b'data' * 1000), codec), 4000)
+                self.assertEqual(writer.size, len(data.getvalue()))
+                self.assertEqual(gzip.decompress(data.getvalue()), b'data' * 1000)
+        finally:
+            os.environ['PATH'] = path
+
+    def test_codecs(self):
+        """Test archive of every codec is extracted by its remote command"""
+        codecs = ['none', 'gzip', {'codec': 'gzip', 'level': 1, 'threads': 2}]
+        if shutil.which('zstd'):
+            codecs += ['zstd:19', 'zstd:22']
+
+        saved = getattr(deploy.config, 'compression', None)
+        try:
+            for codec in codecs:
+                deploy.config.compression = codec
+                path = os.path.join(self.dir.name, 'env.tar')
+                self.build('env.tar')
+                target = tempfile.mkdtemp(dir=self.dir.name)
+                command = deploy.untar_command(deploy.environment_codec(), path)
+                subprocess.run(command, shell=True, check=True, cwd=target)
+                with open(os.path.join(target, 'a/b/d')) as f:
+                    self.assertEqual(f.read(), 'd')
+        finally:
+            deploy.config.compression = saved
+
+    def test_codec_settings(self):
+        """Test codec specs, levels and transport compression"""
+        self.assertEqual(deploy.compression_codec('zstd:19'), {'codec': 'zstd', 'level': 19,
+                                                               'threads': deploy.compress_threads()})
+        self.assertEqual(deploy.compression_codec({'codec': 'gzip', 'threads': 3}),
+                         {'codec': 'gzip', 'level': None, 'threads': 3})
+        self.assertEqual(deploy.compression_codec('')['codec'], 'none')
+        self.assertEqual(deploy.untar_command(deploy.compression_codec('zstd'), '-', 'm'), 'zstd -dc | tar -xmf -')
+        self.assertEqual(deploy.untar_command(deploy.compression_codec('gzip'), 'env.tar.gz'), 'tar -xzf env.tar.gz')
+        self.assertTrue(deploy.compressed_codec(deploy.compression_codec('gzip')))
+        self.assertFalse(deploy.compressed_codec(deploy.compression_codec('none')))
+        for spec in ['lz4', 'gzip:10', 'zstd:fast']:
+            with self.assertRaises(SystemExit):
+                deploy.compression_codec(spec)
+
+    def test_stream(self):
+        """Test streamed environment is extracted on the server and accounted like the archive"""
+        bin_dir = os.path.join(self.dir.name, 'bin')
+        os.makedirs(bin_dir)
+        # Remote commands are executed locally
+        with open(os.path.join(bin_dir, 'ssh'), 'w') as f:
+            f.write('#!/bin/bash\nwhile [ $# -gt 0 ]; do case "$1" in -p|-o) shift 2;; -*) shift;; *) break;; esac; done\n'
+                    'shift\nexec bash -c "$*"\n')
+        os.chmod(os.path.join(bin_dir, 'ssh'), 0o755)
+
+        saved = {name: getattr(deploy.config, name, None) for name in
+                 ['compression', 'ssh', 'command_timeout', 'temp_dir_environment', 'arch_name']}
+        path = os.environ['PATH']
+        os.environ['PATH'] = bin_dir + os.pathsep + path
+        deploy.config.ssh = {'multiplexing': False}
+        deploy.config.command_timeout = 0
+        deploy.config.temp_dir_environment = self.env
+        deploy.config.arch_name = 'env.tar'
+        codecs = ['none', 'gzip:6'] + (['zstd:3'] if shutil.which('zstd') else [])
+        try:
+            for codec in codecs:
+                deploy.config.compression = codec
+                deploy.transfer_artifacts.clear()
+                content_hash, data = self.build('env.tar')
+                archived = dict(deploy.transfer_artifacts['env.tar'])
+
+                deploy.transfer_artifacts.clear()
+                destination = os.path.join(self.dir.name, 'remote', codec.replace(':', '-'))
+                deploy.stream_environment({'host': 'localhost'}, {'DESTINATION_DIR': destination,
+                                                                  'SERVER_NAME': 'dev'})
+
+                for name, content in [('b.yml', 'b'), ('a/c.conf', 'c'), ('a/b/d', 'd')]:
+                    with open(os.path.join(destination, name)) as f:
+                        self.assertEqual(f.read(), content)
+                self.assertEqual(deploy.archive_hash(os.path.join(destination, 'env.tar')), content_hash)
+
+                streamed = deploy.transfer_artifacts['env.tar']
+                self.assertEqual((streamed['raw_bytes'], streamed['compressed_bytes'], streamed['codec']),
+                                 (archived['raw_bytes'], len(data), archived['codec']))
+                self.assertEqual([(transfer['server'], transfer['method'], transfer['bytes'])
+                                  for transfer in streamed['transfers']], [('dev', 'stream', len(data))])
+        finally:
+            os.environ['PATH'] = path
+            deploy.transfer_artifacts.clear()
+            for name, value in saved.items():
+                setattr(deploy.config, name, value)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
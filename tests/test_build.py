@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import deploy
+
+
+class TestBuild(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.saved = {name: getattr(deploy.config, name, None) for name in ['docker', 'work_dir']}
+        deploy.config.docker = {}
+        deploy.config.work_dir = self.dir.name
+        self.docker_build, self.out = deploy.docker_build, deploy.out
+        self.output = []
+        deploy.out = lambda text: self.output.append(text)
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(deploy.config, name, value)
+        deploy.docker_build, deploy.out = self.docker_build, self.out
+        self.dir.cleanup()
+
+    def container(self, name, base=None, **options):
+        path = os.path.join(self.dir.name, name, 'Dockerfile')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write('FROM %s\nRUN true\n' % (base or 'alpine:3'))
+        return dict({'name': name + ':$VERSION', 'registry': 'localhost:5000', 'dockerfile': name + '/Dockerfile'},
+                    **options)
+
+    def test_deps(self):
+        """Test base images built in the same run and depends_on are dependencies"""
+        base = self.container('base')
+        app = self.container('app', 'localhost:5000/base:${VERSION}')
+        worker = self.container('worker', depends_on=['app'])
+        other = self.container('other', 'base:1.0.0')
+        containers = [base, app, worker, other]
+        variables = {'VERSION': '1.0.0'}
+
+        deps = {task['id']: task['deps'] for task in deploy.build_tasks(variables, containers, False)}
+        self.assertEqual(deps, {
+            'localhost:5000/base:1.0.0': set(),
+            'localhost:5000/app:1.0.0': {'localhost:5000/base:1.0.0'},
+            'localhost:5000/worker:1.0.0': {'localhost:5000/app:1.0.0'},
+            'localhost:5000/other:1.0.0': {'localhost:5000/base:1.0.0'},
+        })
+
+        with self.assertRaises(SystemExit):
+            deploy.docker_build_deps(variables, self.container('bad', depends_on=['missing']), containers)
+
+    def test_order(self):
+        """Test dependency finishes before its dependents start"""
+        events = []
+        lock = threading.Lock()
+
+        def task(id):
+            def fn():
+                with lock:
+                    events.append(('start', id))
+                time.sleep(0.05)
+                with lock:
+                    events.append(('end', id))
+            return {'id': id, 'fn': fn, 'deps': set()}
+
+        tasks = [task('base'), task('app'), task('worker'), task('other')]
+        tasks[1]['deps'] = {'base'}
+        tasks[2]['deps'] = {'app', 'base'}
+        done, failed = deploy.run_tasks(tasks, 4)
+
+        self.assertEqual((done, failed), ({'base', 'app', 'worker', 'other'}, set()))
+        self.assertLess(events.index(('end', 'base')), events.index(('start', 'app')))
+        self.assertLess(events.index(('end', 'app')), events.index(('start', 'worker')))
+        # Independent task runs at the same time as the first one
+        self.assertLess(events.index(('start', 'other')), events.index(('end', 'base')))
+
+    def test_cycle(self):
+        """Test dependency cycle is rejected before anything runs"""
+        tasks = [{'id': 'a', 'deps': {'b'}}, {'id': 'b', 'deps': {'c'}}, {'id': 'c', 'deps': {'a'}},
+                 {'id': 'd', 'deps': set()}]
+        with self.assertRaises(SystemExit):
+            deploy.check_task_cycles(tasks)
+        self.assertIn('dependency cycle between a, b, c', self.output[-1])
+
+        deploy.check_task_cycles([{'id': 'a', 'deps': {'b', 'external'}}, {'id': 'b', 'deps': set()}])
+
+    def test_workers(self):
+        """Test build_workers limit all builds and host_build_workers builds of every docker host"""
+        running = {}
+        peaks = {}
+        lock = threading.Lock()
+
+        def build(variables, container, base_fingerprints=()):
+            host = container.get('docker_host', '')
+            with lock:
+                running[host] = running.get(host, 0) + 1
+                peaks[host] = max(peaks.get(host, 0), running[host])
+                peaks['total'] = max(peaks.get('total', 0), sum(running.values()))
+            time.sleep(0.05)
+            with lock:
+                running[host] -= 1
+            return ''
+
+        deploy.docker_build = build
+        deploy.config.docker = {'build_workers': 3, 'host_build_workers': 2}
+        containers = [self.container('app%d' % i, docker_host='ssh://host%d' % (i % 2)) for i in range(8)]
+        deploy.build_containers({'VERSION': '1.0.0'}, containers)
+
+        self.assertEqual(peaks, {'ssh://host0': 2, 'ssh://host1': 2, 'total': 3})
+
+    def test_failure(self):
+        """Test dependents of a failed task are skipped and reported, other tasks are run"""
+        def fail():
+            raise SystemExit(2)
+
+        tasks = [
+            {'id': 'base', 'fn': fail, 'deps': set()},
+            {'id': 'app', 'fn': lambda: None, 'deps': {'base'}},
+            {'id': 'worker', 'fn': lambda: None, 'deps': {'app'}},
+            {'id': 'other', 'fn': lambda: None, 'deps': set()},
+        ]
+        done, failed = deploy.run_tasks(tasks, 2)
+
+        self.assertEqual((done, failed), ({'other'}, {'base', 'app', 'worker'}))
+        output = '\n'.join(self.output)
+        self.assertIn('Task base failed with code 2', output)
+        self.assertIn('Skip app: dependency failed', output)
+        self.assertIn('Skip worker: dependency failed', output)
+
+        deploy.docker_build = lambda variables, container, base_fingerprints=(): fail()
+        with self.assertRaises(SystemExit):
+            deploy.build_containers({'VERSION': '1.0.0'}, [self.container('base')])
+        self.assertIn('Failed to build: localhost:5000/base:1.0.0', self.output[-1])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
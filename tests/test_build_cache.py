@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import deploy
+
+# Emulate docker: build counts builds, image ID changes with every build
+DOCKER = """#!/bin/sh
+if [ "$1" = "build" ]; then
+    echo "$@" >> {dir}/builds
+else
+    echo "sha256:$(wc -l < {dir}/builds)"
+fi
+"""
+
+
+class TestBuildCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        bin_dir = os.path.join(self.dir.name, 'bin')
+        os.makedirs(bin_dir)
+        with open(os.path.join(bin_dir, 'docker'), 'w') as f:
+            f.write(DOCKER.replace('{dir}', self.dir.name))
+        os.chmod(os.path.join(bin_dir, 'docker'), 0o755)
+        open(os.path.join(self.dir.name, 'builds'), 'w').close()
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = bin_dir + os.pathsep + self.path
+
+        self.context = os.path.join(self.dir.name, 'app')
+        os.makedirs(os.path.join(self.context, 'logs'))
+        self.write('Dockerfile', 'FROM alpine\nCOPY . /app\n')
+        self.write('main.py', 'print(1)\n')
+        self.write('.dockerignore', 'logs\n*.tmp\n')
+
+        self.saved = {name: getattr(deploy.config, name, None) for name in ['docker', 'work_dir']}
+        deploy.config.docker = {'build_cache_dir': os.path.join(self.dir.name, 'cache')}
+        deploy.config.work_dir = self.dir.name
+        self.flags = deploy.flags
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        for name, value in self.saved.items():
+            setattr(deploy.config, name, value)
+        deploy.flags = self.flags
+        self.dir.cleanup()
+
+    def write(self, name, content):
+        with open(os.path.join(self.context, name), 'w') as f:
+            f.write(content)
+
+    def build(self, version='1.0.0', **options):
+        """Build the container, return number of docker builds so far"""
+        deploy.docker_build({'VERSION': version, 'LIB_DIR': 'lib'}, dict({
+            'name': 'app:$VERSION', 'registry': 'localhost:5000', 'dockerfile': 'app/Dockerfile',
+            'build_path': './', 'build_args': ['VERSION=$VERSION'],
+        }, **options))
+        with open(os.path.join(self.dir.name, 'builds')) as f:
+            return len(f.readlines())
+
+    def test_build_cache(self):
+        """Test build is skipped only if inputs are not changed"""
+        self.assertEqual(self.build(), 1)
+        self.assertEqual(self.build(), 1)
+
+        self.write('logs/app.log', 'ignored')
+        self.write('cache.tmp', 'ignored')
+        self.assertEqual(self.build(), 1)
+
+        self.write('main.py', 'print(2)\n')
+        self.assertEqual(self.build(), 2)
+        self.assertEqual(self.build(), 2)
+
+        self.write('Dockerfile', 'FROM alpine:3\nCOPY . /app\n')
+        self.assertEqual(self.build(), 3)
+
+        deploy.flags = ['--force-build']
+        self.assertEqual(self.build(), 4)
+        # Fingerprint of the forced build is recorded
+        deploy.flags = []
+        self.assertEqual(self.build(), 4)
+
+    def test_build_contexts(self):
+        """Test contents of build contexts with variables are inputs of the build"""
+        lib = os.path.join(self.dir.name, 'lib')
+        os.makedirs(lib)
+        with open(os.path.join(lib, 'util.py'), 'w') as f:
+            f.write('print(1)\n')
+        contexts = {'build_contexts': ['lib=$LIB_DIR']}
+        self.assertEqual(self.build(**contexts), 1)
+        self.assertEqual(self.build(**contexts), 1)
+
+        with open(os.path.join(lib, 'util.py'), 'w') as f:
+            f.write('print(2)\n')
+        self.assertEqual(self.build(**contexts), 2)
+        self.assertEqual(self.build(**contexts), 2)
+
+        # Docker gets the same directory which is hashed
+        with open(os.path.join(self.dir.name, 'builds')) as f:
+            self.assertIn('--build-context lib=%s ' % lib, f.readlines()[-1])
+        self.assertEqual(deploy.build_context_path('base=docker-image://alpine:3'), 'base=docker-image://alpine:3')
+        self.assertEqual(deploy.build_context_path('src=https://github.com/fish/app.git'),
+                         'src=https://github.com/fish/app.git')
+
+    def test_dry_run(self):
+        """Test dry run does not read build inputs"""
+        os.unlink(os.path.join(self.context, 'Dockerfile'))
+        deploy.dry_run_flag = True
+        try:
+            self.assertEqual(self.build(), 0)
+        finally:
+            deploy.dry_run_flag = False
+
+    def test_dockerignore(self):
+        """Test .dockerignore matching"""
+        patterns = [(True, 'logs'), (True, '*.tmp'), (True, 'docs'), (False, 'docs/README.md')]
+        self.assertTrue(deploy.dockerignore_match(patterns, 'logs/app.log'))
+        self.assertTrue(deploy.dockerignore_match(patterns, 'cache.tmp'))
+        self.assertTrue(deploy.dockerignore_match(patterns, 'docs/index.md'))
+        self.assertFalse(deploy.dockerignore_match(patterns, 'docs/README.md'))
+        self.assertFalse(deploy.dockerignore_match(patterns, 'main.py'))
+
+
+# Emulate docker buildx: plain progress output, local cache export writes index.json
+BUILDX = """#!/bin/sh
+echo "$@" >> {dir}/args
+if [ "$1" = "buildx" ]; then
+    echo '#1 [internal] load build definition from Dockerfile'
+    echo '#5 [1/3] FROM docker.io/library/alpine'
+    echo '#6 [2/3] COPY . /app'
+    echo '#6 CACHED'
+    echo '#7 [3/3] RUN make'
+    echo '#7 DONE 1.2s'
+    for arg in "$@"; do
+        case "$arg" in type=local,dest=*) dest=${arg#type=local,dest=}; mkdir -p "${dest%%,*}"; echo '{}' > "${dest%%,*}/index.json";; esac
+    done
+else
+    echo "sha256:1"
+fi
+"""
+
+
+class TestBuildxCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        bin_dir = os.path.join(self.dir.name, 'bin')
+        os.makedirs(bin_dir)
+        with open(os.path.join(bin_dir, 'docker'), 'w') as f:
+            f.write(BUILDX.replace('{dir}', self.dir.name))
+        os.chmod(os.path.join(bin_dir, 'docker'), 0o755)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = bin_dir + os.pathsep + self.path
+
+        os.makedirs(os.path.join(self.dir.name, 'app'))
+        with open(os.path.join(self.dir.name, 'app', 'Dockerfile'), 'w') as f:
+            f.write('FROM alpine\n')
+
+        self.cache_dir = os.path.join(self.dir.name, 'buildx')
+        self.saved = {name: getattr(deploy.config, name, None) for name in ['docker', 'work_dir']}
+        deploy.config.docker = {'build_cache': False, 'buildx': True,
+                                'buildx_cache': {'type': 'local', 'dir': self.cache_dir}}
+        deploy.config.work_dir = self.dir.name
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        for name, value in self.saved.items():
+            setattr(deploy.config, name, value)
+        self.dir.cleanup()
+
+    def build(self, **options):
+        deploy.docker_build({}, dict({'name': 'app:1.0.0', 'registry': 'localhost:5000', 'dockerfile': 'app/Dockerfile',
+                                      'build_path': './', 'build_args': []}, **options))
+        with open(os.path.join(self.dir.name, 'args')) as f:
+            return [line for line in f if line.startswith('buildx ')][-1]
+
+    def test_local(self):
+        """Test local cache is imported from the previous build and replaced by the new one"""
+        cache = os.path.join(self.cache_dir, 'localhost_5000_app')
+        args = self.build()
+        self.assertIn('--cache-to type=local,dest=%s.new,mode=max' % cache, args)
+        self.assertNotIn('--cache-from', args)
+        self.assertTrue(os.path.isfile(os.path.join(cache, 'index.json')))
+        self.assertFalse(os.path.exists(cache + '.new'))
+
+        self.assertIn('--cache-from type=local,src=%s ' % cache, self.build())
+        self.assertNotIn('--cache-', self.build(buildx_cache=False))
+
+    def test_shared_cache(self):
+        """Test builds of tags of the same repository do not use the local cache at the same time"""
+        run = deploy.run
+        running = {'builds': 0, 'peak': 0}
+        lock = threading.Lock()
+
+        def build(command, *args, **kwargs):
+            if ' buildx build ' not in command:
+                return run(command, *args, **kwargs)
+            with lock:
+                running['builds'] += 1
+                running['peak'] = max(running['peak'], running['builds'])
+            time.sleep(0.1)
+            try:
+                return run(command, *args, **kwargs)
+            finally:
+                with lock:
+                    running['builds'] -= 1
+
+        deploy.run = build
+        try:
+            tasks = [{'id': tag, 'deps': set(), 'fn': (lambda tag: lambda: self.build(name='app:' + tag))(tag)}
+                     for tag in ['1.0.0', '1.0.1']]
+            tasks.append({'id': 'other', 'deps': set(), 'fn': lambda: self.build(name='other:1.0.0')})
+            self.assertEqual(deploy.run_tasks(tasks, 3), ({'1.0.0', '1.0.1', 'other'}, set()))
+        finally:
+            deploy.run = run
+
+        self.assertEqual(running['peak'], 2)
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), ['localhost_5000_app', 'localhost_5000_other'])
+
+    def test_registry(self):
+        """Test registry cache reference"""
+        args = self.build(buildx_cache={'type': 'registry'})
+        self.assertIn('--cache-from type=registry,ref=localhost:5000/app:buildcache '
+                      '--cache-to type=registry,ref=localhost:5000/app:buildcache,mode=max', args)
+
+    def test_steps(self):
+        """Test cached steps are counted from plain progress output"""
+        steps = {}
+        on_line = deploy.buildx_step_counter(steps)
+        for line in ['#1 [internal] load build definition', '#5 [1/3] FROM alpine', '#6 [app 2/3] COPY . /app',
+                     '#6 CACHED', '#7 [3/3] RUN make', '#7 DONE 1.2s']:
+            self.assertFalse(on_line(line))
+        self.assertEqual(steps, {'5': False, '6': True, '7': False})
+
+    def test_prune(self):
+        """Test least recently built caches are removed until the directory fits the budget"""
+        for i, name in enumerate(['old', 'middle', 'new']):
+            os.makedirs(os.path.join(self.cache_dir, name))
+            with open(os.path.join(self.cache_dir, name, 'blob'), 'wb') as f:
+                f.write(b'x' * 1024)
+            os.utime(os.path.join(self.cache_dir, name), (1000 + i, 1000 + i))
+
+        self.assertEqual(deploy.prune_buildx_cache(self.cache_dir, 2048, os.path.join(self.cache_dir, 'old')), ['middle'])
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), ['new', 'old'])
+        self.assertEqual(deploy.parse_size('1.5K'), 1536)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
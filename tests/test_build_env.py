@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+
+import deploy
+
+
+class TestBuildEnvironment(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.work_dir = os.path.join(self.dir.name, 'work')
+        os.makedirs(os.path.join(self.work_dir, 'nginx/conf.d'))
+        self.write('docker-compose.yml', 'image: app:${VERSION}\n')
+        self.write('nginx/conf.d/site.conf', 'server_name ${DOMAIN};\n')
+        self.write('nginx/mime.types', 'types ${DOMAIN}\n')
+
+        # Minimal config emulation for tests
+        self.config = {name: getattr(deploy.config, name) for name in
+                       ['work_dir', 'temp_dir', 'files', 'variables', 'replace_vars_file_patterns']}
+        deploy.config.work_dir = self.work_dir
+        deploy.config.temp_dir = os.path.join(self.dir.name, 'tmp')
+        deploy.config.temp_dir_environment = os.path.join(deploy.config.temp_dir, 'environment')
+        deploy.config.files = [
+            {'path': 'docker-compose.yml', 'env_path': 'docker-compose.yml', 'replace_vars': True},
+            {'path': 'nginx', 'env_path': 'nginx', 'replace_vars': True},
+        ]
+        deploy.config.variables = {'VERSION': '1.0.0', 'DOMAIN': 'fish.local'}
+        deploy.config.replace_vars_file_patterns = ['.conf$', '.yml$']
+        os.makedirs(deploy.config.temp_dir_environment)
+
+    def tearDown(self):
+        for name, value in self.config.items():
+            setattr(deploy.config, name, value)
+        self.dir.cleanup()
+
+    def write(self, path, content):
+        with open(os.path.join(self.work_dir, path), 'w') as f:
+            f.write(content)
+
+    def read(self, path):
+        with open(os.path.join(deploy.config.temp_dir_environment, path)) as f:
+            return f.read()
+
+    def mtimes(self):
+        result = {}
+        for root, dirs, files in os.walk(deploy.config.temp_dir_environment):
+            for name in files:
+                result[os.path.join(root, name)] = os.stat(os.path.join(root, name)).st_mtime_ns
+        return result
+
+    def test_build(self):
+        """Test files are rendered or copied"""
+        deploy.stage_build_environment()
+
+        self.assertEqual(self.read('docker-compose.yml'), 'image: app:1.0.0\n')
+        self.assertEqual(self.read('nginx/conf.d/site.conf'), 'server_name fish.local;\n')
+        self.assertEqual(self.read('nginx/mime.types'), 'types ${DOMAIN}\n')
+
+    def test_incremental(self):
+        """Test only files with changed source or variables are rebuilt, stale files are removed"""
+        deploy.stage_build_environment()
+        built = self.mtimes()
+
+        deploy.stage_build_environment()
+        self.assertEqual(self.mtimes(), built, "Nothing should be rebuilt")
+
+        deploy.config.variables['DOMAIN'] = 'fish.com'
+        deploy.stage_build_environment()
+        rebuilt = self.mtimes()
+        self.assertEqual(self.read('nginx/conf.d/site.conf'), 'server_name fish.com;\n')
+        self.assertEqual([path for path in built if built[path] != rebuilt[path]],
+                         [os.path.join(deploy.config.temp_dir_environment, 'nginx/conf.d/site.conf')])
+
+        os.unlink(os.path.join(self.work_dir, 'nginx/mime.types'))
+        deploy.stage_build_environment()
+        self.assertFalse(os.path.exists(os.path.join(deploy.config.temp_dir_environment, 'nginx/mime.types')))
+
+    def test_pattern_added(self):
+        """Test file which becomes rendered by a new pattern is rebuilt when its variables change"""
+        deploy.config.replace_vars_file_patterns = ['.yml$']
+        deploy.stage_build_environment()
+        self.assertEqual(self.read('nginx/conf.d/site.conf'), 'server_name ${DOMAIN};\n')
+
+        deploy.config.replace_vars_file_patterns.append('.conf$')
+        deploy.stage_build_environment()
+        self.assertEqual(self.read('nginx/conf.d/site.conf'), 'server_name fish.local;\n')
+
+        deploy.config.variables['DOMAIN'] = 'fish.com'
+        self.assertEqual(deploy.stage_build_environment(),
+                         [os.path.join(deploy.config.temp_dir_environment, 'nginx/conf.d/site.conf')])
+        self.assertEqual(self.read('nginx/conf.d/site.conf'), 'server_name fish.com;\n')
+
+    def test_links(self):
+        """Test plain files are hard linked only with hardlink mode, source is not changed when the file becomes
+        rendered"""
+        source = os.path.join(self.work_dir, 'nginx/mime.types')
+        env_file = os.path.join(deploy.config.temp_dir_environment, 'nginx/mime.types')
+        deploy.stage_build_environment()
+        self.assertNotEqual(os.stat(source).st_ino, os.stat(env_file).st_ino)
+        self.assertEqual(self.read('nginx/mime.types'), 'types ${DOMAIN}\n')
+
+        deploy.config.env_link = 'hardlink'
+        try:
+            os.unlink(os.path.join(deploy.config.temp_dir, 'build-cache.json'))
+            deploy.stage_build_environment()
+            self.assertEqual(os.stat(source).st_ino, os.stat(env_file).st_ino)
+
+            deploy.config.replace_vars_file_patterns.append('types$')
+            deploy.stage_build_environment()
+        finally:
+            del deploy.config.env_link
+        self.assertEqual(self.read('nginx/mime.types'), 'types fish.local\n')
+        with open(source) as f:
+            self.assertEqual(f.read(), 'types ${DOMAIN}\n')
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
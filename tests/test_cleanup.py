@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 
 from deploy import docker_cleanup_old_versions, mes, err, deb
+import os
 import subprocess
+import tempfile
 import unittest
 
 # Minimal config emulation for tests
@@ -16,9 +18,13 @@ def test_ssh(server, command):
     except subprocess.CalledProcessError as e:
         print(f"Command execution error: {e}")
 
-# Replace real ssh function with test one
+def test_ssh_output(server, command):
+    return subprocess.check_output(command, shell=True).decode()
+
+# Replace real ssh functions with test ones
 import deploy
 deploy.ssh = test_ssh
+deploy.ssh_output = test_ssh_output
 
 def get_image_tags(image_name):
     """Get list of tags for specified image"""
@@ -30,24 +36,22 @@ def create_test_images():
     """Create test Docker images for cleanup function testing"""
     print("\n=== Creating test images ===")
     
-    # Create simple Dockerfile
-    with open("Dockerfile.test", "w") as f:
-        f.write("FROM alpine:latest\nCMD [\"echo\", \"test\"]")
-    
-    # List of versions and tags to create
-    versions = ["1.0.0", "1.0.1", "1.0.2"]
-    
-    for version in versions:
-        # Create regular version
-        cmd = f"docker build -t localhost:5000/test-app:{version} -f Dockerfile.test ."
-        subprocess.run(cmd, shell=True, check=True)
-        
-        # Create prod version
-        cmd = f"docker build -t localhost:5000/test-app:{version}-prod -f Dockerfile.test ."
-        subprocess.run(cmd, shell=True, check=True)
-    
-    # Remove temporary Dockerfile
-    subprocess.run("rm Dockerfile.test", shell=True)
+    # Create simple Dockerfile in a temporary directory, removed even if a build fails
+    with tempfile.TemporaryDirectory() as build_dir:
+        with open(os.path.join(build_dir, "Dockerfile.test"), "w") as f:
+            f.write("FROM alpine:latest\nCMD [\"echo\", \"test\"]")
+        
+        # List of versions and tags to create
+        versions = ["1.0.0", "1.0.1", "1.0.2"]
+        
+        for version in versions:
+            # Create regular version
+            cmd = f"docker build -t localhost:5000/test-app:{version} -f {build_dir}/Dockerfile.test {build_dir}"
+            subprocess.run(cmd, shell=True, check=True)
+            
+            # Create prod version
+            cmd = f"docker build -t localhost:5000/test-app:{version}-prod -f {build_dir}/Dockerfile.test {build_dir}"
+            subprocess.run(cmd, shell=True, check=True)
     
     print("Test images created successfully")
 
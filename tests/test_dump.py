@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import gzip
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import deploy
+
+# Emulate docker: save writes image name, load saves its input, image inspect prints image ID
+DOCKER = """#!/bin/sh
+if [ "$1" = "save" ]; then
+    if [ "$3" = "-o" ]; then echo "image $2" > "$4"; else echo "image $2"; fi
+elif [ "$1" = "image" ]; then
+    echo "sha256:$(echo "$@" | sha256sum | cut -d ' ' -f 1)"
+elif [ "$2" = "-i" ]; then
+    cat "$3" > loaded.tar
+else
+    cat > loaded.tar
+fi
+"""
+
+
+class TestDump(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        bin_dir = os.path.join(self.dir.name, 'bin')
+        os.makedirs(bin_dir)
+        with open(os.path.join(bin_dir, 'docker'), 'w') as f:
+            f.write(DOCKER)
+        os.chmod(os.path.join(bin_dir, 'docker'), 0o755)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = bin_dir + os.pathsep + self.path
+
+        self.saved = {name: getattr(deploy.config, name, None)
+                      for name in ['docker', 'temp_dir_environment', 'temp_dir_containers']}
+        deploy.config.docker = {'dump_workers': 3}
+        deploy.config.temp_dir_environment = self.dir.name
+        deploy.config.temp_dir_containers = self.dir.name
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        for name, value in self.saved.items():
+            setattr(deploy.config, name, value)
+        self.dir.cleanup()
+
+    def container(self, name, compress):
+        return {'name': name + ':1.0.0', 'registry': 'localhost:5000', 'arch_name': name + '.tar', 'compress': compress}
+
+    def load(self, container):
+        """Run remote import command, return loaded data"""
+        command = deploy.docker_import_command({'DESTINATION_DIR': self.dir.name}, container)
+        subprocess.run(command, shell=True, check=True, cwd=self.dir.name)
+        with open(os.path.join(self.dir.name, 'loaded.tar'), 'rb') as f:
+            return f.read()
+
+    def test_dump(self):
+        """Test containers are dumped with their compression and loaded back"""
+        containers = [self.container('plain', ''), self.container('gz', 'gzip')]
+        if shutil.which('zstd'):
+            containers.append(self.container('zst', 'zstd'))
+
+        deploy.dump_containers({}, containers)
+        self.assertTrue(all(deploy.dumped_image_ids[os.path.join(self.dir.name, container['arch_name'])]
+                            .startswith('sha256:') for container in containers if container['compress']))
+
+        with open(os.path.join(self.dir.name, 'gz.tar'), 'rb') as f:
+            self.assertEqual(gzip.decompress(f.read()), b'image localhost:5000/gz:1.0.0\n')
+        for container in containers:
+            if container['compress'] != 'gzip':
+                self.assertEqual(self.load(container), b'image localhost:5000/%s\n' % container['name'].encode())
+
+    def test_sizes(self):
+        """Test raw and compressed sizes of dumps are accounted"""
+        deploy.transfer_artifacts.clear()
+        deploy.dump_containers({}, [self.container('plain', ''), self.container('gz', 'gzip')])
+
+        gz = deploy.transfer_artifacts['gz.tar']
+        self.assertEqual((gz['kind'], gz['raw_bytes']), ('image', len(b'image localhost:5000/gz:1.0.0\n')))
+        self.assertEqual(gz['compressed_bytes'], os.path.getsize(os.path.join(self.dir.name, 'gz.tar')))
+        plain = deploy.transfer_artifacts['plain.tar']
+        self.assertEqual((plain['raw_bytes'], plain['compressed_bytes'], plain['ratio']), (33, 33, 1.0))
+        deploy.transfer_artifacts.clear()
+
+    def test_unknown_compression(self):
+        """Test unknown compression is rejected"""
+        with self.assertRaises(SystemExit):
+            deploy.dump_compression(self.container('app', 'lz4'))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+import contextlib
+import os
+import tempfile
+import time
+import unittest
+
+import deploy
+
+
+class TestHistory(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.saved = {name: getattr(deploy.config, name, None) for name in ['history', 'work_dir', 'variables']}
+        deploy.config.history = {'file': os.path.join(self.dir.name, 'history.sqlite'), 'keep': 3}
+        deploy.config.work_dir = self.dir.name
+        deploy.config.variables = {'VERSION': '1.0.0'}
+        deploy.server_name = 'dev'
+        self.clear()
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(deploy.config, name, value)
+        deploy.server_name = ''
+        self.clear()
+        self.dir.cleanup()
+
+    def clear(self):
+        del deploy.history_stages[:]
+        deploy.history_counters.clear()
+        deploy.transfer_artifacts.clear()
+
+    def load(self, limit=10):
+        with contextlib.closing(deploy.open_history()) as db:
+            return deploy.load_history(db, 'dev', limit)
+
+    def test_save(self):
+        """Test stages, artifacts, counters and exit status of runs are saved, only the newest keep runs are kept"""
+        with deploy.Span('build', 'stage'):
+            deploy.count('build_cache_hits')
+            deploy.count('build_cache_hits')
+        deploy.account_artifact('app.tar', 'image', 1000, 400)
+        deploy.account_transfer('app.tar', {'SERVER_NAME': 'dev'}, 'rsync', 400, 1)
+
+        self.assertIsNotNone(deploy.save_history(['build', 'deploy'], time.time() - 5, 0))
+        run = self.load()[0]
+        self.assertEqual((run['version'], run['commands'], run['code']), ('1.0.0', 'build,deploy', 0))
+        self.assertGreaterEqual(run['duration'], 5)
+        self.assertEqual(list(run['stages']), ['build'])
+        self.assertEqual(run['artifacts'], {'app.tar': (400, 400)})
+        self.assertEqual(run['counters'], {'build_cache_hits': 2})
+
+        for code in [1, 0, 0, 0]:
+            deploy.save_history(['deploy'], time.time(), code)
+        runs = self.load()
+        self.assertEqual([run['code'] for run in runs], [0, 0, 0])
+        with contextlib.closing(deploy.open_history()) as db:
+            self.assertEqual(db.execute("SELECT COUNT(*) FROM artifacts").fetchone()[0], 3)
+
+    def test_skip(self):
+        """Test runs of informational commands and dry runs are not saved"""
+        self.assertIsNone(deploy.save_history(['history'], time.time(), 0))
+        deploy.dry_run_flag = True
+        try:
+            self.assertIsNone(deploy.save_history(['deploy'], time.time(), 0))
+        finally:
+            deploy.dry_run_flag = False
+        self.assertFalse(os.path.exists(deploy.config.history['file']))
+
+    def test_trends(self):
+        """Test stages and artifacts past the percentile of previous successful runs are regressions"""
+        def run(build, push, size, code=0):
+            return {'code': code, 'stages': {'build': build, 'push': push}, 'artifacts': {'app.tar': (size, size)}}
+
+        previous = [run(60 + i, 2 + i * 0.1, 1000, 0) for i in range(6)] + [run(500, 50, 5000, 1)]
+        trends = {row[1]: row for row in deploy.history_trends([run(100, 3, 2000)] + previous, 90)}
+
+        self.assertEqual(trends['build'][2:], (100, 62.5, 64.5, 6, True))
+        # Slower than p90, but by less than min_seconds
+        self.assertFalse(trends['push'][6])
+        self.assertTrue(trends['app.tar'][6])
+
+        trends = {row[1]: row for row in deploy.history_trends([run(100, 3, 2000)] + previous[:3], 90)}
+        self.assertFalse(trends['build'][6])
+        self.assertEqual(deploy.history_trends([run(1, 1, 1)], 90)[0][3:], (None, None, 0, False))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+import io
+import json
+import os
+import subprocess
+import tarfile
+import tempfile
+import time
+import unittest
+
+import deploy
+
+IMAGE_ID = 'sha256:' + 'a' * 64
+
+
+class TestImport(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.saved = {name: getattr(deploy.config, name, None)
+                      for name in ['docker', 'temp_dir_environment', 'temp_dir_containers']}
+        deploy.config.docker = {}
+        deploy.config.temp_dir_environment = self.dir.name
+        deploy.config.temp_dir_containers = self.dir.name
+        self.container = {'name': 'app:1.0.0', 'registry': 'localhost:5000', 'arch_name': 'app.tar'}
+        deploy.dumped_image_ids[os.path.join(self.dir.name, 'app.tar')] = IMAGE_ID
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(deploy.config, name, value)
+        deploy.dumped_image_ids.clear()
+        self.dir.cleanup()
+
+    def test_image_id(self):
+        """Test image ID is the config digest of the saved image"""
+        path = os.path.join(self.dir.name, 'saved.tar')
+        for config_name in ['blobs/sha256/' + 'b' * 64, 'b' * 64 + '.json']:
+            with tarfile.open(path, 'w') as tar:
+                data = json.dumps([{'Config': config_name, 'Layers': []}]).encode()
+                info = tarfile.TarInfo('manifest.json')
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+            self.assertEqual(deploy.docker_dump_image_id('', 'app', path, deploy.compression_codec('')), 'sha256:' + 'b' * 64)
+
+        with open(path, 'w') as f:
+            f.write('not a tar')
+        self.assertEqual(deploy.docker_dump_image_id('', 'app', path, deploy.compression_codec('')), '')
+
+    def test_action(self):
+        """Test import is skipped if the server has the same image, tagged if it has it with other tag"""
+        def action(*images):
+            inventory = {'images': [{'Repository': repository, 'Tag': tag, 'ID': image_id}
+                                    for repository, tag, image_id in images], 'containers': []}
+            return deploy.docker_import_action({}, self.container, inventory)
+
+        self.assertEqual(action(('localhost:5000/app', '1.0.0', IMAGE_ID)), 'skip')
+        self.assertEqual(action(('localhost:5000/app', '0.9.0', IMAGE_ID)), 'tag')
+        self.assertEqual(action(('localhost:5000/app', '1.0.0', 'sha256:other')), 'load')
+        self.assertEqual(action(), 'load')
+
+        deploy.dumped_image_ids.clear()
+        self.assertEqual(action(('localhost:5000/app', '1.0.0', '')), 'load')
+
+    def test_guard(self):
+        """Test load runs only if the server does not have the image"""
+        bin_dir = os.path.join(self.dir.name, 'bin')
+        os.makedirs(bin_dir)
+        with open(os.path.join(bin_dir, 'docker'), 'w') as f:
+            f.write('#!/bin/sh\necho "$REMOTE_ID"\n')
+        os.chmod(os.path.join(bin_dir, 'docker'), 0o755)
+
+        command = deploy.docker_import_guard({}, self.container, 'echo loaded')
+        for remote_id, output in [(IMAGE_ID, ''), ('', 'loaded\n'), ('sha256:other', 'loaded\n')]:
+            env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ['PATH'], REMOTE_ID=remote_id)
+            self.assertEqual(subprocess.run(['bash', '-c', command], env=env, capture_output=True, text=True,
+                                            check=True).stdout, output)
+
+    def test_parallel(self):
+        """Test commands run at the same time within the limit, output is prefixed and failures are reported"""
+        def run(commands, workers):
+            start = time.time()
+            process = subprocess.run(['bash', '-c', deploy.parallel_command(commands, workers)],
+                                     capture_output=True, text=True)
+            return process.returncode, sorted(process.stdout.split('\n')[:-1]), time.time() - start
+
+        commands = [('a', 'sleep 0.5; echo done'), ('b', 'sleep 0.5; echo done'), ('c', 'sleep 0.5; echo done')]
+        code, output, duration = run(commands, 3)
+        self.assertEqual((code, output), (0, ['[a] done', '[b] done', '[c] done']))
+        self.assertLess(duration, 1.4)
+
+        code, output, duration = run(commands, 1)
+        self.assertGreaterEqual(duration, 1.4)
+
+        code, output, duration = run([('a', 'exit 3'), ('b', 'echo ok')], 2)
+        self.assertEqual((code, output), (1, ['[b] ok']))
+        self.assertEqual(deploy.parallel_command([('a', 'echo ok')], 2), 'echo ok')
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
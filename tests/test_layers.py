@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+import hashlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import unittest
+
+import deploy
+
+
+def add_file(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def create_image(path, layers, oci=True):
+    """Create docker save archive with given layer contents"""
+    names = []
+    with tarfile.open(path, 'w') as tar:
+        for i, data in enumerate(layers):
+            name = 'blobs/sha256/' + hashlib.sha256(data).hexdigest() if oci else 'layer%d/layer.tar' % i
+            if name not in names:
+                add_file(tar, name, data)
+            names.append(name)
+        add_file(tar, 'config.json', b'{}')
+        add_file(tar, 'manifest.json', json.dumps([{'Config': 'config.json', 'Layers': names}]).encode())
+
+
+def read_image(path):
+    with tarfile.open(path) as tar:
+        return {member.name.lstrip('./'): tar.extractfile(member).read()
+                for member in tar.getmembers() if member.isfile() or member.islnk()}
+
+
+class TestLayers(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.store = os.path.join(self.dir.name, 'store')
+
+        # Emulate docker load: save loaded image
+        bin_dir = os.path.join(self.dir.name, 'bin')
+        os.makedirs(bin_dir)
+        with open(os.path.join(bin_dir, 'docker'), 'w') as f:
+            f.write('#!/bin/sh\ncat > %s/loaded.tar\n' % self.dir.name)
+        os.chmod(os.path.join(bin_dir, 'docker'), 0o755)
+        self.env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ['PATH'])
+
+        self.docker, deploy.config.docker = deploy.config.docker, {'layer_store': self.store, 'layer_store_days': 0}
+
+    def tearDown(self):
+        deploy.config.docker = self.docker
+        self.dir.cleanup()
+
+    def transfer(self, image, remote):
+        """Transfer image to the store, return number of sent layers"""
+        layers = deploy.docker_layers(image)
+        missing = set(layers.values()) - remote
+        data = io.BytesIO()
+        sent = deploy.write_layers(data, image, 'app.tar', layers, missing)
+
+        data.seek(0)
+        with tarfile.open(fileobj=data) as tar:
+            tar.extractall(self.store)
+
+        command = deploy.docker_layers_import_command({}, {'arch_name': 'app.tar'})
+        subprocess.run(command, shell=True, check=True, env=self.env, cwd=self.dir.name)
+        return sent
+
+    def test_transfer(self):
+        """Test only missing layers are sent and the image is rebuilt"""
+        for oci in [True, False]:
+            shutil.rmtree(self.store, ignore_errors=True)
+            image = os.path.join(self.dir.name, 'app.tar')
+            create_image(image, [b'base', b'app-1', b'base'], oci)
+            self.assertEqual(self.transfer(image, set()), 2)
+            self.assertEqual(read_image(os.path.join(self.dir.name, 'loaded.tar')), read_image(image))
+
+            create_image(image, [b'base', b'app-2', b'base'], oci)
+            remote = set(os.listdir(os.path.join(self.store, 'blobs')))
+            self.assertEqual(self.transfer(image, remote), 1)
+            self.assertEqual(read_image(os.path.join(self.dir.name, 'loaded.tar')), read_image(image))
+            self.assertEqual(os.listdir(os.path.join(self.store, 'images')), [])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+import unittest
+
+import deploy
+
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        self.saved = {name: getattr(deploy.config, name, None) for name in ['docker', 'containers', 'work_dir']}
+        deploy.config.docker = {}
+        deploy.config.work_dir = '/nonexistent/'
+        deploy.config.containers = [
+            {'name': 'base:$VERSION', 'registry': 'localhost:5000', 'dockerfile': 'base/Dockerfile'},
+            {'name': 'app:$VERSION', 'registry': 'localhost:5000', 'dockerfile': 'app/Dockerfile',
+             'depends_on': ['base'], 'arch_name': 'app.tar'},
+        ]
+        self.variables = deploy.config.variables
+        deploy.config.variables = {'VERSION': '1.0.0'}
+        self.flags = deploy.flags
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(deploy.config, name, value)
+        deploy.config.variables = self.variables
+        deploy.flags = self.flags
+
+    def graph(self, commands):
+        return {task['id']: task['deps'] for task in deploy.pipeline_tasks(commands)}
+
+    def test_graph(self):
+        """Test dependencies of stage tasks"""
+        base, app, worker = 'localhost:5000/base:1.0.0', 'localhost:5000/app:1.0.0', 'localhost:5000/worker:1.0.0'
+        deploy.config.containers.append({'name': 'worker:$VERSION', 'registry': 'localhost:5000',
+                                         'dockerfile': 'worker/Dockerfile', 'arch_name': 'worker.tar',
+                                         'deploy_separately': True})
+        deploy.flags = []
+        before_deploy = {'build-env', 'build ' + base, 'build ' + app, 'build ' + worker, 'push ' + base, 'check',
+                         'dump ' + app, 'dump ' + worker, 'archive', 'upload'}
+        self.assertEqual(self.graph(['build-env', 'build', 'push', 'deploy', 'run']), {
+            'build-env': set(),
+            'build ' + base: set(),
+            'build ' + app: {'build ' + base},
+            'build ' + worker: set(),
+            'push ' + base: {'build ' + base},
+            'check': {'build-env'},
+            'dump ' + app: {'build ' + app, 'build-env', 'check'},
+            'dump ' + worker: {'build ' + worker, 'build-env', 'check'},
+            # Dump deployed separately is not a part of the archive
+            'archive': {'dump ' + app, 'build-env', 'check'},
+            'upload': {'archive'},
+            'deploy': before_deploy,
+            'run': before_deploy | {'deploy'},
+        })
+
+        deploy.flags = ['--stream']
+        self.assertEqual(self.graph(['run', 'deploy']), {
+            'run': set(),
+            'check': {'run'},
+            'dump ' + app: {'run', 'check'},
+            'dump ' + worker: {'run', 'check'},
+            'deploy': {'run', 'check', 'dump ' + app, 'dump ' + worker},
+        })
+
+    def test_limits(self):
+        """Test tasks of a group are limited, other tasks run at the same time"""
+        running = {'build': 0, 'push': 0}
+        peaks = {'build': 0, 'push': 0, 'total': 0}
+        lock = threading.Lock()
+
+        def task(group):
+            with lock:
+                running[group] += 1
+                peaks[group] = max(peaks[group], running[group])
+                peaks['total'] = max(peaks['total'], sum(running.values()))
+            time.sleep(0.05)
+            with lock:
+                running[group] -= 1
+
+        tasks = [{'id': '%s %d' % (group, i), 'fn': (lambda g: lambda: task(g))(group), 'deps': set(),
+                  'limits': {group: 2}} for group in ['build', 'push'] for i in range(4)]
+        done, failed = deploy.run_tasks(tasks, 10)
+
+        self.assertEqual(len(done), 8)
+        self.assertEqual(peaks, {'build': 2, 'push': 2, 'total': 4})
+
+    def test_history(self):
+        """Test every stage of the pipeline is recorded from its first task start to its last task end"""
+        def task(id, stage, delay, deps=()):
+            return {'id': id, 'stage': stage, 'fn': lambda: time.sleep(delay), 'deps': set(deps)}
+
+        pipeline_tasks = deploy.pipeline_tasks
+        deploy.pipeline_tasks = lambda commands: [
+            task('build a', 'build', 0.1), task('build b', 'build', 0.2, ['build a']),
+            task('dump a', 'dump', 0.05, ['build a']), task('deploy', 'deploy', 0.05, ['build b', 'dump a'])]
+        del deploy.history_stages[:]
+        try:
+            deploy.run_pipeline(['build', 'deploy'])
+            stages = dict(deploy.history_stages)
+        finally:
+            deploy.pipeline_tasks = pipeline_tasks
+            del deploy.history_stages[:]
+
+        self.assertEqual(sorted(stages), ['pipeline build', 'pipeline deploy', 'pipeline dump'])
+        self.assertGreaterEqual(stages['pipeline build'], 0.3)
+        self.assertLess(stages['pipeline dump'], 0.1)
+        self.assertGreaterEqual(stages['pipeline deploy'], 0.05)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
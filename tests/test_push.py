@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import deploy
+
+DIGEST = 'sha256:1111111111111111111111111111111111111111111111111111111111111111'
+
+
+# Fake registry which knows only test-app:1.0.0
+class RegistryHandler(BaseHTTPRequestHandler):
+    def do_HEAD(self):
+        if self.path == '/v2/test-app/manifests/1.0.0':
+            self.send_response(200)
+            self.send_header('Docker-Content-Digest', DIGEST)
+        else:
+            self.send_response(404)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestPush(unittest.TestCase):
+    def setUp(self):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), RegistryHandler)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.registry = '127.0.0.1:%d' % self.httpd.server_port
+
+        # Emulate docker: local images and executed commands
+        self.commands = []
+        self.repo_digests = {}
+        self.run, self.run_output = deploy.run, deploy.run_output
+        deploy.run = lambda command, input=None: self.commands.append(command)
+        deploy.run_output = lambda command, check=True: json.dumps(self.repo_digests.get(command.split()[-1], []))
+        self.docker, deploy.config.docker = deploy.config.docker, {}
+
+    def tearDown(self):
+        deploy.run, deploy.run_output = self.run, self.run_output
+        deploy.config.docker = self.docker
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def test_manifest_digest(self):
+        """Test digest lookup in registry"""
+        self.assertEqual(deploy.registry_manifest_digest(self.registry, 'test-app:1.0.0'), DIGEST)
+        self.assertIsNone(deploy.registry_manifest_digest(self.registry, 'test-app:2.0.0'))
+        self.assertIsNone(deploy.registry_manifest_digest('127.0.0.1:1', 'test-app:1.0.0'))
+
+    def test_push_skips_existing(self):
+        """Test only changed images are pushed"""
+        self.repo_digests = {
+            self.registry + '/test-app:1.0.0': [self.registry + '/test-app@' + DIGEST],
+            self.registry + '/test-app:2.0.0': [self.registry + '/test-app@' + DIGEST],
+        }
+        containers = [
+            {'name': 'test-app:1.0.0', 'registry': self.registry},
+            {'name': 'test-app:2.0.0', 'registry': self.registry},
+            {'name': 'test-new:1.0.0', 'registry': self.registry},
+        ]
+
+        deploy.push_containers({}, containers)
+
+        self.assertEqual(sorted(self.commands), [
+            'docker push %s/test-app:2.0.0' % self.registry,
+            'docker push %s/test-new:1.0.0' % self.registry,
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
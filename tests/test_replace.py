@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+import collections
+import os
+import tempfile
+import unittest
+
+import deploy
+
+
+class TestRenderFile(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.variables = {
+            'VERSION': '1.0.0',
+            'VERSION_SUFFIX': '-prod',
+            'SPECIAL': 'a&b\\c/d\nnext line',
+        }
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def render(self, content, chunk_size=1024 * 1024):
+        frm = os.path.join(self.dir.name, 'src.conf')
+        to = os.path.join(self.dir.name, 'dst.conf')
+        with open(frm, 'w') as f:
+            f.write(content)
+
+        default_chunk_size = deploy.render_chunk_size
+        deploy.render_chunk_size = chunk_size
+        try:
+            deploy.render_file(deploy.compile_variables(self.variables), frm, to)
+        finally:
+            deploy.render_chunk_size = default_chunk_size
+
+        with open(to) as f:
+            return f.read()
+
+    def test_replace(self):
+        """Test only known ${VARNAME} variables are replaced"""
+        self.assertEqual(
+            self.render('v=${VERSION}${VERSION_SUFFIX} $VERSION ${UNKNOWN} ${}'),
+            'v=1.0.0-prod $VERSION ${UNKNOWN} ${}'
+        )
+
+    def test_special_characters(self):
+        """Test values with sed special characters are not escaped"""
+        self.assertEqual(self.render('value: ${SPECIAL}'), 'value: a&b\\c/d\nnext line')
+
+    def test_chunks(self):
+        """Test variables on chunk boundaries"""
+        content = 'x${VERSION}$${VERSION_SUFFIX}}' * 50
+        expected = 'x1.0.0$-prod}' * 50
+        for chunk_size in [1, 2, 3, 5, 7, 64]:
+            self.assertEqual(self.render(content, chunk_size), expected)
+
+
+class TestReplaceVariables(unittest.TestCase):
+    def test_longest_name(self):
+        """Test the longest defined name is used regardless of order of variables"""
+        for variables in [{'VERSION': '1.0.0', 'VERSION_SUFFIX': '-prod'}, {'VERSION_SUFFIX': '-prod', 'VERSION': '1.0.0'}]:
+            self.assertEqual(deploy.replace_variables(variables, 'app:$VERSION$VERSION_SUFFIX'), 'app:1.0.0-prod')
+            self.assertEqual(deploy.replace_variables(variables, '${VERSION}_SUFFIX $VERSIONX'), '1.0.0_SUFFIX 1.0.0X')
+
+    def test_unknown(self):
+        """Test unknown variables and shell syntax are kept"""
+        self.assertEqual(deploy.replace_variables({'A': 'a'}, "$B ${B} awk '{print $1}' $ $$A"),
+                         "$B ${B} awk '{print $1}' $ $a")
+
+    def test_references(self):
+        """Test values refer to other variables, cycles are kept unresolved"""
+        variables = {'LOGS': '$DESTINATION_DIR/logs', 'DESTINATION_DIR': '/srv/app', 'A': '$B', 'B': '$A'}
+        self.assertEqual(deploy.replace_variables(variables, '$LOGS'), '/srv/app/logs')
+        self.assertEqual(deploy.replace_variables(variables, '$A'), '$A')
+
+    def test_layers(self):
+        """Test server values override environment, environment overrides config"""
+        variables = collections.ChainMap({'ENV': 'prod'}, {'HOME': '/root', 'ENV': 'shell'}, {'HOME': '/home'})
+        self.assertEqual(deploy.replace_variables(variables, '$HOME/$ENV'), '/root/prod')
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
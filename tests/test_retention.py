@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import random
+import signal
+import subprocess
+import unittest
+
+import deploy
+
+
+def image(tag, image_id='', repository='localhost:5000/app'):
+    return {'Repository': repository, 'Tag': tag, 'ID': image_id}
+
+
+class TestRetention(unittest.TestCase):
+    def plan(self, container, images, containers=()):
+        container = dict({'name': 'app:1.0.0', 'registry': 'localhost:5000', 'cleanup_old': True}, **container)
+        return deploy.docker_cleanup_plan({}, [container], {'images': images, 'containers': list(containers)})
+
+    def test_version_sort(self):
+        """Test tags are ordered like sort -V"""
+        tags = ['1.0.10', '1.0.9', '1.0.2-prod', '1.0.2', '1.0.2~rc1', '1.0.2a', '1.10', '1.9.9', 'latest', '2']
+        random.Random(1).shuffle(tags)
+        expected = subprocess.run(['sort', '-V'], input='\n'.join(tags) + '\n', capture_output=True,
+                                  text=True, check=True).stdout.split()
+        self.assertEqual(sorted(tags, key=deploy.version_key), expected)
+
+    def test_plan(self):
+        """Test old tags are removed, newest and matching only are kept"""
+        images = [image(tag) for tag in ['1.0.0', '1.0.1', '1.0.10', '1.0.9', '1.0.1-prod', '1.0.2-prod']]
+        images.append(image('1.0.0', repository='localhost:5000/other'))
+
+        self.assertEqual(self.plan({'keep_versions': 2}, images),
+                         ['localhost:5000/app:1.0.2-prod', 'localhost:5000/app:1.0.1-prod',
+                          'localhost:5000/app:1.0.1', 'localhost:5000/app:1.0.0'])
+        self.assertEqual(self.plan({'name': 'app:1.0.2-prod', 'cleanup_pattern': '*-prod', 'keep_versions': 1},
+                                   images), ['localhost:5000/app:1.0.1-prod'])
+        self.assertEqual(self.plan({'keep_versions': 10}, images), [])
+        self.assertEqual(self.plan({'cleanup_old': False}, images), [])
+
+    def test_in_use(self):
+        """Test images used by containers are kept, by tag or by ID"""
+        images = [image('1.0.0', 'sha256:aaa'), image('1.0.1', 'sha256:bbb'), image('1.0.2', 'sha256:ccc'),
+                  image('1.0.3', 'sha256:ddd')]
+        containers = [{'Image': 'localhost:5000/app:1.0.0'}, {'Image': 'sha256:bbb'}]
+        self.assertEqual(self.plan({'name': 'app:1.0.3', 'keep_versions': 1}, images, containers),
+                         ['localhost:5000/app:1.0.2'])
+
+    def test_transaction(self):
+        """Test version which is not loaded yet is counted"""
+        images = [image('1.0.0'), image('1.0.1')]
+        self.assertEqual(self.plan({'name': 'app:1.0.2', 'keep_versions': 2}, images), ['localhost:5000/app:1.0.0'])
+
+    def test_cleanup_errors(self):
+        """Test failed cleanup does not fail the deploy, interrupt during cleanup stops it"""
+        ssh, err = deploy.ssh, deploy.err
+        errors = []
+        container = {'name': 'app:1.0.2', 'registry': 'localhost:5000', 'cleanup_old': True, 'keep_versions': 1}
+        inventory = {'images': [image('1.0.0'), image('1.0.1')], 'containers': []}
+
+        def fail(server, command):
+            raise deploy.CommandError({'command': command, 'code': 1, 'output': '', 'time': 0, 'timed_out': False})
+
+        def interrupt(server, command):
+            deploy.signal_handler(signal.SIGINT, None)
+
+        deploy.err = errors.append
+        try:
+            deploy.ssh = fail
+            deploy.docker_cleanup({}, {}, [container], inventory=inventory)
+            self.assertEqual(errors, ['Failed to cleanup old versions: Command failed with code 1: '
+                                      'docker rmi localhost:5000/app:1.0.1 localhost:5000/app:1.0.0 || true'])
+
+            deploy.ssh = interrupt
+            with self.assertRaises(SystemExit) as e:
+                deploy.docker_cleanup({}, {}, [container], inventory=inventory)
+            self.assertNotIsInstance(e.exception, deploy.CommandError)
+
+            # Command killed by Ctrl+C in a thread of a group deploy
+            deploy.ssh = fail
+            with self.assertRaises(deploy.CommandError):
+                deploy.docker_cleanup({}, {}, [container], inventory=inventory)
+            self.assertEqual(len(errors), 1)
+        finally:
+            deploy.ssh, deploy.err = ssh, err
+            deploy.interrupted_flag = False
+
+    def test_remove_command(self):
+        """Test images are removed in one call"""
+        self.assertEqual(deploy.docker_remove_images_command(['a:1', 'a:2']), 'docker rmi a:1 a:2 || true')
+        self.assertEqual(deploy.docker_remove_images_command(['a:1'], True),
+                         'nohup docker rmi a:1 >/dev/null 2>&1 </dev/null &')
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
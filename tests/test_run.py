@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+import time
+import unittest
+
+import deploy
+
+
+class TestRun(unittest.TestCase):
+    def tearDown(self):
+        deploy.thread_local.prefix = ''
+
+    def test_error(self):
+        """Test failed command raises CommandError with exit code, check=False returns the code"""
+        with self.assertRaises(deploy.CommandError) as context:
+            deploy.run('exit 3')
+        self.assertEqual(context.exception.code, 3)
+        self.assertIsInstance(context.exception, SystemExit)
+        self.assertEqual(deploy.run('exit 4', check=False), 4)
+        self.assertEqual(deploy.run_output('echo ok'), 'ok\n')
+
+    def test_timeout(self):
+        """Test the whole process group is killed by timeout"""
+        start = time.time()
+        with self.assertRaises(deploy.CommandError) as context:
+            deploy.run('sleep 30 & sleep 30', timeout=0.3)
+        self.assertLess(time.time() - start, 10)
+        self.assertTrue(context.exception.result['timed_out'])
+        self.assertEqual(context.exception.code, deploy.timeout_code)
+        self.assertEqual(deploy.running_processes, {})
+
+        with self.assertRaises(deploy.CommandError):
+            deploy.run_output('sleep 30', timeout=0.3)
+
+    def test_output(self):
+        """Test output of parallel tasks is kept in a bounded buffer"""
+        deploy.thread_local.prefix = '[task] '
+        result = deploy.execute('seq 1 %d' % (deploy.output_tail_lines * 2))
+        lines = result['output'].split('\n')
+        self.assertEqual(len(lines), deploy.output_tail_lines)
+        self.assertEqual(lines[-1], str(deploy.output_tail_lines * 2))
+
+        hidden = []
+        result = deploy.execute('echo a; echo b; exit 2', on_line=lambda line: hidden.append(line) or True)
+        self.assertEqual((result['code'], hidden), (2, ['a', 'b']))
+
+    def test_binary_output(self):
+        """Test output which is not UTF-8 does not fail the command, failed output handler stops it"""
+        deploy.thread_local.prefix = '[task] '
+        result = deploy.execute("printf 'a\\377\\376b\\n'")
+        self.assertEqual((result['code'], result['output']), (0, 'a\ufffd\ufffdb'))
+        self.assertEqual(deploy.run_output("printf '\\377'"), '\ufffd')
+
+        def fail(line):
+            raise ValueError(line)
+
+        start = time.time()
+        with self.assertRaises(ValueError):
+            deploy.execute('echo a; exec sleep 30', on_line=fail)
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(deploy.running_processes, {})
+
+        done, failed = deploy.run_tasks([{'id': 'a', 'fn': lambda: deploy.run("printf '\\377\\376'"),
+                                          'deps': set(), 'prefix': '[a] '}])
+        self.assertEqual((done, failed), ({'a'}, set()))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import deploy
+
+
+class TestServers(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.saved = {name: getattr(deploy.config, name, None) for name in [
+            'variables', 'servers', 'groups', 'parallel', 'work_dir', 'temp_dir', 'destination_dir', 'arch_name',
+            'files', 'containers', 'replace_vars_file_patterns']}
+        self.globals = {name: getattr(deploy, name, None) for name in
+                        ['server', 'servers', 'server_name', 'base_variables', 'flags', 'out']}
+        self.output = []
+        deploy.out = lambda text: self.output.append(text)
+        deploy.flags = []
+
+        work_dir = os.path.join(self.dir.name, 'work')
+        os.makedirs(work_dir)
+        with open(os.path.join(work_dir, 'site.conf'), 'w') as f:
+            f.write('server_name ${DOMAIN};\n')
+
+        deploy.config.variables = {'SUDO': 'sudo', 'DOMAIN': 'fish.local'}
+        deploy.config.servers = {
+            'dev': {'host': 'fish-dev', 'version': '1.0.0', 'env': 'dev'},
+            'prod': {'host': 'fish-prod', 'version': '1.0.0', 'env': 'prod', 'tags': ['web'],
+                     'variables': {'DOMAIN': 'fish.com', 'SUDO': ''}},
+            'prod2': {'host': 'fish-prod2', 'version': '1.0.0', 'env': 'prod', 'tags': ['web'],
+                      'variables': {'DOMAIN': 'fish.com'}, 'destination_dir': 'fish2'},
+        }
+        deploy.config.groups = {'all': ['prod', 'dev'], 'production': ['prod', 'prod2']}
+        deploy.config.parallel = 10
+        deploy.config.work_dir = work_dir
+        deploy.config.temp_dir = os.path.join(self.dir.name, 'tmp-$ENV')
+        deploy.config.destination_dir = 'fish'
+        deploy.config.arch_name = 'fish.tar.gz'
+        deploy.config.files = [{'path': 'site.conf', 'env_path': 'site.conf', 'replace_vars': True}]
+        deploy.config.containers = [{'name': 'app:$VERSION', 'arch_name': 'app-$ENV.tar'}]
+        deploy.config.replace_vars_file_patterns = ['.conf$']
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(deploy.config, name, value)
+        for name, value in self.globals.items():
+            setattr(deploy, name, value)
+        self.dir.cleanup()
+
+    def init(self, name):
+        deploy.server_name = name
+        deploy.init_config(name)
+        os.makedirs(deploy.config.temp_dir_environment, exist_ok=True)
+
+    def test_resolve(self):
+        """Test servers are found by server name, group name and tag"""
+        self.assertEqual(deploy.get_servers('dev'), ['dev'])
+        self.assertEqual(deploy.get_servers('all'), ['prod', 'dev'])
+        self.assertEqual(deploy.get_servers('web'), ['prod', 'prod2'])
+        self.assertEqual(deploy.get_servers('unknown'), [])
+
+    def test_variables(self):
+        """Test every server of the group gets its own variables, variables of the first server are not shared"""
+        self.init('all')
+        self.assertEqual(deploy.server, deploy.config.servers['prod'])
+        self.assertEqual(deploy.config.variables['SUDO'], '')
+
+        dev = deploy.get_server_variables('dev')
+        self.assertEqual((dev['SERVER_NAME'], dev['SERVER_HOST'], dev['ENV']), ('dev', 'fish-dev', 'dev'))
+        self.assertEqual((dev['SUDO'], dev['DOMAIN'], dev['DESTINATION_DIR']), ('sudo', 'fish.local', 'fish'))
+        self.assertEqual(dev['TEMP_DIR'], os.path.join(self.dir.name, 'tmp-prod'))
+
+        prod2 = deploy.get_server_variables('prod2')
+        self.assertEqual((prod2['SUDO'], prod2['DESTINATION_DIR']), ('sudo', 'fish2'))
+
+    def test_check(self):
+        """Test group is rejected if a server resolves the built environment or containers differently"""
+        self.init('all')
+        deploy.stage_build_environment()
+        with self.assertRaises(SystemExit):
+            deploy.check_group_variables()
+        self.assertIn('Server dev of [all] resolves ${DOMAIN}, app-$ENV.tar differently', self.output[-1])
+
+        self.init('production')
+        deploy.stage_build_environment()
+        deploy.check_group_variables()
+
+        deploy.config.servers['prod2']['version'] = '1.0.1'
+        with self.assertRaises(SystemExit):
+            deploy.check_group_variables()
+        self.assertIn('resolves app:$VERSION differently', self.output[-1])
+
+    def test_check_build(self):
+        """Test group is rejected if a server resolves build arguments or the docker host of containers differently"""
+        deploy.config.containers = [{'name': 'app:1.0.0', 'registry': 'localhost:5000', 'dockerfile': 'Dockerfile',
+                                     'build_path': './', 'build_args': ['DOMAIN=${DOMAIN}', 'ENV=${ENV}']}]
+        self.init('production')
+        deploy.stage_build_environment()
+        deploy.check_group_variables()
+
+        deploy.config.servers['prod2']['variables']['DOMAIN'] = 'fish2.com'
+        with self.assertRaises(SystemExit):
+            deploy.check_group_variables()
+        self.assertIn('resolves ${DOMAIN}, DOMAIN=${DOMAIN} differently', self.output[-1])
+
+        deploy.config.servers['prod2']['variables']['DOMAIN'] = 'fish.com'
+        deploy.config.containers[0]['docker_host'] = 'ssh://${SERVER_HOST}'
+        with self.assertRaises(SystemExit):
+            deploy.check_group_variables()
+        self.assertIn('resolves ssh://${SERVER_HOST} differently', self.output[-1])
+
+    def test_parallel(self):
+        """Test no more than parallel servers are deployed at the same time"""
+        deploy.config.servers.update({'web%d' % i: {'host': 'web%d' % i, 'version': '1.0.0', 'env': 'prod',
+                                                    'tags': ['web']} for i in range(6)})
+        self.init('web')
+        deploy.flags = ['--parallel=3']
+        running = [0, 0]
+        hosts = []
+        lock = threading.Lock()
+
+        def fn(server, variables):
+            with lock:
+                running[0] += 1
+                running[1] = max(running[1], running[0])
+                hosts.append(variables['SERVER_HOST'])
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+
+        deploy.on_servers(fn)
+        self.assertEqual(running[1], 3)
+        self.assertEqual(sorted(hosts), sorted(server['host'] for server in deploy.config.servers.values()
+                                               if 'web' in server.get('tags', [])))
+
+    def test_failure(self):
+        """Test failure on one server does not stop other servers, summary is printed and run fails"""
+        self.init('web')
+        deployed = []
+
+        def fn(server, variables):
+            if variables['SERVER_NAME'] == 'prod':
+                raise SystemExit(2)
+            deployed.append(variables['SERVER_NAME'])
+
+        with self.assertRaises(SystemExit) as e:
+            deploy.on_servers(fn)
+        self.assertEqual(e.exception.code, 1)
+        self.assertEqual(deployed, ['prod2'])
+        output = '\n'.join(self.output)
+        self.assertRegex(output, r'prod +fish-prod +failed')
+        self.assertRegex(output, r'prod2 +fish-prod2 +ok')
+        self.assertIn('Failed on 1 of 2 servers', output)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
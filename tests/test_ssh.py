@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import threading
+import unittest
+
+import deploy
+
+# Stub ssh and rsync log their arguments, ssh reads the script, master creates its socket and removes it on exit,
+# master of host "down" fails to connect
+STUBS = {
+    'ssh': """#!/bin/bash
+echo "ssh $*" >> "$SSH_TEST_LOG"
+case "$*" in *"-N -f down"*) exit 255;; esac
+control_path=$(echo "$*" | sed -n 's/.*ControlPath=\\([^ ]*\\).*/\\1/p')
+case "$*" in *"ControlMaster=yes"*) touch "$control_path";; *"-O exit"*) rm -f "$control_path";; esac
+[ "${@: -2:1}" = bash ] && cat > /dev/null
+exit 0
+""",
+    'rsync': """#!/bin/bash
+echo "rsync $*" >> "$SSH_TEST_LOG"
+""",
+}
+
+
+class TestSsh(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        bin_dir = os.path.join(self.dir.name, 'bin')
+        os.makedirs(bin_dir)
+        for name, script in STUBS.items():
+            with open(os.path.join(bin_dir, name), 'w') as f:
+                f.write(script)
+            os.chmod(os.path.join(bin_dir, name), 0o755)
+        self.log = os.path.join(self.dir.name, 'calls.log')
+        self.environ = dict(os.environ)
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+        os.environ['SSH_TEST_LOG'] = self.log
+
+        self.saved = {name: getattr(deploy.config, name, None) for name in ['ssh', 'command_timeout']}
+        deploy.config.ssh = {}
+        deploy.config.command_timeout = 0
+        self.err = deploy.err
+        self.errors = []
+        deploy.err = lambda text: self.errors.append(text)
+        self.server = {'host': 'fish-prod', 'user': 'deploy', 'port': '2222'}
+
+    def tearDown(self):
+        deploy.ssh_disconnect()
+        os.environ.clear()
+        os.environ.update(self.environ)
+        for name, value in self.saved.items():
+            setattr(deploy.config, name, value)
+        deploy.err = self.err
+        self.dir.cleanup()
+
+    def calls(self):
+        with open(self.log) as f:
+            return f.read().splitlines()
+
+    def upload(self, server):
+        path = os.path.join(self.dir.name, 'fish.tar.gz')
+        open(path, 'w').close()
+        deploy.upload(server, path, 'fish/')
+        return path
+
+    def test_multiplexing(self):
+        """Test one master connection per server is opened and reused by ssh and rsync"""
+        threads = [threading.Thread(target=deploy.ssh, args=(self.server, 'true')) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        path = self.upload(self.server)
+
+        control_path = deploy.ssh_masters['deploy@fish-prod:2222']['control_path']
+        self.assertEqual(os.path.dirname(control_path), deploy.ssh_control_dir)
+        calls = self.calls()
+        self.assertEqual(calls[0], 'ssh -o ControlMaster=yes -o ControlPersist=60 -o ConnectTimeout=10 '
+                                   '-o ControlPath=%s -p 2222 -N -f deploy@fish-prod' % control_path)
+        options = '-p 2222 -o ControlMaster=no -o ControlPath=%s' % control_path
+        self.assertEqual(calls[1:5], ['ssh %s deploy@fish-prod bash -s' % options] * 4)
+        self.assertEqual(calls[5], 'rsync -chavzP --info=progress2 -e ssh %s %s deploy@fish-prod:fish/'
+                         % (options, path))
+
+        deploy.config.ssh = {'persist': 300, 'connect_timeout': 3}
+        deploy.ssh({'host': 'fish-dev'}, 'true')
+        self.assertIn('-o ControlPersist=300 -o ConnectTimeout=3 ', self.calls()[6])
+
+    def test_expired(self):
+        """Test master connection is opened again after it exits by itself"""
+        deploy.ssh(self.server, 'true')
+        control_path = deploy.ssh_masters['deploy@fish-prod:2222']['control_path']
+        deploy.ssh(self.server, 'true')
+        self.assertEqual(len([call for call in self.calls() if 'ControlMaster=yes' in call]), 1)
+
+        os.remove(control_path)
+        deploy.ssh(self.server, 'true')
+        calls = self.calls()
+        self.assertEqual(len([call for call in calls if 'ControlMaster=yes' in call]), 2)
+        self.assertIn('ControlMaster=yes', calls[-2])
+        self.assertEqual(calls[-1], 'ssh -p 2222 -o ControlMaster=no -o ControlPath=%s deploy@fish-prod bash -s'
+                         % control_path)
+
+    def test_separate(self):
+        """Test separate connections without multiplexing and if the master connection fails"""
+        deploy.config.ssh = {'multiplexing': False}
+        deploy.ssh(self.server, 'true')
+        path = self.upload(self.server)
+        self.assertEqual(self.calls(), [
+            'ssh -p 2222 deploy@fish-prod bash -s',
+            'rsync -chavzP --info=progress2 -e ssh -p 2222 %s deploy@fish-prod:fish/' % path,
+        ])
+        self.assertEqual(deploy.ssh_masters, {})
+
+        deploy.config.ssh = {}
+        deploy.ssh({'host': 'down'}, 'true')
+        deploy.ssh({'host': 'down'}, 'true')
+        self.assertEqual([call for call in self.calls()[2:] if 'ControlMaster=yes' not in call],
+                         ['ssh down bash -s'] * 2)
+        self.assertEqual(len(self.calls()), 5)
+        self.assertEqual(self.errors, ['Failed to open multiplexed connection to down, use separate connections'])
+
+    def test_disconnect(self):
+        """Test master connections are closed and the control directory is removed"""
+        deploy.ssh(self.server, 'true')
+        deploy.ssh({'host': 'fish-dev'}, 'true')
+        deploy.ssh({'host': 'down'}, 'true')
+        control_dir = deploy.ssh_control_dir
+        paths = [master['control_path'] for master in deploy.ssh_masters.values() if master['control_path']]
+
+        deploy.ssh_disconnect()
+        self.assertEqual(self.calls()[-2:], [
+            'ssh -o ControlPath=%s -O exit deploy@fish-prod' % paths[0],
+            'ssh -o ControlPath=%s -O exit fish-dev' % paths[1],
+        ])
+        self.assertEqual((deploy.ssh_masters, deploy.ssh_control_dir), ({}, ''))
+        self.assertFalse(os.path.exists(control_dir))
+
+        # Next call opens a new master connection
+        deploy.ssh(self.server, 'true')
+        self.assertIn('ControlMaster=yes', self.calls()[-2])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import tempfile
+import unittest
+
+import deploy
+
+
+class TestTrace(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.trace_file = os.path.join(self.dir.name, 'trace.json')
+        deploy.trace_file = self.trace_file
+        deploy.trace_spans.clear()
+
+    def tearDown(self):
+        deploy.trace_file = ''
+        deploy.trace_spans.clear()
+        self.dir.cleanup()
+
+    def test_trace(self):
+        """Test commands and tasks are written as nested trace events"""
+        with deploy.Span('build', 'stage'):
+            deploy.run('true')
+            deploy.run_tasks([
+                {'id': 'ok', 'fn': lambda: deploy.run('true'), 'deps': set(), 'prefix': '[ok] '},
+                {'id': 'fail', 'fn': lambda: deploy.run('exit 3'), 'deps': set(), 'prefix': '[fail] '},
+            ], 2)
+        deploy.write_trace(self.trace_file)
+
+        with open(self.trace_file) as f:
+            events = json.load(f)['traceEvents']
+        spans = [event for event in events if event['ph'] == 'X']
+        threads = {event['tid']: event['args']['name'] for event in events if event['ph'] == 'M'}
+
+        self.assertEqual(len(spans), 6)
+        stage = spans[0]
+        self.assertEqual((stage['name'], stage['cat'], stage['ts']), ('build', 'stage', 0))
+        for span in spans[1:]:
+            self.assertGreaterEqual(span['ts'], stage['ts'])
+            self.assertLessEqual(span['ts'] + span['dur'], stage['ts'] + stage['dur'])
+
+        codes = {threads[span['tid']]: span['args']['code'] for span in spans if span['cat'] == 'command'}
+        self.assertEqual(codes, {'MainThread': 0, '[ok]': 0, '[fail]': 3})
+        self.assertEqual(sorted(span['name'] for span in spans if span['cat'] == 'task'), ['fail', 'ok'])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
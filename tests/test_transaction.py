@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import deploy
+
+
+class TestTransaction(unittest.TestCase):
+    def setUp(self):
+        self.ssh, self.out, self.mes, self.err = deploy.ssh, deploy.out, deploy.mes, deploy.err
+        self.output = []
+        self.lines = []
+        deploy.out = deploy.mes = deploy.err = lambda text: self.output.append(text)
+
+        # Generated script is run by local bash instead of the server
+        def ssh(server, command, on_line=None, check=True):
+            def line(text):
+                if not on_line(text):
+                    self.lines.append(text.rstrip('\n'))
+                return True
+            return deploy.run('bash -s', command, line, check)
+        deploy.ssh = ssh
+
+    def tearDown(self):
+        deploy.ssh, deploy.out, deploy.mes, deploy.err = self.ssh, self.out, self.mes, self.err
+
+    def results(self, results):
+        return [(result['name'], result['code']) for result in results]
+
+    def test_steps(self):
+        """Test every step reports its code, output without newline at the end does not hide markers"""
+        results = deploy.remote_transaction({'host': 'localhost'}, [
+            {'name': 'extract', 'command': "printf 'extracted'"},
+            {'name': 'cleanup', 'command': 'echo cleanup; exit 3', 'optional': True},
+            {'name': 'run', 'command': "printf 'started'"},
+        ])
+        self.assertEqual(self.results(results), [('extract', 0), ('cleanup', 3), ('run', 0)])
+        self.assertIn('extracted', self.lines)
+        self.assertIn('cleanup', self.lines)
+        self.assertIn('started', self.lines)
+        self.assertFalse([line for line in self.lines if deploy.step_marker in line])
+        self.assertIn('Step: cleanup', self.output)
+        self.assertRegex('\n'.join(self.output), r'cleanup +3 +\d+\.\d+s')
+
+    def test_output(self):
+        """Test empty lines printed before markers are dropped, empty lines of the output and the table are prefixed"""
+        deploy.thread_local.prefix = '[web1] '
+        try:
+            deploy.remote_transaction({'host': 'localhost'}, [
+                {'name': 'extract', 'command': 'echo extracted'},
+                {'name': 'run', 'command': 'echo; echo started; echo; echo'},
+            ])
+        finally:
+            deploy.thread_local.prefix = ''
+        self.assertEqual(self.lines, ['extracted', 'started'])
+        self.assertEqual([line for line in self.output if line == '[web1] '], ['[web1] '] * 3)
+        table = self.output[-3:]
+        self.assertRegex(table[0], r'^\[web1\] STEP +CODE +TIME$')
+        self.assertRegex(table[1], r'^\[web1\] extract +0 +\d+\.\d+s$')
+        self.assertRegex(table[2], r'^\[web1\] run +0 +\d+\.\d+s$')
+
+    def test_failure(self):
+        """Test failed step stops the transaction, remaining steps are not run"""
+        with self.assertRaises(SystemExit) as e:
+            deploy.remote_transaction({'host': 'localhost'}, [
+                {'name': 'import', 'command': "printf 'loading'; exit 5"},
+                {'name': 'run', 'command': 'echo started'},
+            ])
+        self.assertEqual(e.exception.code, 5)
+        self.assertEqual([line for line in self.output if line.startswith('Step: ')], ['Step: import'])
+        self.assertNotIn('started', self.lines)
+        self.assertRegex('\n'.join(self.output), r'import +5 ')
+        self.assertIn('Remote transaction failed with code 5', self.output)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
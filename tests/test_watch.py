@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import deploy
+
+
+class TestWatch(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.work_dir = os.path.join(self.dir.name, 'work')
+        os.makedirs(os.path.join(self.work_dir, 'nginx/conf.d'))
+        self.write('docker-compose.yml', 'image: app:${VERSION}\n')
+        self.write('nginx/conf.d/site.conf', 'server_name ${DOMAIN};\n')
+        self.write('nginx/mime.types', 'types ${DOMAIN}\n')
+
+        self.config = {name: getattr(deploy.config, name, None) for name in
+                       ['work_dir', 'temp_dir', 'files', 'variables', 'replace_vars_file_patterns', 'watch', 'ssh']}
+        deploy.config.work_dir = self.work_dir
+        deploy.config.temp_dir = os.path.join(self.dir.name, 'tmp')
+        deploy.config.temp_dir_environment = os.path.join(deploy.config.temp_dir, 'environment')
+        deploy.config.files = [
+            {'path': 'docker-compose.yml', 'env_path': 'docker-compose.yml', 'replace_vars': True},
+            {'path': 'nginx', 'env_path': 'nginx', 'replace_vars': True},
+        ]
+        deploy.config.variables = {'VERSION': '1.0.0', 'DOMAIN': 'fish.local'}
+        deploy.config.replace_vars_file_patterns = ['.conf$', '.yml$']
+        deploy.config.ssh = {'multiplexing': False}
+        deploy.config.watch = {'hooks': {'nginx/*': 'nginx -s reload', '*.yml': 'docker-compose up -d'}}
+        os.makedirs(deploy.config.temp_dir_environment)
+
+    def tearDown(self):
+        for name, value in self.config.items():
+            setattr(deploy.config, name, value)
+        self.dir.cleanup()
+
+    def write(self, path, content):
+        with open(os.path.join(self.work_dir, path), 'w') as f:
+            f.write(content)
+
+    def read(self, path):
+        with open(os.path.join(deploy.config.temp_dir_environment, path)) as f:
+            return f.read()
+
+    def test_watcher(self):
+        """Test created, changed and removed files are reported with inotify and with polling"""
+        for inotify in [True, False]:
+            watcher = deploy.Watcher([os.path.join(self.work_dir, 'nginx'),
+                                      os.path.join(self.work_dir, 'docker-compose.yml')], 0.05, inotify)
+            try:
+                self.assertEqual(watcher.fd >= 0, inotify)
+                self.write('docker-compose.yml', 'changed %s\n' % inotify)
+                self.write('README', 'not watched\n')
+                os.makedirs(os.path.join(self.work_dir, 'nginx/new'))
+                self.write('nginx/new/app.conf', 'app\n')
+                changed, start = deploy.watch_changes(watcher, 0.2)
+                self.assertIn(os.path.join(self.work_dir, 'docker-compose.yml'), changed)
+                self.assertIn(os.path.join(self.work_dir, 'nginx/new/app.conf'), changed)
+                self.assertNotIn(os.path.join(self.work_dir, 'README'), changed)
+
+                shutil.rmtree(os.path.join(self.work_dir, 'nginx/new'))
+                self.assertIn(os.path.join(self.work_dir, 'nginx/new/app.conf'), deploy.watch_changes(watcher, 0.2)[0])
+                self.assertEqual(watcher.wait(0.1), set())
+            finally:
+                watcher.close()
+
+    def test_update(self):
+        """Test only changed files are rendered, removed files are removed from the environment"""
+        deploy.stage_build_environment()
+        self.write('nginx/conf.d/site.conf', 'server_name www.${DOMAIN};\n')
+        self.write('nginx/conf.d/api.conf', 'server_name api.${DOMAIN};\n')
+        os.unlink(os.path.join(self.work_dir, 'nginx/mime.types'))
+
+        updated, removed = deploy.watch_update_environment({
+            os.path.join(self.work_dir, 'nginx/conf.d/site.conf'),
+            os.path.join(self.work_dir, 'nginx/conf.d/api.conf'),
+            os.path.join(self.work_dir, 'nginx/mime.types'),
+        })
+        self.assertEqual(updated, ['nginx/conf.d/api.conf', 'nginx/conf.d/site.conf'])
+        self.assertEqual(removed, ['nginx/mime.types'])
+        self.assertEqual(self.read('nginx/conf.d/site.conf'), 'server_name www.fish.local;\n')
+        self.assertEqual(self.read('nginx/conf.d/api.conf'), 'server_name api.fish.local;\n')
+        self.assertFalse(os.path.exists(os.path.join(deploy.config.temp_dir_environment, 'nginx/mime.types')))
+
+        # Build cache knows the rendered files
+        self.assertEqual(deploy.stage_build_environment(), [])
+
+    def test_hooks(self):
+        """Test hooks of matching paths are run in order of the config"""
+        self.assertEqual(deploy.watch_hooks(['nginx/conf.d/site.conf']), ['nginx -s reload'])
+        self.assertEqual(deploy.watch_hooks(['docker-compose.yml', 'nginx/mime.types']),
+                         ['nginx -s reload', 'docker-compose up -d'])
+        self.assertEqual(deploy.watch_hooks(['other']), [])
+
+    @unittest.skipUnless(shutil.which('rsync'), 'rsync is not installed')
+    def test_sync(self):
+        """Test changed files are sent by relative paths and removed files are deleted on the server"""
+        deploy.stage_build_environment()
+        destination = os.path.join(self.dir.name, 'remote')
+        os.makedirs(os.path.join(destination, 'nginx'))
+        with open(os.path.join(destination, 'nginx/mime.types'), 'w') as f:
+            f.write('old\n')
+
+        paths = ['nginx/conf.d/site.conf', 'nginx/mime.types']
+        os.unlink(os.path.join(deploy.config.temp_dir_environment, 'nginx/mime.types'))
+        commands = []
+        run, ssh = deploy.run, deploy.ssh
+        # Local rsync instead of the remote one
+        deploy.run = lambda cmd, timeout=None: subprocess.run(
+            cmd.replace("-e 'ssh' ", '').replace('localhost:', ''), shell=True, check=True, stdout=subprocess.DEVNULL)
+        deploy.ssh = lambda server, command: commands.append(command)
+        try:
+            deploy.watch_sync({'host': 'localhost'}, {'DESTINATION_DIR': destination, 'NAME': 'nginx'}, paths,
+                              ['$NAME -s reload'])
+        finally:
+            deploy.run, deploy.ssh = run, ssh
+
+        with open(os.path.join(destination, 'nginx/conf.d/site.conf')) as f:
+            self.assertEqual(f.read(), 'server_name fish.local;\n')
+        self.assertFalse(os.path.exists(os.path.join(destination, 'nginx/mime.types')))
+        self.assertEqual(commands, ['nginx -s reload'])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)